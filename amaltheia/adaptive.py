@@ -0,0 +1,142 @@
+# Copyright (C) 2019  GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import amaltheia.log as log
+from amaltheia.results import percentile
+from amaltheia.strategy import ParallelStrategy
+
+
+class AIMDController(object):
+    """Additive increase, multiplicative decrease concurrency limit. The
+    limit grows by @increase for every @limit healthy hosts (i.e. once per
+    "window" of hosts), and is multiplied by @decrease when a host is not
+    healthy. Only hosts started after the last decrease can decrease the
+    limit again, so that a single slow period only counts once"""
+
+    def __init__(self, minimum=1, maximum=4, start=None, increase=1.0,
+                 decrease=0.5):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.limit = float(start if start is not None else minimum)
+
+        self.started = 0
+        self.last_decrease = 0
+
+    @property
+    def concurrency(self):
+        return max(self.minimum, min(self.maximum, int(self.limit)))
+
+    def start(self):
+        """Called when a host starts. Returns its sequence number"""
+        self.started += 1
+        return self.started
+
+    def healthy(self):
+        self.limit = min(
+            self.maximum, self.limit + self.increase / max(1, self.limit))
+
+    def unhealthy(self, sequence):
+        """Called for unhealthy hosts, with the sequence number that start()
+        returned for them. Returns True if the limit was decreased"""
+        if sequence <= self.last_decrease:
+            return False
+
+        self.limit = max(self.minimum, self.limit * self.decrease)
+        self.last_decrease = self.started
+        return True
+
+
+class AdaptiveStrategy(ParallelStrategy):
+    '''run updates on a varying number of hosts in parallel, up to N. More
+    hosts are started while hosts are healthy, and fewer after failures or
+    slow phases'''
+
+    @property
+    def name(self):
+        return 'Adaptive-{}'.format(self.nparallel)
+
+    def __getstate__(self):
+        state = super(AdaptiveStrategy, self).__getstate__()
+        for key in ('_controller', '_sequence', '_durations'):
+            state.pop(key, None)
+        return state
+
+    @property
+    def controller(self):
+        if not hasattr(self, '_controller'):
+            args = self.strategy_args
+            minimum = int(args.get('min-parallel', 1))
+            self._controller = AIMDController(
+                minimum=minimum, maximum=self.nparallel,
+                start=int(args.get('start', minimum)),
+                increase=float(args.get('increase', 1)),
+                decrease=float(args.get('decrease', 0.5)))
+            self._sequence = {}
+            self._durations = {}
+
+        return self._controller
+
+    def concurrency(self):
+        return self.controller.concurrency
+
+    def next_host(self):
+        item = super(AdaptiveStrategy, self).next_host()
+        if item is not None:
+            self._sequence[item[0]] = self.controller.start()
+
+        return item
+
+    def unhealthy(self, result):
+        """Returns the reason @result is unhealthy, or None"""
+        if result.exception or result.failed > 0:
+            return 'failed'
+
+        if getattr(result, 'timed_out', None):
+            return 'timed out'
+
+        durations = getattr(result, 'durations', {})
+        max_duration = self.strategy_args.get('max-duration') or {}
+        ratio = self.strategy_args.get('max-duration-ratio')
+        for phase, duration in durations.items():
+            if duration > float(max_duration.get(phase, float('inf'))):
+                return '{} took {:.1f}s'.format(phase, duration)
+
+            # compare with the median of previous healthy hosts
+            previous = self._durations.get(phase, [])
+            if ratio is not None and len(previous) >= 3:
+                median = percentile(previous, 50)
+                if duration > float(ratio) * median:
+                    return '{} took {:.1f}s, median {:.1f}s'.format(
+                        phase, duration, median)
+
+        return None
+
+    def host_done(self, result):
+        controller = self.controller
+        reason = self.unhealthy(result)
+        if reason is None:
+            for phase, duration in getattr(result, 'durations', {}).items():
+                self._durations.setdefault(phase, []).append(duration)
+
+            controller.healthy()
+        elif controller.unhealthy(self._sequence.get(result.host_name, 0)):
+            log.info('[amaltheia] Host {} {}, concurrency {}'.format(
+                result.host_name, reason, controller.concurrency))
+            return
+
+        log.debug('[amaltheia] Concurrency {}'.format(
+            controller.concurrency))
@@ -16,40 +16,57 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from argparse import ArgumentParser
+import importlib
 import sys
 import yaml
 
 import amaltheia.log as log
 from amaltheia.config import config
+from amaltheia.selector import Selector
+from amaltheia.shard import parse_shard
 from amaltheia.strategy import run_strategy
 from amaltheia.utils import override
 
 
+def parse_pairs(pairs, kind):
+    """Parses list of "key=value" strings, with YAML values. Returns list
+    of (key, value)"""
+    result = []
+    for pair in pairs:
+        try:
+            key, value = pair.split('=')
+            result.append((key, yaml.safe_load(value)))
+        except (ValueError, yaml.YAMLError):
+            print('[amaltheia] Ignoring {} {}'.format(kind, pair))
+
+    return result
+
+
+def prepare_job(job, overrides, variables):
+    """Applies "key=value" @overrides to @job, and returns dictionary of
+    @variables. Raises ValueError if a required variable is missing"""
+    for key, value in parse_pairs(overrides, 'option'):
+        override(job, key, value)
+
+    variables = dict(parse_pairs(variables, 'variable'))
+    for var_name in job.get('requires', []):
+        if var_name not in variables:
+            raise ValueError('Missing required variable {}'.format(var_name))
+
+    return variables
+
+
 def parse_job(args):
     """Loads YAML file, adds any parsed arguments"""
     with open(args.script, 'r') as fin:
         result = yaml.safe_load(fin)
 
-    for arg in args.override:
-        try:
-            key, value = arg.split('=')
-            override(result, key, yaml.safe_load(value))
-        except (ValueError, yaml.YAMLError):
-            print('[amaltheia] Ignoring option {}'.format(arg))
-
-    config.variables = {}
-    for var in args.variables:
-        try:
-            key, value = var.split('=')
-            config.variables[key] = yaml.safe_load(value)
-        except (ValueError, yaml.YAMLError):
-            print('[amaltheia] Ignoring variable {}'.format(var))
-
-    for var_name in result.get('requires', []):
-        if var_name not in config.variables:
-            print('[amaltheia] Missing required variable {} for {}'.format(
-                var_name, args.script))
-            sys.exit(-1)
+    try:
+        config.variables = prepare_job(
+            result, args.override, args.variables)
+    except ValueError as e:
+        print('[amaltheia] {} for {}'.format(e, args.script))
+        sys.exit(-1)
 
     return result
 
@@ -58,15 +75,50 @@ def amaltheia(args):
     job = parse_job(args)
 
     config.load(job.get('config', {}))
-    log.setup(level=config.log_level)
-
-    log.debug('[amaltheia] Loaded variables: {}'.format(config.variables))
-    log.debug('[amaltheia] Loaded config: {}'.format(config._entries))
-
-    run_strategy(job)
+    if args.limit is not None:
+        config.load({'limit': args.limit})
+    if args.shard is not None:
+        config.load({'shard': args.shard, 'shard-key': args.shard_key})
+    if args.incremental:
+        config.load({'incremental': True})
+    if config.incremental and not config.state_file:
+        config.load({'state-file': 'amaltheia-state.json'})
+
+    try:
+        if config.limit:
+            Selector(config.limit)
+        if config.shard:
+            parse_shard(config.shard)
+    except ValueError as e:
+        print('[amaltheia] {}'.format(e))
+        sys.exit(-1)
+
+    log.setup(level=config.log_level,
+              json_file=config.log_json_file,
+              host_dir=config.log_host_dir)
+
+    try:
+        log.debug('[amaltheia] Loaded variables: {}'.format(config.variables))
+        log.debug('[amaltheia] Loaded config: {}'.format(config._entries))
+
+        run_strategy(job)
+    finally:
+        log.shutdown()
+
+
+# sub-commands, "amaltheia <command> ..." -> module with main(argv)
+commands = {
+    'serve': 'amaltheia.serve',
+    'worker': 'amaltheia.distributed',
+    'history': 'amaltheia.history',
+}
 
 
 def main():
+    if sys.argv[1:2] and sys.argv[1] in commands:
+        module = importlib.import_module(commands[sys.argv[1]])
+        return module.main(sys.argv[2:])
+
     parser = ArgumentParser(
         description='A system update tool for production servers')
 
@@ -86,6 +138,22 @@ def main():
                         required=False,
                         default=[],
                         help='"key=value" pairs for script overrides')
+    parser.add_argument('--limit',
+                        required=False,
+                        help='Only process hosts matching this selector, '
+                             'e.g. "lar04*,!lar0412,&zone=az1"')
+    parser.add_argument('--shard',
+                        required=False,
+                        help='"i/n", only process the i-th of n shards of '
+                             'the discovered hosts')
+    parser.add_argument('--shard-key',
+                        required=False,
+                        help='Host argument to shard by (e.g. "zone"), so '
+                             'that hosts with the same value stay together')
+    parser.add_argument('--incremental',
+                        action='store_true',
+                        help='Skip hosts that did not change since their '
+                             'last successful run')
 
     amaltheia(parser.parse_args())
 
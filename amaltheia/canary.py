@@ -0,0 +1,134 @@
+# Copyright (C) 2019  GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import amaltheia.log as log
+from amaltheia.results import percentile
+from amaltheia.strategy import ParallelStrategy
+from amaltheia.utils import bold
+
+
+def succeeded(result):
+    return not result.exception and result.failed == 0
+
+
+def check_gate(results, baseline, success_rate=1.0, duration_ratio=None):
+    """Checks HostResult list @results of a step. At least @success_rate
+    (0-1) of the hosts must succeed and, if @duration_ratio is set (a number
+    or a dictionary per phase), the median duration of each phase must not
+    exceed @duration_ratio times the median duration of the @baseline
+    results. Returns None if the gate passes, otherwise the reason"""
+    ok = sum(1 for r in results if succeeded(r))
+    if ok < success_rate * len(results):
+        return '{} of {} hosts succeeded'.format(ok, len(results))
+
+    if duration_ratio is None:
+        return None
+
+    for phase in ('evacuate', 'update', 'restore'):
+        ratio = duration_ratio
+        if isinstance(duration_ratio, dict):
+            ratio = duration_ratio.get(phase)
+        if ratio is None:
+            continue
+
+        expected = percentile([
+            r.durations[phase] for r in baseline
+            if phase in getattr(r, 'durations', {})], 50)
+        actual = percentile([
+            r.durations[phase] for r in results
+            if phase in getattr(r, 'durations', {})], 50)
+        if expected is None or actual is None:
+            continue
+
+        if actual > float(ratio) * expected:
+            return '{} took {:.1f}s, canaries took {:.1f}s'.format(
+                phase, actual, expected)
+
+    return None
+
+
+class CanaryStrategy(ParallelStrategy):
+    '''run updates on 1 host, then 2, 4, 8, ... hosts in parallel, up to N,
+    as long as each step is successful'''
+
+    @property
+    def name(self):
+        return 'Canary-{}'.format(self.nparallel)
+
+    def __getstate__(self):
+        state = super(CanaryStrategy, self).__getstate__()
+        for key in ('_step', '_started', '_step_results', '_canaries',
+                    '_gate_failed'):
+            state.pop(key, None)
+        return state
+
+    def setup(self):
+        if hasattr(self, '_step'):
+            return
+
+        self._step = min(self.nparallel, int(self.strategy_args.get(
+            'start', 1)))
+        self._started = 0
+        self._step_results = []
+        self._canaries = None
+        self._gate_failed = None
+
+    def concurrency(self):
+        self.setup()
+        return self._step
+
+    def next_host(self):
+        self.setup()
+        if self._gate_failed is not None or self._started >= self._step:
+            return None
+
+        item = super(CanaryStrategy, self).next_host()
+        if item is not None:
+            self._started += 1
+
+        return item
+
+    def host_done(self, result):
+        self._step_results.append(result)
+        if len(self._step_results) < self._started:
+            return
+
+        # all hosts of this step are finished, the first step is the baseline
+        results, self._step_results = self._step_results, []
+        if self._canaries is None:
+            self._canaries = results
+
+        self._gate_failed = check_gate(
+            results, self._canaries,
+            success_rate=float(self.strategy_args.get('success-rate', 1.0)),
+            duration_ratio=self.strategy_args.get('max-duration-ratio'))
+
+        if self._gate_failed is not None:
+            log.fatal(bold('[amaltheia] Canary gate failed: {}'.format(
+                self._gate_failed)))
+            return
+
+        self._started = 0
+        self._step = min(self.nparallel, self._step * int(
+            self.strategy_args.get('growth', 2)))
+        log.info('[amaltheia] Canary step passed, next step {} hosts'.format(
+            self._step))
+
+    def unscheduled(self):
+        if getattr(self, '_gate_failed', None) is None:
+            return []
+
+        return [(host_name, 'canary gate failed: {}'.format(
+            self._gate_failed)) for host_name, _ in self._next_hosts]
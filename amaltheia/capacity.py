@@ -0,0 +1,190 @@
+# Copyright (C) 2019  GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import amaltheia.log as log
+from amaltheia.ordering import (
+    find_hypervisor, nova_hypervisors, short_names)
+from amaltheia.strategy import ParallelStrategy
+from amaltheia.utils import bold, jinja, openstack_cmd_json
+
+# resource name -> (used, total) columns of "openstack hypervisor list --long"
+resources = {
+    'ram': ('Memory MB Used', 'Memory MB'),
+    'vcpus': ('vCPUs Used', 'vCPUs'),
+    'disk': ('Local GB Used', 'Local GB'),
+}
+
+
+def nova_zones():
+    """Returns dictionary of nova-compute host -> availability zone"""
+    services = openstack_cmd_json(
+        'openstack compute service list --service nova-compute -f json')
+
+    return {s['Host']: s['Zone'] for s in services}
+
+
+def hypervisor_stats(hypervisors, zones):
+    """Returns dictionary of hypervisor name -> {"zone": zone, "used": {},
+    "total": {}}, for the resources that hypervisors report"""
+    result = {}
+    for name, h in hypervisors.items():
+        zone = zones.get(name, zones.get(name.split('.')[0]))
+        stats = result[name] = {'zone': zone, 'used': {}, 'total': {}}
+        for resource, (used, total) in resources.items():
+            try:
+                stats['used'][resource] = float(h[used])
+                stats['total'][resource] = float(h[total])
+            except (KeyError, TypeError, ValueError):
+                pass
+
+    return result
+
+
+def check_capacity(stats, draining, headroom=0.2, ratios=None, min_up=0.0):
+    """Checks whether the hypervisors of @stats can be drained at the same
+    time. Instances of @draining hypervisors must fit in the rest of their
+    availability zone, leaving @headroom (fraction of capacity) free, and
+    at least @min_up (fraction of hypervisors) of each zone must not be
+    draining. @ratios are allocation ratios per resource. Returns None if
+    they can, otherwise the reason they cannot"""
+    ratios = ratios or {}
+
+    zones = {}
+    for name, h in stats.items():
+        zones.setdefault(h['zone'], []).append(name)
+
+    for zone in set(stats[name]['zone'] for name in draining):
+        members = zones[zone]
+        up = [name for name in members if name not in draining]
+        if len(up) < min_up * len(members):
+            return 'zone {}: {} of {} hypervisors up'.format(
+                zone, len(up), len(members))
+
+        for resource in resources:
+            if any(resource not in stats[name]['total'] for name in members):
+                continue
+
+            used = sum(stats[name]['used'][resource] for name in members)
+            total = sum(stats[name]['total'][resource] for name in up)
+            available = total * ratios.get(resource, 1.0) * (1 - headroom)
+            if used > available:
+                return 'zone {}: {} {:g} used, {:g} available'.format(
+                    zone, resource, used, available)
+
+    return None
+
+
+class CapacityStrategy(ParallelStrategy):
+    '''run updates on up to N hosts in parallel, as long as the instances
+    of all hosts in progress fit in the rest of their availability zone'''
+
+    # hosts are picked according to the hypervisor stats
+    streaming = False
+
+    @property
+    def name(self):
+        return 'Capacity-{}'.format(self.nparallel)
+
+    def __getstate__(self):
+        state = super(CapacityStrategy, self).__getstate__()
+        for key in ('_stats', '_queue', '_draining', '_hypervisors'):
+            state.pop(key, None)
+        return state
+
+    def hypervisor(self, host_name):
+        """Returns hypervisor name of @host_name, or None"""
+        return self._hypervisors.get(host_name)
+
+    def map_hypervisors(self):
+        """Finds the hypervisor name of each host, once for all hosts"""
+        names = {h: h for h in self._stats}
+        short = short_names(names)
+        fix_hostname = self.strategy_args.get('fix-hostname')
+
+        self._hypervisors = {}
+        for host_name, host_args in self.hosts.items():
+            name = host_name
+            if fix_hostname is not None:
+                name = jinja(fix_hostname, host=host_name, host_args=host_args)
+
+            self._hypervisors[host_name] = find_hypervisor(
+                names, name, short)
+
+    def refresh(self):
+        """Retrieves current hypervisor stats. If that fails, the last known
+        stats are kept. Without any, no more hosts are started, rather than
+        draining hypervisors without limits"""
+        previous = getattr(self, '_stats', None)
+        try:
+            self._stats = hypervisor_stats(nova_hypervisors(), nova_zones())
+        except Exception:
+            log.exception(bold('[amaltheia] Failed to retrieve hypervisor '
+                               'stats, {}'.format(
+                                   'no more hosts will be started'
+                                   if previous is None else
+                                   'using the last known ones')))
+            self._stats = previous
+            if previous is None:
+                return
+
+        if not hasattr(self, '_hypervisors') or (
+                set(self._stats) != set(previous or ())):
+            self.map_hypervisors()
+
+    def check(self, hypervisors):
+        return check_capacity(
+            self._stats, set(hypervisors),
+            headroom=float(self.strategy_args.get('headroom', 0.2)),
+            ratios=self.strategy_args.get('allocation-ratios'),
+            min_up=float(self.strategy_args.get('min-up', 0.0)))
+
+    def next_host(self):
+        if not hasattr(self, '_queue'):
+            self.refresh()
+            self._queue = list(self.hosts)
+            self._draining = {}
+
+        if self._stats is None:
+            return None
+
+        for host_name in self._queue:
+            hypervisor = self.hypervisor(host_name)
+            draining = list(self._draining.values())
+            if hypervisor is not None and self.check(
+                    draining + [hypervisor]) is not None:
+                continue
+
+            self._queue.remove(host_name)
+            if hypervisor is not None:
+                self._draining[host_name] = hypervisor
+
+            log.info('[amaltheia] Starting {}, draining: {}'.format(
+                host_name, ', '.join(sorted(self._draining.values()))))
+            return host_name, self.hosts[host_name]
+
+        return None
+
+    def host_done(self, result):
+        if self._draining.pop(result.host_name, None) is not None:
+            self.refresh()
+
+    def unscheduled(self):
+        if getattr(self, '_stats', None) is None:
+            return [(host_name, 'hypervisor stats unavailable')
+                    for host_name in getattr(self, '_queue', [])]
+
+        return [(host_name, 'insufficient capacity, {}'.format(
+            self.check([self.hypervisor(host_name)])))
+            for host_name in getattr(self, '_queue', [])]
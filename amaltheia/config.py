@@ -25,9 +25,22 @@ class Config:
         ssh_user=os.getenv('SSH_USER', 'ubuntu'),
         ssh_config_file=os.getenv('SSH_CONFIG_FILE', 'ssh_config'),
         ssh_strict_host_key_checking=False,
+        ssh_output_lines=1000,
+        ssh_output_dir=None,
+        ssh_jump_channels=10,
         log_level=logging.INFO,
+        log_json_file=None,
+        log_host_dir=None,
         color=True,
-        list_hosts=False
+        list_hosts=False,
+        discovery_cache_ttl=0,
+        limit=None,
+        shard=None,
+        shard_key=None,
+        state_file=None,
+        incremental=False,
+        incremental_keys=None,
+        history_db=None
     )
 
     variables = dict()
@@ -0,0 +1,288 @@
+# Copyright (C) 2019  GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import bisect
+
+import amaltheia.log as log
+from amaltheia.strategy import ParallelStrategy
+
+
+def _as_list(value):
+    """Returns @value as a list of strings"""
+    if value is None:
+        return []
+
+    if isinstance(value, (list, tuple, set)):
+        return [str(v) for v in value]
+
+    return [str(value)]
+
+
+class DagScheduler(object):
+    """Decides which hosts can start, respecting ordering constraints.
+
+    @hosts is a dictionary of host_name -> host_args. Each host belongs to
+    the groups listed in its @group_key host argument, and may declare:
+
+    - "after": list of groups or host names that must be finished first
+    - "exclusive-with": list of host names that must not run at the same time
+
+    @groups maps group names to {"max-parallel": N, "after": [...]}, and
+    @exclusive is a list of host lists, of which at most one host may be
+    running at any time. Hosts are started in inventory order, as soon as
+    all their constraints are satisfied.
+
+    Hosts whose dependencies are all finished are kept in a ready list, which
+    is updated by finish() using the number of unmet dependencies of each
+    host, so that next() does not need to check the dependencies again.
+
+    Raises ValueError for "after" targets that are neither hosts nor groups
+    (groups without hosts must be listed in @groups), and for dependency
+    cycles, before any host is started.
+    """
+
+    def __init__(self, hosts, group_key='group', groups=None, exclusive=None,
+                 skip_failed_dependencies=True):
+        self.groups = groups or {}
+        self.skip_failed_dependencies = skip_failed_dependencies
+
+        self.order = {host_name: i for i, host_name in enumerate(hosts)}
+        self.pending = set(hosts)
+        self.running = set()
+        self.done = set()
+        self.failed = set()
+        self.finished = set()
+
+        self.members = {}
+        self.host_groups = {}
+        for host_name, host_args in hosts.items():
+            self.host_groups[host_name] = _as_list(host_args.get(group_key))
+            for group in self.host_groups[host_name]:
+                self.members.setdefault(group, set()).add(host_name)
+
+        self.exclusive = {host_name: set() for host_name in hosts}
+        for hosts_list in exclusive or []:
+            hosts_list = [h for h in _as_list(hosts_list) if h in hosts]
+            for host_name in hosts_list:
+                self.exclusive[host_name].update(hosts_list)
+
+        for host_name, host_args in hosts.items():
+            for other in _as_list(host_args.get('exclusive-with')):
+                if other in hosts:
+                    self.exclusive[host_name].add(other)
+                    self.exclusive[other].add(host_name)
+
+        for host_name in hosts:
+            self.exclusive[host_name].discard(host_name)
+
+        self.depends = {}
+        for host_name, host_args in hosts.items():
+            targets = _as_list(host_args.get('after'))
+            for group in self.host_groups[host_name]:
+                targets.extend(_as_list(
+                    (self.groups.get(group) or {}).get('after')))
+
+            self.depends[host_name] = set()
+            for target in targets:
+                if target in hosts:
+                    self.depends[host_name].add(target)
+                elif target in self.members or target in self.groups:
+                    self.depends[host_name].update(
+                        self.members.get(target, ()))
+                else:
+                    raise ValueError(
+                        'host {} must run after unknown host or group '
+                        '{}'.format(host_name, target))
+
+            self.depends[host_name].discard(host_name)
+
+        self.dependents = {host_name: [] for host_name in hosts}
+        for host_name, depends in self.depends.items():
+            for target in depends:
+                self.dependents[target].append(host_name)
+
+        self.unmet = {host_name: len(self.depends[host_name])
+                      for host_name in hosts}
+        self.check_cycles()
+
+        # (inventory index, host name) of hosts with no unmet dependencies
+        self.ready = [(self.order[h], h) for h in hosts if not self.unmet[h]]
+
+        self.limits = {group: self.max_parallel(group)
+                       for group in self.members}
+        self.group_running = {group: 0 for group in self.members}
+
+    def check_cycles(self):
+        """Raises ValueError if some hosts depend on each other, and could
+        never start"""
+        unmet = dict(self.unmet)
+        ready = [h for h, count in unmet.items() if not count]
+        while ready:
+            for other in self.dependents[ready.pop()]:
+                unmet[other] -= 1
+                if not unmet[other]:
+                    ready.append(other)
+
+        # hosts left waiting are in a cycle, or after one, leave out the
+        # latter so that the error only mentions the cycle
+        stuck = set(h for h, count in unmet.items() if count)
+        while True:
+            after = [h for h in stuck if stuck.isdisjoint(self.dependents[h])]
+            if not after:
+                break
+            stuck.difference_update(after)
+
+        cycle = sorted(stuck, key=self.order.get)
+        if cycle:
+            raise ValueError('dependency cycle between hosts {}'.format(
+                ', '.join(cycle)))
+
+    def max_parallel(self, group):
+        """Returns concurrency limit for @group, or None"""
+        try:
+            return int((self.groups.get(group) or {})['max-parallel'])
+        except (KeyError, ValueError, TypeError):
+            return None
+
+    def blocked_by_failure(self, host_name):
+        """True if @host_name can never start, due to failed dependencies"""
+        return self.skip_failed_dependencies and bool(
+            self.depends[host_name] & self.failed)
+
+    def can_start(self, host_name):
+        """True if all constraints of @host_name are currently satisfied"""
+        if self.unmet[host_name]:
+            return False
+
+        if self.blocked_by_failure(host_name):
+            return False
+
+        return self.can_run(host_name)
+
+    def can_run(self, host_name):
+        """True if starting @host_name respects mutual exclusions and group
+        limits. Dependencies are not checked"""
+        if not self.exclusive[host_name].isdisjoint(self.running):
+            return False
+
+        for group in self.host_groups[host_name]:
+            limit = self.limits[group]
+            if limit is not None and self.group_running[group] >= limit:
+                return False
+
+        return True
+
+    def next(self):
+        """Returns next host that can start and marks it as running, or
+        None if no host can start right now"""
+        for i, (_, host_name) in enumerate(self.ready):
+            if self.can_run(host_name):
+                del self.ready[i]
+                self.pending.discard(host_name)
+                self.running.add(host_name)
+                for group in self.host_groups[host_name]:
+                    self.group_running[group] += 1
+
+                return host_name
+
+        return None
+
+    def finish(self, host_name, success):
+        """Marks @host_name as finished"""
+        if host_name in self.running:
+            self.running.discard(host_name)
+            for group in self.host_groups[host_name]:
+                self.group_running[group] -= 1
+
+        if success:
+            self.done.add(host_name)
+        else:
+            self.failed.add(host_name)
+
+        if host_name in self.finished:
+            return
+
+        self.finished.add(host_name)
+        for other in self.dependents[host_name]:
+            self.unmet[other] -= 1
+            if not self.unmet[other] and not self.blocked_by_failure(other):
+                bisect.insort(self.ready, (self.order[other], other))
+
+    def unscheduled(self):
+        """Returns list of (host_name, reason) for hosts still pending"""
+        result = []
+        for host_name in sorted(self.pending, key=self.order.get):
+            if self.blocked_by_failure(host_name):
+                reason = 'failed dependencies {}'.format(', '.join(sorted(
+                    self.depends[host_name] & self.failed)))
+            else:
+                reason = 'unsatisfiable dependencies {}'.format(
+                    ', '.join(sorted(self.depends[host_name] - self.done)))
+
+            result.append((host_name, reason))
+
+        return result
+
+
+class DagStrategy(ParallelStrategy):
+    '''run updates on up to N hosts in parallel, respecting dependencies,
+    group concurrency limits and mutual exclusions between hosts'''
+
+    # the complete inventory is needed to resolve dependencies
+    streaming = False
+
+    @property
+    def name(self):
+        return 'DAG-{}'.format(self.nparallel)
+
+    @property
+    def scheduler(self):
+        if not hasattr(self, '_scheduler'):
+            self._scheduler = DagScheduler(
+                self.hosts,
+                group_key=self.strategy_args.get('group-key', 'group'),
+                groups=self.strategy_args.get('groups'),
+                exclusive=self.strategy_args.get('exclusive'),
+                skip_failed_dependencies=self.strategy_args.get(
+                    'skip-failed-dependencies', True))
+
+            log.debug('[amaltheia] DAG dependencies: {}'.format(
+                self._scheduler.depends))
+
+        return self._scheduler
+
+    def __getstate__(self):
+        state = super(DagStrategy, self).__getstate__()
+        state.pop('_scheduler', None)
+        return state
+
+    def execute(self):
+        # dependency errors are reported before any host is touched
+        self.scheduler
+        super(DagStrategy, self).execute()
+
+    def next_host(self):
+        host_name = self.scheduler.next()
+        if host_name is None:
+            return None
+
+        return host_name, self.hosts[host_name]
+
+    def host_done(self, result):
+        self.scheduler.finish(
+            result.host_name, not result.exception and result.failed == 0)
+
+    def unscheduled(self):
+        return self.scheduler.unscheduled()
@@ -15,18 +15,36 @@
 
 import json
 import re
+import shutil
+import tempfile
+import time
 import urllib.request
+from collections import OrderedDict
+from copy import deepcopy
 
 import amaltheia.log as log
-from amaltheia.utils import GET, jinja, str_or_dict, _HTTP
+from amaltheia.config import config
+from amaltheia.jsonstream import iter_items
+from amaltheia.registry import Registry
+from amaltheia.selector import Selector, select_hosts
+from amaltheia.shard import shard_hosts
+from amaltheia.utils import GET, jinja, jinja_variables, str_or_dict, _HTTP
 
 
 class Discoverer(object):
     """Base class for discoverers. automatically retrieve hosts from
-    a service"""
+    a service. Discoverers implement either discover() or iter_hosts()"""
 
     def __init__(self, discover_args):
         self.args = discover_args
+        self.selector = Selector(self.args.get('select'))
+
+    def selected(self, host_name, host_args, **fields):
+        """Returns True if the host matches the "select" argument, see
+        amaltheia.selector. @fields are the data of the host returned by
+        the API, e.g. "host" for NetBox"""
+        return not self.selector or self.selector(
+            host_name, host_args, **fields)
 
     def discover(self):
         """discoveres should implement this function to return a host
@@ -35,7 +53,14 @@ class Discoverer(object):
             "hostname_1": {**host1_args},
             "hostname_2": {**host2_args}
         }"""
-        raise NotImplementedError
+        return dict(self.iter_hosts())
+
+    def iter_hosts(self):
+        """discoverers that retrieve hosts in multiple steps (e.g. paginated
+        APIs) should implement this to yield (host_name, host_args) tuples
+        as soon as they are available, so that strategies can start working
+        on the first hosts while the rest are still being discovered"""
+        return iter(self.discover().items())
 
 
 class StaticDiscoverer(Discoverer):
@@ -45,14 +70,11 @@ class StaticDiscoverer(Discoverer):
             raise ValueError('static discoverer expects list of hosts')
 
         self.args = discover_args
+        self.selector = Selector(None)
 
-    def discover(self):
-        result = {}
+    def iter_hosts(self):
         for host in self.args:
-            host_name, host_args = str_or_dict(jinja(host))
-            result[host_name] = host_args
-
-        return result
+            yield str_or_dict(jinja(host))
 
 
 class NetBoxDiscoverer(Discoverer):
@@ -67,23 +89,24 @@ class NetBoxDiscoverer(Discoverer):
 
         self.host_name = self.args['host-name']
         self.netbox_url = jinja(self.args['netbox-url'])
-        self.filter_name = jinja(self.args.get('filter-name', '.*'))
+        self.filter_name = name_filter(
+            'host.name', self.args.get('filter-name'))
 
-    def discover(self):
-        api_result = json.loads(GET(self.netbox_url))
+    def iter_hosts(self):
+        api_result = {'next': self.netbox_url}
+        while api_result.get('next'):
+            api_result = json.loads(GET(api_result['next']))
 
-        hosts = {}
-        for host in api_result.get('results', []):
+            for host in api_result.get('results', []):
+                if self.filter_name and not self.filter_name(None, host=host):
+                    continue
 
-            if not re.match(self.filter_name, host['name']):
-                continue
+                host_name = jinja(self.host_name, host=host)
+                host_args = jinja(
+                    self.args.get('host-args') or {}, host=host)
 
-            host_name = jinja(self.host_name, host=host)
-            host_args = jinja(self.args.get('host-args') or {}, host=host)
-
-            hosts[host_name] = host_args
-
-        return hosts
+                if self.selected(host_name, host_args, host=host):
+                    yield host_name, host_args
 
 
 class PatchmanDiscoverer(Discoverer):
@@ -98,45 +121,55 @@ class PatchmanDiscoverer(Discoverer):
 
         self.patchman_url = self.args['patchman-url']
         self.host_name = self.args['host-name']
-        self.filter_name = jinja(self.args.get('filter-name', '.*')) or ''
+        self.filter_name = name_filter(
+            'host.hostname', self.args.get('filter-name'))
         self.skip_ok = self.args.get('skip-ok', False)
 
-    def discover(self):
-        results = []
+    def iter_hosts(self):
         response = {'next': self.patchman_url}
         while response['next']:
             response = json.loads(GET(response['next']))
-            results.extend(response['results'])
 
-        hosts = {}
-        for host in results:
-            if not re.match(self.filter_name, host['hostname']):
-                continue
+            for host in response['results']:
+                result = self.parse_host(host)
+                if result is not None:
+                    yield result
 
-            host_name = jinja(self.host_name, host=host)
-            host_args = jinja(self.args.get('host-args') or {}, host=host)
+    def parse_host(self, host):
+        """Returns (host_name, host_args) for Patchman @host, or None if
+        host should be skipped"""
+        if self.filter_name and not self.filter_name(None, host=host):
+            return None
 
-            if host['updates'] and self.args.get('on-package-updates'):
-                host_args.setdefault('updates', [])
-                host_args['updates'].extend(
-                    self.args.get('on-package-updates'))
+        host_name = jinja(self.host_name, host=host)
+        host_args = jinja(self.args.get('host-args') or {}, host=host)
 
-            if host['reboot_required'] and self.args.get('on-reboot-required'):
-                host_args.setdefault('updates', [])
-                host_args['updates'].extend(
-                    self.args.get('on-reboot-required'))
+        if host['updates'] and self.args.get('on-package-updates'):
+            host_args.setdefault('updates', [])
+            host_args['updates'].extend(
+                self.args.get('on-package-updates'))
 
-            # skip hosts with no actionable items
-            if not host_args and self.skip_ok:
-                continue
+        if host['reboot_required'] and self.args.get('on-reboot-required'):
+            host_args.setdefault('updates', [])
+            host_args['updates'].extend(
+                self.args.get('on-reboot-required'))
 
-            hosts[host_name] = host_args
+        # skip hosts with no actionable items
+        if not host_args and self.skip_ok:
+            return None
 
-        return hosts
+        if not self.selected(host_name, host_args, host=host):
+            return None
+
+        return host_name, host_args
 
 
 class HttpDiscoverer(Discoverer):
     """Discover hosts from an HTTP API"""
+
+    # responses larger than this are kept in a temporary file, see download()
+    spool_size = 16 * 1024 * 1024
+
     def __init__(self, discover_args):
         super(HttpDiscoverer, self).__init__(discover_args)
         if 'request' not in self.args:
@@ -145,7 +178,7 @@ class HttpDiscoverer(Discoverer):
         if 'url' not in self.args['request']:
             raise ValueError('missing "request.url" for HTTP discoverer')
 
-        if 'results' not in self.args:
+        if 'results' not in self.args and 'stream' not in self.args:
             raise ValueError('missing "results" for HTTP discoverer')
 
         if 'parse' not in self.args:
@@ -157,60 +190,192 @@ class HttpDiscoverer(Discoverer):
         self.request_params = self.args.get('request', {})
         self.request = _HTTP(self.request_params)
 
-        self.results_template = self.args['results']
+        self.results_template = self.args.get('results')
+        self.stream = self.args.get('stream')
         self.host_name_template = self.args['parse']['host-name']
         self.host_args_template = self.args['parse']['host-args']
 
-        self.match_filters = self.args.get('match', [])
-
-    def discover(self):
-        response = json.loads(urllib.request.urlopen(self.request).read())
+        # regular expressions that do not use the item are compiled once,
+        # the rest are rendered for each item
+        self.match_filters = []
+        for m in self.args.get('match') or []:
+            regex = m['regex']
+            if 'item' not in jinja_variables(regex):
+                regex = re.compile(str(jinja(regex))).search
+
+            self.match_filters.append((regex, m['value']))
+
+    def matches(self, item):
+        """Returns True if @item matches all "match" filters"""
+        for regex, value in self.match_filters:
+            search = regex
+            if not callable(search):
+                search = re.compile(str(jinja(regex, item=item))).search
+
+            if not search(str(jinja(value, item=item))):
+                return False
+
+        return True
+
+    def iter_results(self, response):
+        """Yields items of the results of HTTP @response. With "stream",
+        items are decoded one at a time instead of loading the whole
+        response in memory"""
+        if self.stream is not None:
+            yield from iter_items(response, str(self.stream))
+            return
+
+        response = json.loads(response.read())
         results = jinja(self.results_template, _env=None, response=response)
 
         if isinstance(results, dict):
             results = [{'key': k, 'value': v} for k, v in results.items()]
 
-        hosts = {}
-        for item in results:
-            if any(not re.search(str(m['regex']), str(m['value']))
-                   for m in jinja(self.match_filters, _env=None, item=item)):
-                continue
+        yield from results
 
-            host_name = str(
-                jinja(self.host_name_template, _env=None, item=item))
-            host_args = jinja(self.host_args_template, _env=None, item=item)
+    def download(self):
+        """Returns file-like object with the whole response. Hosts may be
+        processed while they are discovered, so the connection is closed
+        before the first one is yielded, instead of staying idle until the
+        server times out. Large responses are spooled to disk"""
+        spool = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        with urllib.request.urlopen(self.request) as response:
+            shutil.copyfileobj(response, spool)
 
-            hosts[host_name] = host_args
+        spool.seek(0)
+        return spool
+
+    def iter_hosts(self):
+        with self.download() as response:
+            for item in self.iter_results(response):
+                if not self.matches(item):
+                    continue
+
+                host_name = str(
+                    jinja(self.host_name_template, _env=None, item=item))
+                host_args = jinja(
+                    self.host_args_template, _env=None, item=item)
+
+                if self.selected(host_name, host_args, item=item):
+                    yield host_name, host_args
+
+
+def name_filter(field, regex):
+    """Returns Selector for the "filter-name" argument of discoverers,
+    matching @field against regular expression @regex, or None"""
+    if not regex:
+        return None
 
-        return hosts
+    return Selector(['{}~{}'.format(field, jinja(regex))])
 
 
-discoverers = {
+discoverers = Registry('amaltheia.discoverers', {
     'http': HttpDiscoverer,
     'static': StaticDiscoverer,
     'netbox': NetBoxDiscoverer,
     'patchman': PatchmanDiscoverer
-}
+})
 
 
-def discover(job):
-    """Parses job configuration and returns list of found hosts"""
-    hosts = {}
+# discoverer configuration -> (time, list of hosts), see _host_iterators()
+_cache = {}
+
+
+def _caching(key, items):
+    """Yields @items, and caches them once all of them are found"""
+    found = []
+    for item in items:
+        found.append(item)
+        yield item
 
+    _cache[key] = (time.monotonic(), deepcopy(found))
+
+
+def _host_iterators(job):
+    """Yields an iterator of (host_name, host_args) for each discoverer of
+    the hosts section of @job. With the "discovery-cache-ttl" option, hosts
+    are kept in memory and reused by later jobs of the same process, see
+    "amaltheia serve" """
+    ttl = config.discovery_cache_ttl
     for disc in job.get('hosts', []):
         disc_name, disc_args = str_or_dict(disc)
 
+        key = json.dumps([disc, config.variables], sort_keys=True, default=str)
+        cached = _cache.get(key)
+        if ttl and cached is not None and (
+                time.monotonic() - cached[0] < float(ttl)):
+            log.debug('[amaltheia] Using cached hosts of {}'.format(
+                disc_name))
+            yield iter(deepcopy(cached[1]))
+            continue
+
         Discoverer = discoverers.get(disc_name)
         if Discoverer is None:
             log.fatal('[amaltheia] Unknown host discoverer {}'.format(
                 disc_name))
             continue
 
-        hosts.update(Discoverer(disc_args).discover())
+        items = Discoverer(disc_args).iter_hosts()
+        yield _caching(key, items) if ttl else items
+
+
+def discover(job):
+    """Parses job configuration and returns OrderedDict of found hosts"""
+    hosts = OrderedDict()
+
+    for items in _host_iterators(job):
+        for host_name, host_args in items:
+            if host_name in hosts:
+                log.warning('[amaltheia] Host {} found more than once, '
+                            'using the last one'.format(host_name))
+
+            hosts[host_name] = host_args
+
+    if config.limit:
+        total = len(hosts)
+        hosts = OrderedDict(select_hosts(hosts.items(), config.limit))
+        log.info('[amaltheia] Limit {}: {} of {} hosts'.format(
+            config.limit, len(hosts), total))
+
+    if config.shard:
+        total = len(hosts)
+        hosts = OrderedDict(shard_hosts(
+            hosts.items(), config.shard, config.shard_key))
+        log.info('[amaltheia] Shard {}: {} of {} hosts'.format(
+            config.shard, len(hosts), total))
 
     return hosts
 
 
+def iter_discover(job):
+    """Parses job configuration and returns iterator of (host_name,
+    host_args) for each host, as soon as it is discovered. Hosts that are
+    found more than once are only yielded the first time, since they may
+    already be processed. Unlike discover(), which keeps the last one"""
+    items = _iter_unique(job)
+    if config.limit:
+        items = select_hosts(items, config.limit)
+    if config.shard:
+        items = shard_hosts(items, config.shard, config.shard_key)
+
+    return items
+
+
+def _iter_unique(job):
+    seen = set()
+
+    for items in _host_iterators(job):
+        for host_name, host_args in items:
+            if host_name in seen:
+                log.warning('[amaltheia] Host {} found more than once, '
+                            'using the first one'.format(host_name))
+                continue
+
+            seen.add(host_name)
+            yield host_name, host_args
+
+
 __all__ = [
-    discover
+    discover,
+    iter_discover,
 ]
@@ -0,0 +1,419 @@
+# Copyright (C) 2019  GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# The "distributed" strategy is the coordinator: it enqueues hosts in a shared
+# SQLite queue as they are discovered, and collects their results. Workers
+# ("amaltheia worker"), possibly on other machines, claim hosts from the queue
+# and process them. Claims are leases that workers renew while working on a
+# host, so that hosts of workers that died are picked up again.
+
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+from argparse import ArgumentParser
+from contextlib import contextmanager
+
+import amaltheia.log as log
+from amaltheia.amaltheia import parse_pairs
+from amaltheia.config import config
+from amaltheia.results import HostResult
+from amaltheia.strategy import SerialStrategy, Strategy
+from amaltheia.utils import bold
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    definition TEXT NOT NULL,
+    max_attempts INTEGER NOT NULL DEFAULT 3,
+    running INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS hosts (
+    job INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    host_name TEXT NOT NULL,
+    host_args TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    PRIMARY KEY (job, host_name)
+);
+'''
+
+
+class WorkQueue(object):
+    """Queue of hosts in SQLite database @path. Hosts are "pending",
+    "claimed" by a worker until their lease expires, or "done" """
+
+    def __init__(self, path, lease=300):
+        self.path = path
+        self.lease = float(lease)
+
+        db = sqlite3.connect(self.path, timeout=60)
+        try:
+            db.executescript(SCHEMA)
+        finally:
+            db.close()
+
+    @contextmanager
+    def db(self):
+        """Yields a connection in a transaction, that is committed at the
+        end of the block. Connections are not shared between threads or
+        processes"""
+        db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+
+            db.execute('COMMIT')
+        finally:
+            db.close()
+
+    def create_job(self, definition, max_attempts=3):
+        """Adds job with dictionary @definition ("services", "updates",
+        "strategy_args", "variables", "config"). Hosts are claimed up to
+        @max_attempts times. Returns the job id"""
+        with self.db() as db:
+            return db.execute(
+                'INSERT INTO jobs (definition, max_attempts) VALUES (?, ?)',
+                (json.dumps(definition), max_attempts)).lastrowid
+
+    def job(self, job_id):
+        with self.db() as db:
+            row = db.execute('SELECT definition FROM jobs WHERE id = ?', (
+                job_id, )).fetchone()
+
+        return json.loads(row[0]) if row else None
+
+    def finish_job(self, job_id):
+        """Workers stop claiming hosts of @job_id"""
+        with self.db() as db:
+            db.execute('UPDATE jobs SET running = 0 WHERE id = ?', (job_id, ))
+
+    def enqueue(self, job_id, host_name, host_args):
+        with self.db() as db:
+            position = db.execute(
+                'SELECT COUNT(*) FROM hosts WHERE job = ?', (
+                    job_id, )).fetchone()[0]
+            db.execute(
+                'INSERT OR IGNORE INTO hosts (job, position, host_name, '
+                'host_args) VALUES (?, ?, ?, ?)',
+                (job_id, position, host_name, json.dumps(host_args)))
+
+    def claim(self, worker):
+        """Claims the next pending host of any running job, or a host whose
+        lease expired, for @worker. Returns (job_id, host_name, host_args)
+        or None"""
+        now = time.time()
+        with self.db() as db:
+            row = db.execute(
+                'SELECT h.job, h.host_name, h.host_args FROM hosts h '
+                'JOIN jobs j ON j.id = h.job WHERE j.running AND ('
+                "h.state = 'pending' OR (h.state = 'claimed' AND "
+                'h.lease_until < ? AND h.attempts < j.max_attempts)) '
+                'ORDER BY h.job, h.position LIMIT 1', (now, )).fetchone()
+            if row is None:
+                return None
+
+            db.execute(
+                "UPDATE hosts SET state = 'claimed', worker = ?, "
+                'lease_until = ?, attempts = attempts + 1 '
+                'WHERE job = ? AND host_name = ?',
+                (worker, now + self.lease, row[0], row[1]))
+
+        return row[0], row[1], json.loads(row[2])
+
+    def renew(self, job_id, host_name, worker):
+        """Extends the lease of @worker on a host. Returns False if the host
+        is no longer claimed by @worker"""
+        with self.db() as db:
+            return db.execute(
+                'UPDATE hosts SET lease_until = ? WHERE job = ? AND '
+                "host_name = ? AND state = 'claimed' AND worker = ?",
+                (time.time() + self.lease, job_id, host_name, worker),
+            ).rowcount > 0
+
+    def complete(self, job_id, host_name, worker, result):
+        """Stores HostResult @result. If a host was processed more than
+        once (e.g. a slow worker lost its lease), the first result wins"""
+        with self.db() as db:
+            db.execute(
+                "UPDATE hosts SET state = 'done', worker = ?, result = ? "
+                "WHERE job = ? AND host_name = ? AND state != 'done'",
+                (worker, json.dumps(result.compact()), job_id, host_name))
+
+    def expire(self, job_id, max_attempts=3):
+        """Marks hosts of @job_id that were claimed @max_attempts times, and
+        whose last lease expired, as failed. Returns their names"""
+        now = time.time()
+        with self.db() as db:
+            names = [row[0] for row in db.execute(
+                'SELECT host_name FROM hosts WHERE job = ? AND '
+                "state = 'claimed' AND lease_until < ? AND attempts >= ?",
+                (job_id, now, max_attempts))]
+            for host_name in names:
+                result = HostResult(host_name=host_name, failed=1,
+                                    lease_expired=max_attempts)
+                db.execute(
+                    "UPDATE hosts SET state = 'done', result = ? "
+                    'WHERE job = ? AND host_name = ?',
+                    (json.dumps(result.compact()), job_id, host_name))
+
+        return names
+
+    def results(self, job_id, known=()):
+        """Returns list of HostResult of hosts of @job_id that are done,
+        except for host names in @known"""
+        with self.db() as db:
+            rows = db.execute(
+                'SELECT host_name, result FROM hosts WHERE job = ? AND '
+                "state = 'done' ORDER BY position", (job_id, )).fetchall()
+
+        return [HostResult.from_compact(json.loads(result))
+                for host_name, result in rows if host_name not in known]
+
+    def remaining(self, job_id):
+        with self.db() as db:
+            return db.execute(
+                'SELECT COUNT(*) FROM hosts WHERE job = ? AND '
+                "state != 'done'", (job_id, )).fetchone()[0]
+
+
+class DistributedStrategy(Strategy):
+    '''enqueue hosts for "amaltheia worker" processes, possibly on other
+    machines, and wait for their results'''
+
+    streaming = True
+
+    @property
+    def name(self):
+        return 'Distributed'
+
+    def execute(self):
+        args = self.strategy_args
+        if not args.get('queue'):
+            log.fatal('[amaltheia] Missing "queue" for distributed strategy')
+            return
+
+        q = WorkQueue(args['queue'])
+        max_attempts = int(args.get('max-attempts', 3))
+        interval = float(args.get('poll-interval', 2))
+
+        job_id = q.create_job({
+            'services': self.services,
+            'updates': self.updates,
+            'strategy_args': args,
+            'variables': config.variables,
+            'config': self.job_config,
+        }, max_attempts)
+        log.info('[amaltheia] Queued job {} in {}'.format(
+            job_id, args['queue']))
+
+        try:
+            for host_name, host_args in self.iter_hosts():
+                q.enqueue(job_id, host_name, host_args)
+
+            known = set()
+            while True:
+                for host_name in q.expire(job_id, max_attempts):
+                    log.fatal(bold('[{}] [amaltheia] Lease expired {} '
+                                   'times, giving up'.format(
+                                       host_name, max_attempts)))
+
+                # hosts may finish while results are read, check first
+                finished = q.remaining(job_id) == 0
+                for result in q.results(job_id, known):
+                    known.add(result.host_name)
+                    self.results.append(result)
+                    log.info('[{}] [amaltheia] Finished by worker'.format(
+                        result.host_name))
+
+                if finished:
+                    break
+
+                time.sleep(interval)
+        finally:
+            q.finish_job(job_id)
+
+
+class LeaseLost(Exception):
+    """The lease of a worker on a host expired, and the host may already
+    be processed by another worker"""
+
+
+class WorkerStrategy(SerialStrategy):
+    """Processes a single host claimed by a worker. Stops before the next
+    step once @lost is set"""
+
+    def __init__(self, *args, **kwargs):
+        super(WorkerStrategy, self).__init__(*args, **kwargs)
+        self.lost = threading.Event()
+
+    def checkpoint(self, host_name):
+        if self.lost.is_set():
+            raise LeaseLost()
+
+
+def worker_name():
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+def apply_config(job, defaults, overrides):
+    """Sets configuration options for @job: the @defaults of the worker,
+    then the "config" block of the job, then the worker @overrides"""
+    config._entries.clear()
+    config._entries.update(defaults)
+    config.load(job.get('config') or {})
+    config.load(overrides)
+    config.variables = job.get('variables') or {}
+
+
+def process_host(q, job_id, job, host_name, host_args, worker):
+    """Processes a claimed host, renewing its lease in the background.
+    Returns the HostResult, or None if the lease was lost"""
+    done = threading.Event()
+    strategy = WorkerStrategy(
+        {host_name: host_args}, job['services'], job['updates'],
+        job['strategy_args'])
+
+    def heartbeat():
+        while not done.wait(q.lease / 3):
+            if not q.renew(job_id, host_name, worker):
+                strategy.lost.set()
+                return
+
+    thread = threading.Thread(target=heartbeat, daemon=True)
+    thread.start()
+
+    try:
+        return strategy.do_host(host_name, host_args)
+    except LeaseLost:
+        # another worker may be working on the host, do not touch it again,
+        # not even to restore its services
+        log.fatal(bold('[{}] [amaltheia] Lost lease, stopping without '
+                       'restoring services'.format(host_name)))
+        return None
+    except Exception:
+        log.exception(bold(
+            '[{}] [amaltheia] An unhandled exception occured'.format(
+                host_name)))
+
+        return HostResult(host_name=host_name, exception=True)
+    finally:
+        done.set()
+        thread.join()
+        log.set_host(None)
+
+
+def run_worker(path, lease=300, interval=2, exit_when_idle=False,
+               overrides=None):
+    """Claims and processes hosts from the queue in @path, until there are
+    no more hosts if @exit_when_idle is set, otherwise forever. Dictionary
+    @overrides has configuration options of the worker, which take
+    precedence over the "config" block of jobs"""
+    q = WorkQueue(path, lease=lease)
+    worker = worker_name()
+    jobs = {}
+    overrides = overrides or {}
+    defaults = dict(config._entries)
+
+    while True:
+        item = q.claim(worker)
+        if item is None:
+            if exit_when_idle:
+                return
+
+            time.sleep(interval)
+            continue
+
+        job_id, host_name, host_args = item
+        if job_id not in jobs:
+            jobs[job_id] = q.job(job_id)
+
+        log.info('[{}] [amaltheia] Claimed by {} (job {})'.format(
+            host_name, worker, job_id))
+        apply_config(jobs[job_id], defaults, overrides)
+        result = process_host(
+            q, job_id, jobs[job_id], host_name, host_args, worker)
+        if result is not None:
+            q.complete(job_id, host_name, worker, result)
+
+
+def main(argv):
+    parser = ArgumentParser(
+        prog='amaltheia worker',
+        description='Process hosts of jobs of the "distributed" strategy')
+
+    parser.add_argument('-q',
+                        '--queue',
+                        required=True,
+                        help='Path to the SQLite queue database')
+    parser.add_argument('-p',
+                        '--processes',
+                        type=int,
+                        default=1,
+                        help='Number of hosts to process in parallel')
+    parser.add_argument('-c',
+                        '--config',
+                        nargs='*',
+                        required=False,
+                        default=[],
+                        help='"key=value" pairs for configuration options')
+    parser.add_argument('--lease',
+                        type=float,
+                        default=300,
+                        help='Seconds before hosts of a dead worker are '
+                             'picked up again')
+    parser.add_argument('--poll-interval',
+                        type=float,
+                        default=2,
+                        help='Seconds to wait when there are no hosts')
+    parser.add_argument('--exit-when-idle',
+                        action='store_true',
+                        help='Exit when there are no more hosts to claim')
+
+    args = parser.parse_args(argv)
+
+    overrides = dict(parse_pairs(args.config, 'option'))
+    config.load(overrides)
+    log.setup(level=config.log_level,
+              json_file=config.log_json_file,
+              host_dir=config.log_host_dir)
+
+    kwargs = dict(lease=args.lease, interval=args.poll_interval,
+                  exit_when_idle=args.exit_when_idle, overrides=overrides)
+    try:
+        processes = [
+            multiprocessing.Process(
+                target=run_worker, args=(args.queue, ), kwargs=kwargs)
+            for _ in range(max(1, args.processes))]
+
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log.shutdown()
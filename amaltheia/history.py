@@ -0,0 +1,276 @@
+# Copyright (C) 2019  GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import sqlite3
+from argparse import ArgumentParser
+from datetime import datetime
+
+from amaltheia.results import percentile, status
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started REAL NOT NULL,
+    finished REAL NOT NULL,
+    strategy TEXT,
+    ok INTEGER NOT NULL,
+    error INTEGER NOT NULL,
+    skipped INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS hosts (
+    run INTEGER NOT NULL,
+    host_name TEXT NOT NULL,
+    status TEXT NOT NULL,
+    duration REAL,
+    result TEXT
+);
+CREATE TABLE IF NOT EXISTS phases (
+    run INTEGER NOT NULL,
+    host_name TEXT NOT NULL,
+    phase TEXT NOT NULL,
+    duration REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS steps (
+    run INTEGER NOT NULL,
+    host_name TEXT NOT NULL,
+    phase TEXT NOT NULL,
+    name TEXT NOT NULL,
+    duration REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS hosts_host_name ON hosts (host_name);
+CREATE INDEX IF NOT EXISTS phases_host_name ON phases (host_name, phase);
+'''
+
+
+def host_duration(result):
+    """Returns total duration of all phases of HostResult @result, or None
+    if it was not processed"""
+    durations = getattr(result, 'durations', None)
+    if not durations:
+        return None
+
+    return sum(durations.values())
+
+
+class History(object):
+    """Results and durations of past runs, in SQLite database @path"""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def record(self, started, finished, strategy, results):
+        """Appends a run, with list of HostResult @results. Returns the id
+        of the run"""
+        counts = {'ok': 0, 'error': 0, 'skipped': 0}
+        for result in results:
+            counts[status(result)] += 1
+
+        with self.db:
+            run = self.db.execute(
+                'INSERT INTO runs (started, finished, strategy, ok, error, '
+                'skipped) VALUES (?, ?, ?, ?, ?, ?)',
+                (started, finished, strategy, counts['ok'], counts['error'],
+                 counts['skipped'])).lastrowid
+
+            for r in results:
+                self.db.execute(
+                    'INSERT INTO hosts (run, host_name, status, duration, '
+                    'result) VALUES (?, ?, ?, ?, ?)',
+                    (run, r.host_name, status(r), host_duration(r),
+                     json.dumps(r.compact(), default=str)))
+
+                self.db.executemany(
+                    'INSERT INTO phases (run, host_name, phase, duration) '
+                    'VALUES (?, ?, ?, ?)', [
+                        (run, r.host_name, phase, duration) for phase, duration
+                        in (getattr(r, 'durations', None) or {}).items()])
+
+                self.db.executemany(
+                    'INSERT INTO steps (run, host_name, phase, name, '
+                    'duration) VALUES (?, ?, ?, ?, ?)', [
+                        (run, r.host_name, phase, name, duration)
+                        for phase, name, duration in getattr(r, 'steps', [])])
+
+        return run
+
+    def durations(self, phase=None, runs=20):
+        """Returns dictionary of host name -> list of durations of @phase
+        (or of the whole host), in the last @runs runs where it was
+        processed"""
+        if phase is None:
+            rows = self.db.execute(
+                'SELECT host_name, duration FROM hosts WHERE duration IS '
+                'NOT NULL ORDER BY run DESC')
+        else:
+            rows = self.db.execute(
+                'SELECT host_name, duration FROM phases WHERE phase = ? '
+                'ORDER BY run DESC', (phase, ))
+
+        result = {}
+        for host_name, duration in rows:
+            values = result.setdefault(host_name, [])
+            if len(values) < runs:
+                values.append(duration)
+
+        return result
+
+    def expected(self, p=50, phase=None, runs=20):
+        """Returns dictionary of host name -> @p-th percentile of its past
+        durations"""
+        return {host_name: percentile(values, p) for host_name, values in
+                self.durations(phase, runs).items()}
+
+    def host_stats(self, phase=None, runs=20):
+        """Returns list of (host_name, count, p50, p95), slowest first"""
+        result = [
+            (host_name, len(values), percentile(values, 50),
+             percentile(values, 95))
+            for host_name, values in self.durations(phase, runs).items()]
+
+        return sorted(result, key=lambda row: -row[3])
+
+    def step_stats(self, phase=None):
+        """Returns list of (phase, name, count, p50, p95, max) for each
+        service and update action, slowest first"""
+        query = 'SELECT phase, name, duration FROM steps'
+        params = ()
+        if phase is not None:
+            query += ' WHERE phase = ?'
+            params = (phase, )
+
+        steps = {}
+        for step_phase, name, duration in self.db.execute(query, params):
+            steps.setdefault((step_phase, name), []).append(duration)
+
+        result = [
+            key + (len(values), percentile(values, 50),
+                   percentile(values, 95), max(values))
+            for key, values in steps.items()]
+
+        return sorted(result, key=lambda row: -row[4])
+
+    def trend(self, limit=20):
+        """Returns list of (run, started, strategy, ok, error, skipped,
+        wall time, p50 of host durations) for the last @limit runs"""
+        runs = self.db.execute(
+            'SELECT id, started, finished, strategy, ok, error, skipped '
+            'FROM runs ORDER BY id DESC LIMIT ?', (limit, )).fetchall()
+
+        result = []
+        for run, started, finished, strategy, ok, error, skipped in reversed(
+                runs):
+            durations = [row[0] for row in self.db.execute(
+                'SELECT duration FROM hosts WHERE run = ? AND duration IS '
+                'NOT NULL', (run, ))]
+            result.append((run, started, strategy, ok, error, skipped,
+                           finished - started, percentile(durations, 50)))
+
+        return result
+
+
+def estimate_remaining(remaining, expected, finished, concurrency):
+    """Returns estimated seconds until hosts @remaining are done, working
+    on @concurrency hosts at a time. Durations come from dictionary
+    @expected (e.g. History.expected()) or, for hosts without history, the
+    median of durations of @finished hosts. Returns None if there is
+    nothing to estimate from"""
+    fallback = percentile(finished, 50)
+    if fallback is None:
+        fallback = percentile(list(expected.values()), 50)
+    if fallback is None:
+        return None
+
+    total = sum(expected.get(host_name, fallback) for host_name in remaining)
+    return total / max(1, concurrency)
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return '-'
+
+    if seconds < 60:
+        return '{:.1f}s'.format(seconds)
+
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '{}h{:02d}m'.format(hours, minutes)
+    return '{}m{:02d}s'.format(minutes, seconds)
+
+
+def print_table(header, rows):
+    rows = [header] + [[str(x) for x in row] for row in rows]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    for row in rows:
+        print('  '.join(x.ljust(w) for x, w in zip(row, widths)).rstrip())
+
+
+def main(argv):
+    parser = ArgumentParser(
+        prog='amaltheia history',
+        description='Query durations and results of past runs')
+
+    parser.add_argument('-d',
+                        '--db',
+                        required=True,
+                        help='Path to the history database, see the '
+                             '"history-db" configuration option')
+    parser.add_argument('query',
+                        choices=['hosts', 'steps', 'trend'],
+                        help='"hosts": p50/p95 duration per host, "steps": '
+                             'slowest services and update actions, '
+                             '"trend": results and durations of each run')
+    parser.add_argument('-p',
+                        '--phase',
+                        choices=['evacuate', 'update', 'restore'],
+                        help='Only show durations of this phase')
+    parser.add_argument('-n',
+                        '--limit',
+                        type=int,
+                        default=20,
+                        help='Number of runs (or rows) to show')
+
+    args = parser.parse_args(argv)
+    history = History(args.db)
+
+    if args.query == 'hosts':
+        print_table(['HOST', 'RUNS', 'P50', 'P95'], [
+            (host_name, count, format_duration(p50), format_duration(p95))
+            for host_name, count, p50, p95 in history.host_stats(
+                args.phase, args.limit)])
+
+    elif args.query == 'steps':
+        print_table(['PHASE', 'NAME', 'COUNT', 'P50', 'P95', 'MAX'], [
+            (phase, name, count, format_duration(p50), format_duration(p95),
+             format_duration(slowest))
+            for phase, name, count, p50, p95, slowest in history.step_stats(
+                args.phase)][:args.limit])
+
+    elif args.query == 'trend':
+        print_table(
+            ['RUN', 'STARTED', 'STRATEGY', 'OK', 'ERROR', 'SKIPPED', 'TIME',
+             'HOST P50'], [
+                (run, datetime.fromtimestamp(started).strftime(
+                    '%Y-%m-%d %H:%M'), strategy, ok, error, skipped,
+                 format_duration(wall), format_duration(p50))
+                for run, started, strategy, ok, error, skipped, wall, p50
+                in history.trend(args.limit)])
+
+    history.close()
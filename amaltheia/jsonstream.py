@@ -0,0 +1,182 @@
+# Copyright (C) 2019  GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Incremental decoding of large JSON documents. Only the items of a single
+# array (or object) are decoded, one at a time, and everything before them is
+# skipped without building any objects. Memory usage depends on the size of
+# the largest item, not on the size of the document.
+
+import codecs
+import json
+import re
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_SPECIAL = re.compile(r'[\[\]{}"]')
+_STRING_END = re.compile(r'(?:[^"\\]|\\.)*"', re.S)
+_NUMBER_START = '-0123456789'
+_NUMBER_CHARS = '.eE+-0123456789'
+
+_decoder = json.JSONDecoder()
+
+
+class _Reader(object):
+    """Buffer over file-like object @fp, that is read in chunks of
+    @chunk_size bytes. Data before the current position is dropped"""
+
+    def __init__(self, fp, chunk_size):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def read(self, size=None):
+        """Appends the next @size bytes to the buffer. Returns False at the
+        end of the input"""
+        if self.eof:
+            return False
+
+        data = self.fp.read(size or self.chunk_size)
+        self.eof = not data
+        self.buffer = self.buffer[self.pos:] + self.decoder.decode(
+            data, final=self.eof)
+        self.pos = 0
+        return True
+
+    def error(self, message):
+        return ValueError('invalid JSON: {}'.format(message))
+
+    def peek(self):
+        """Skips whitespace and returns the next character, or '' at the end
+        of the input"""
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.read():
+                return ''
+
+    def expect(self, chars):
+        """Consumes and returns the next character, which must be one of
+        @chars"""
+        c = self.peek()
+        if not c or c not in chars:
+            raise self.error('expected one of "{}", got "{}"'.format(
+                chars, c))
+
+        self.pos += 1
+        return c
+
+    def value(self):
+        """Decodes and returns the next value"""
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+                if self.eof or not self.partial_number(end):
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+
+            # large values: read more at a time, to avoid decoding the
+            # same prefix over and over
+            self.read(size)
+            size *= 2
+
+    def partial_number(self, end):
+        """True if the value decoded up to @end is a number that may continue
+        in the next chunk, e.g. the 1 of 1.5 or 1e10 split after the 1"""
+        if self.buffer[self.pos] not in _NUMBER_START:
+            return False
+
+        return end == len(self.buffer) or self.buffer[end] in _NUMBER_CHARS
+
+    def skip(self):
+        """Skips the next value, without decoding it"""
+        if self.peek() not in '[{':
+            self.value()
+            return
+
+        depth = 0
+        while True:
+            m = _SPECIAL.search(self.buffer, self.pos)
+            if m is None:
+                self.pos = len(self.buffer)
+                if not self.read():
+                    raise self.error('unexpected end of input')
+                continue
+
+            if m.group() == '"':
+                end = _STRING_END.match(self.buffer, m.end())
+                if end is None:
+                    self.pos = m.start()
+                    if not self.read():
+                        raise self.error('unterminated string')
+                    continue
+
+                self.pos = end.end()
+                continue
+
+            self.pos = m.end()
+            depth += 1 if m.group() in '[{' else -1
+            if depth == 0:
+                return
+
+    def find(self, path):
+        """Moves to the value of nested object keys @path"""
+        for key in path:
+            self.expect('{')
+            if self.peek() == '}':
+                raise KeyError(key)
+
+            while True:
+                name = self.value()
+                self.expect(':')
+                if name == key:
+                    break
+
+                self.skip()
+                if self.expect(',}') == '}':
+                    raise KeyError(key)
+
+
+def iter_items(fp, path='', chunk_size=65536):
+    """Yields items of the array at @path (keys separated by ".", e.g.
+    "data.hosts") of the JSON document in file-like object @fp. If the value
+    at @path is an object, yields {"key": key, "value": value} for each of
+    its members. Raises KeyError if @path is not found, ValueError on
+    invalid JSON"""
+    reader = _Reader(fp, chunk_size)
+    reader.find([key for key in path.split('.') if key])
+
+    c = reader.expect('[{')
+    close = ']' if c == '[' else '}'
+    if reader.peek() == close:
+        return
+
+    while True:
+        if c == '[':
+            yield reader.value()
+        else:
+            key = reader.value()
+            reader.expect(':')
+            yield {'key': key, 'value': reader.value()}
+
+        if reader.expect(',' + close) == close:
+            return
@@ -13,9 +13,27 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import json
 import logging
+import logging.handlers
+import multiprocessing
+import os
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime
 
-from amaltheia.utils import bold, colored
+from amaltheia.config import config
+from amaltheia.utils import bold, colored, host_file
+
+# Host currently being processed by this thread, see set_host()
+_context = threading.local()
+
+# Listener thread that writes all log records, see setup()
+_listener = None
+
+# ANSI escape sequences, stripped from log files
+_ansi = re.compile(r'\x1b\[[0-9;]*m')
 
 
 class AmaltheiaFormatter(logging.Formatter):
@@ -29,21 +47,190 @@ class AmaltheiaFormatter(logging.Formatter):
     }
 
     def format(self, record, *args, **kwargs):
+        # records are shared between handlers, do not alter the original
+        record = logging.makeLogRecord(record.__dict__)
         color = self.colors.get(record.levelname)
         record.levelname = colored(bold(record.levelname), color)
         return super(AmaltheiaFormatter, self).format(record, *args, **kwargs)
 
 
-def setup(level):
-    """Setup logging"""
-    logging.getLogger().setLevel(level)
+class PlainFormatter(logging.Formatter):
+    """Format log records without colors, for log files"""
+    def format(self, record):
+        return _ansi.sub('', super(PlainFormatter, self).format(record))
+
+
+class JsonFormatter(logging.Formatter):
+    """Format log records as JSON lines"""
+    def format(self, record):
+        return json.dumps({
+            'time': datetime.fromtimestamp(record.created).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.processName,
+            'host': getattr(record, 'host', None),
+            'message': _ansi.sub('', record.getMessage()),
+        })
+
+
+class HostFilter(logging.Filter):
+    """Tag log records with the host that is currently being processed"""
+    def filter(self, record):
+        if getattr(record, 'host', None) is None:
+            record.host = getattr(_context, 'host', None)
+
+        return True
+
+
+class HostFileHandler(logging.Handler):
+    """Write log records of each host to a separate file in @directory. At
+    most @max_open files are kept open, the least recently used ones are
+    closed and re-opened (for appending) when needed"""
+    def __init__(self, directory, max_open=64):
+        super(HostFileHandler, self).__init__()
+        self.directory = directory
+        self.max_open = max_open
+        self.handlers = OrderedDict()
+
+        os.makedirs(directory, exist_ok=True)
+
+    def emit(self, record):
+        host = getattr(record, 'host', None)
+        if not host:
+            return
+
+        handler = self.handlers.get(host)
+        if handler is None:
+            while len(self.handlers) >= self.max_open:
+                self.handlers.popitem(last=False)[1].close()
+
+            handler = logging.FileHandler(host_file(self.directory, host))
+            handler.setFormatter(self.formatter)
+            self.handlers[host] = handler
+        else:
+            self.handlers.move_to_end(host)
+
+        handler.emit(record)
+
+    def close(self):
+        for handler in self.handlers.values():
+            handler.close()
+
+        self.handlers = OrderedDict()
+        super(HostFileHandler, self).close()
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler for multiprocessing.SimpleQueue. Records are written
+    to the queue pipe directly, so none are lost when pool workers are
+    terminated, and are never split across processes.
+
+    The pipe buffer (usually 64KB) is the only buffering: if the listener
+    falls behind (e.g. a slow terminal or disk), logging blocks until it
+    catches up. A multiprocessing.Queue would not block, but its feeder
+    thread loses the records of killed workers and cannot be guarded by
+    queue_lock()"""
+    def enqueue(self, record):
+        self.queue.put(record)
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    """QueueListener for multiprocessing.SimpleQueue"""
+    def dequeue(self, block):
+        return self.queue.get()
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+def setup(level, json_file=None, host_dir=None, extra_handlers=()):
+    """Setup logging. Log records from all processes are sent to a queue,
+    and a single listener thread in the main process formats and writes
+    them to the console, and optionally to a JSON lines file, to per-host
+    log files and to any @extra_handlers"""
+    global _listener
+    shutdown()
+
+    handlers = []
+
     handler = logging.StreamHandler()
     handler.setLevel(level)
     handler.setFormatter(AmaltheiaFormatter("%(levelname)s:%(name)s:%(msg)s"))
-    logging.getLogger('amaltheia').addHandler(handler)
+    handlers.append(handler)
+
+    if json_file:
+        handler = logging.FileHandler(json_file)
+        handler.setLevel(level)
+        handler.setFormatter(JsonFormatter())
+        handlers.append(handler)
+
+    if host_dir:
+        handler = HostFileHandler(host_dir)
+        handler.setLevel(level)
+        handler.setFormatter(PlainFormatter(
+            '%(asctime)s %(levelname)s %(msg)s'))
+        handlers.append(handler)
+
+    for handler in extra_handlers:
+        handler.setLevel(level)
+        handlers.append(handler)
+
+    queue = multiprocessing.SimpleQueue()
+    queue_handler = _QueueHandler(queue)
+    queue_handler.setLevel(level)
+    queue_handler.addFilter(HostFilter())
+
+    logging.getLogger().setLevel(level)
+    logging.getLogger('amaltheia').handlers = [queue_handler]
     logging.getLogger('amaltheia').propagate = False
     logging.getLogger('paramiko.transport').disabled = True
 
+    # The listener thread keeps formatting records while worker processes
+    # are forked. Import colorama here, so that the listener never holds the
+    # import lock of a module at fork time, deadlocking the forked worker.
+    # Without colors (or when only listing hosts) it is never imported.
+    if config.color and not config.list_hosts:
+        import colorama  # noqa: F401
+
+    _listener = _QueueListener(queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def shutdown():
+    """Flush pending log records and stop the listener thread"""
+    global _listener
+    if _listener is None:
+        return
+
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+
+    logging.getLogger('amaltheia').handlers = []
+    _listener = None
+
+
+def queue_lock():
+    """Returns the lock that processes hold while writing a log record to
+    the queue, or None"""
+    if _listener is None:
+        return None
+
+    return getattr(_listener.queue, '_wlock', None)
+
+
+def flush():
+    """Wait until all pending log records are written"""
+    if _listener is not None:
+        _listener.stop()
+        _listener.start()
+
+
+def set_host(host_name):
+    """Set host that is currently being processed by this thread. Subsequent
+    log records are tagged with it, to allow writing per-host log files"""
+    _context.host = host_name
+
 
 def logger():
     return logging.getLogger('amaltheia')
@@ -63,3 +250,7 @@ def exception(*args, **kwargs):
 
 def info(*args, **kwargs):
     return logger().info(*args, **kwargs)
+
+
+def warning(*args, **kwargs):
+    return logger().warning(*args, **kwargs)
@@ -0,0 +1,225 @@
+# Copyright (C) 2019  GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import random
+from collections import OrderedDict
+
+import amaltheia.log as log
+from amaltheia.config import config
+from amaltheia.history import History
+from amaltheia.results import percentile
+from amaltheia.utils import (
+    jinja, openstack_cmd_json, str_or_dict)
+
+
+def _float(value, default=0.0):
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return default
+
+
+def _short(host_name):
+    return str(host_name).split('.')[0]
+
+
+def nova_hypervisors():
+    """Returns dictionary of hypervisor host name -> hypervisor stats, as
+    returned by "openstack hypervisor list --long" """
+    hypervisors = openstack_cmd_json(
+        'openstack hypervisor list --long -f json')
+
+    return {h['Hypervisor Hostname']: h for h in hypervisors}
+
+
+def nova_servers_per_host():
+    """Returns dictionary of hypervisor host name -> number of instances,
+    from a single "openstack server list" of all projects"""
+    servers = openstack_cmd_json(
+        'openstack server list --all-projects --long -f json')
+
+    result = {}
+    for server in servers:
+        host = server.get('Host')
+        if host:
+            result[host] = result.get(host, 0) + 1
+
+    return result
+
+
+def short_names(hypervisors):
+    """Returns dictionary of short host name -> name for @hypervisors"""
+    result = {}
+    for name in hypervisors:
+        result.setdefault(_short(name), name)
+
+    return result
+
+
+def find_hypervisor(hypervisors, host_name, short=None):
+    """Returns stats for @host_name from @hypervisors, matching either the
+    full or the short host name. @short is the result of short_names() for
+    @hypervisors, to avoid scanning all of them for each host"""
+    if host_name in hypervisors:
+        return hypervisors[host_name]
+
+    if short is None:
+        short = short_names(hypervisors)
+
+    name = short.get(_short(host_name))
+    return hypervisors[name] if name is not None else None
+
+
+class CostEstimator(object):
+    """Base class for estimating the cost (e.g. expected duration) of
+    processing each host. Higher cost means the host takes longer"""
+    def __init__(self, args):
+        self.args = args
+
+    def fix_hostname(self, host_name, host_args):
+        """Renders "fix-hostname" argument, like services do"""
+        fix_hostname = self.args.get('fix-hostname')
+        if fix_hostname is not None:
+            return jinja(fix_hostname, host=host_name, host_args=host_args)
+
+        return host_name
+
+    def estimate(self, hosts):
+        """Returns dictionary of host_name -> cost for @hosts"""
+        raise NotImplementedError
+
+
+class NovaCostEstimator(CostEstimator):
+    """Cost is the resources that need to be migrated away from each
+    hypervisor. "metric" is one of "ram" (MB used, default), "vcpus"
+    (vCPUs used) or "vms" (number of instances)"""
+    def estimate(self, hosts):
+        metric = self.args.get('metric', 'ram')
+        if metric == 'vms':
+            hypervisors = nova_servers_per_host()
+        else:
+            column = {'ram': 'Memory MB Used', 'vcpus': 'vCPUs Used'}[metric]
+            hypervisors = {name: _float(stats.get(column))
+                           for name, stats in nova_hypervisors().items()}
+
+        short = short_names(hypervisors)
+        return {
+            host_name: _float(find_hypervisor(
+                hypervisors, self.fix_hostname(host_name, host_args), short))
+            for host_name, host_args in hosts.items()
+        }
+
+
+class HostArgsCostEstimator(CostEstimator):
+    """Cost is read from a host argument ("key", default "cost")"""
+    def estimate(self, hosts):
+        key = self.args.get('key', 'cost')
+        return {
+            host_name: _float(host_args.get(key))
+            for host_name, host_args in hosts.items()
+        }
+
+
+class HistoryCostEstimator(CostEstimator):
+    """Cost is the duration of each host in past runs (percentile "p",
+    default 50), from the history database ("db", default is the
+    "history-db" option). Hosts without history get the median cost"""
+    def estimate(self, hosts):
+        path = self.args.get('db', config.history_db)
+        if not path:
+            raise ValueError('no history database')
+
+        history = History(path)
+        try:
+            expected = history.expected(
+                p=float(self.args.get('p', 50)), phase=self.args.get('phase'))
+        finally:
+            history.close()
+
+        default = percentile(list(expected.values()), 50) or 0
+        return {host_name: expected.get(host_name, default)
+                for host_name in hosts}
+
+
+estimators = {
+    'nova': NovaCostEstimator,
+    'host-args': HostArgsCostEstimator,
+    'history': HistoryCostEstimator,
+}
+
+
+def order_by_cost(hosts, args):
+    """Longest-processing-time-first: most expensive hosts start first, so
+    that the tail of the run is not dominated by a single expensive host"""
+    source_name, source_args = str_or_dict(args.get('source', 'nova'))
+    Estimator = estimators.get(source_name)
+    if Estimator is None:
+        log.fatal('[amaltheia] Unknown cost source {}, keeping {}'.format(
+            source_name, 'discovery order'))
+        return list(hosts), {}
+
+    try:
+        cost = Estimator(source_args).estimate(hosts)
+    except Exception:
+        log.exception('[amaltheia] Failed to estimate host costs, '
+                      'keeping discovery order')
+        return list(hosts), {}
+
+    # sorted() is stable, hosts with equal cost keep their discovery order
+    return sorted(hosts, key=lambda h: -cost.get(h, 0)), cost
+
+
+def order_by_name(hosts, args):
+    return sorted(hosts), {}
+
+
+def order_random(hosts, args):
+    result = list(hosts)
+    random.Random(args.get('seed')).shuffle(result)
+    return result, {}
+
+
+def order_as_discovered(hosts, args):
+    return list(hosts), {}
+
+
+orders = {
+    'cost': order_by_cost,
+    'name': order_by_name,
+    'random': order_random,
+    'as-discovered': order_as_discovered,
+}
+
+
+def order_hosts(hosts, order):
+    """Returns @hosts dictionary, re-ordered according to @order, as an
+    OrderedDict (plain dictionaries keep no order before Python 3.7). @order
+    is a string or dictionary, e.g. "name" or {"cost": {"source": "nova"}}"""
+    order_name, order_args = str_or_dict(order)
+
+    order_func = orders.get(order_name)
+    if order_func is None:
+        log.fatal('[amaltheia] Unknown host order {}, keeping {}'.format(
+            order_name, 'discovery order'))
+        return hosts
+
+    names, cost = order_func(hosts, order_args)
+
+    log.info('[amaltheia] Ordered {} hosts by {}'.format(
+        len(names), order_name))
+    log.debug('[amaltheia] Host order ({}): {}'.format(order_name, ', '.join(
+        '{} ({:g})'.format(h, cost[h]) if h in cost else h for h in names)))
+
+    return OrderedDict((host_name, hosts[host_name]) for host_name in names)
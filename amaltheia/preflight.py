@@ -0,0 +1,121 @@
+# Copyright (C) 2019  GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import re
+import socket
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+import amaltheia.log as log
+from amaltheia.results import HostResult
+from amaltheia.utils import jinja, ssh_cmd, ssh_proxy, ssh_try_connect
+
+
+def check_tcp(host_name, port, timeout):
+    """Returns None if @host_name:@port accepts connections, otherwise
+    the reason it does not"""
+    try:
+        socket.create_connection((host_name, port), timeout=timeout).close()
+        return None
+    except OSError as e:
+        return 'tcp port {}: {}'.format(port, e)
+
+
+def check_host(host_name, host_args, args):
+    """Runs pre-flight checks for a single host. Returns (unreachable,
+    skipped), the reasons for which the host should not be processed, or
+    None"""
+    address = host_name
+    if args.get('fix-hostname'):
+        address = jinja(
+            args['fix-hostname'], host=host_name, host_args=host_args)
+
+    timeout = args.get('timeout', 5)
+
+    # hosts behind a proxy are not reachable directly
+    direct = ssh_proxy(address, host_args) == (None, None)
+    if args.get('tcp', True) and direct:
+        reason = check_tcp(address, args.get('tcp-port', 22), timeout)
+        if reason is not None:
+            return reason, None
+
+    if args.get('ssh', True) and not ssh_try_connect(
+            address, host_args, timeout=timeout):
+        return 'ssh connection failed', None
+
+    check = args.get('check')
+    if check:
+        cmd = jinja(check['command'], host=host_name, host_args=host_args)
+        try:
+            stdout, _ = ssh_cmd(address, host_args, cmd, timeout=timeout,
+                                command_timeout=check.get('timeout', 60))
+        except Exception as e:
+            log.warning('[{}] [preflight] Check failed: {}'.format(
+                host_name, e))
+            return None, None
+
+        skip_if = check.get('skip-if-stdout')
+        if skip_if is not None and re.search(skip_if, stdout.strip()):
+            return None, check.get('reason', 'nothing to do')
+
+    return None, None
+
+
+def preflight(hosts, args):
+    """Runs pre-flight checks for dictionary @hosts in parallel. Returns
+    dictionary of hosts that should be processed, in the same order, and
+    a list of HostResult for the ones that should not"""
+    # import paramiko before starting any threads, see log.setup()
+    import paramiko  # noqa: F401
+
+    def check(item):
+        log.set_host(item[0])
+        try:
+            return item[0], check_host(item[0], item[1], args)
+        except Exception as e:
+            return item[0], ('pre-flight checks failed: {}'.format(e), None)
+        finally:
+            log.set_host(None)
+
+    nparallel = max(1, min(int(args.get('nparallel', 32)), len(hosts) or 1))
+    log.info('[amaltheia] Pre-flight checks for {} hosts'.format(len(hosts)))
+
+    reasons = {}
+    with ThreadPool(processes=nparallel) as pool:
+        for host_name, reason in pool.imap_unordered(check, hosts.items()):
+            reasons[host_name] = reason
+
+    results, remaining = [], OrderedDict()
+    for host_name, host_args in hosts.items():
+        unreachable, skipped = reasons[host_name]
+        if unreachable is not None:
+            log.fatal('[{}] [preflight] Unreachable: {}'.format(
+                host_name, unreachable))
+            results.append(HostResult(
+                host_name=host_name, failed=1, unreachable=unreachable))
+        elif skipped is not None:
+            log.info('[{}] [preflight] Skipped: {}'.format(
+                host_name, skipped))
+            results.append(HostResult(host_name=host_name, skipped=skipped))
+        else:
+            remaining[host_name] = host_args
+
+    log.info('[amaltheia] Pre-flight checks: {} hosts OK, {} unreachable, '
+             '{} skipped'.format(
+                 len(remaining),
+                 sum(1 for r in results if not getattr(r, 'skipped', None)),
+                 sum(1 for r in results if getattr(r, 'skipped', None))))
+
+    return remaining, results
@@ -0,0 +1,110 @@
+# Copyright (C) 2019  GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import importlib
+import logging
+
+
+def _entry_points(group):
+    """Returns list of installed entry points for @group"""
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        import pkg_resources
+        return list(pkg_resources.iter_entry_points(group))
+
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        return list(eps.select(group=group))
+
+    return list(eps.get(group, []))
+
+
+def _import(target):
+    """Imports "module.path:ClassName" and returns the class"""
+    module_name, _, attr = target.partition(':')
+    return getattr(importlib.import_module(module_name), attr)
+
+
+class Registry(object):
+    """Maps names to classes, resolving them lazily. Entries can either be
+    classes or "module.path:ClassName" strings, which are only imported the
+    first time they are requested. Names that are not built-in are looked up
+    in the installed entry points of @group, so that third-party packages
+    can provide their own plugins, e.g. in setup.cfg:
+
+    ```
+    [entry_points]
+    amaltheia.updaters =
+        my-updater = my_package.module:MyUpdater
+    ```
+    """
+
+    def __init__(self, group, entries=None):
+        self.group = group
+        self._entries = dict(entries or {})
+        self._plugins = None
+
+    def register(self, name, target):
+        """Adds (or replaces) @name, pointing to class or string @target"""
+        self._entries[name] = target
+
+    def plugins(self):
+        """Returns entry points for @self.group, loaded once"""
+        if self._plugins is None:
+            self._plugins = {}
+            try:
+                for ep in _entry_points(self.group):
+                    self._plugins.setdefault(ep.name, ep)
+            except Exception:
+                logging.getLogger('amaltheia').exception(
+                    '[amaltheia] Failed to load plugins for {}'.format(
+                        self.group))
+
+        return self._plugins
+
+    def names(self):
+        """Returns list of all known names, built-in and plugins"""
+        return sorted(set(self._entries) | set(self.plugins()))
+
+    def get(self, name, default=None):
+        """Returns class for @name, importing it if needed"""
+        if name in self._entries:
+            target = self._entries[name]
+            if isinstance(target, str):
+                target = _import(target)
+                self._entries[name] = target
+
+            return target
+
+        ep = self.plugins().get(name)
+        if ep is None:
+            return default
+
+        self._entries[name] = ep.load()
+        return self._entries[name]
+
+    def __getitem__(self, name):
+        result = self.get(name)
+        if result is None:
+            raise KeyError(name)
+
+        return result
+
+    def __contains__(self, name):
+        return name in self._entries or name in self.plugins()
+
+    def __iter__(self):
+        return iter(self.names())
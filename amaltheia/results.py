@@ -14,32 +14,64 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
+import math
+
 from amaltheia.utils import colored
 
 colors = {
     'evacuated': 'yellow',
     'failed': 'red',
     'updated': 'green',
-    'restored': 'magenta'
+    'restored': 'magenta',
+    'skipped': 'cyan',
+    'timed_out': 'red',
 }
 
 
 class HostResult(object):
+
+    # attributes of every result, in order
+    defaults = (
+        ('evacuated', False),
+        ('updated', 0),
+        ('failed', 0),
+        ('restored', False),
+        ('exception', False),
+    )
+
     def __init__(self, **kwargs):
 
-        self.evacuated = False
-        self.updated = 0
-        self.failed = 0
-        self.restored = False
-        self.exception = False
+        for key, value in self.defaults:
+            setattr(self, key, value)
 
         for key, value in kwargs.items():
             setattr(self, key, value)
 
+    def compact(self):
+        """Returns plain list of (key, value) for the attributes that are
+        not set to their default, for sending results between processes.
+        Use HostResult.from_compact() to restore"""
+        defaults = dict(self.defaults)
+        return [(key, value) for key, value in self.__dict__.items()
+                if key not in defaults or value != defaults[key]]
+
+    @classmethod
+    def from_compact(cls, items):
+        result = cls()
+        for key, value in items:
+            setattr(result, key, value)
+
+        return result
+
     def __str__(self):
+        if getattr(self, 'skipped', False):
+            return '{}{}'.format(self.host_name.ljust(50), colored(
+                'skipped={}'.format(self.skipped), colors['skipped']))
+
         items = []
         for key, value in self.__dict__.items():
-            if key == 'host_name' or key == 'exception' and not value:
+            if key in ('host_name', 'durations', 'steps') or (
+                    key == 'exception' and not value):
                 continue
 
             if str(value) == '0':
@@ -52,3 +84,24 @@ class HostResult(object):
             items.append(colored('{}={}'.format(key, value), color))
 
         return '{}{}'.format(self.host_name.ljust(50), ' '.join(items))
+
+
+def status(result):
+    """Returns "ok", "error" or "skipped" for HostResult @result"""
+    if getattr(result, 'skipped', False):
+        return 'skipped'
+    elif result.exception or result.failed > 0:
+        return 'error'
+
+    return 'ok'
+
+
+def percentile(values, p):
+    """Returns the @p-th percentile (0-100) of @values, using the nearest
+    rank method, or None if there are no values"""
+    values = sorted(values)
+    if not values:
+        return None
+
+    rank = max(1, int(math.ceil(p / 100.0 * len(values))))
+    return values[min(rank, len(values)) - 1]
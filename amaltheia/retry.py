@@ -0,0 +1,100 @@
+# Copyright (C) 2019  GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import re
+import time
+
+import amaltheia.log as log
+from amaltheia.utils import (
+    DeadlineExceeded, clear_last_command, last_command)
+
+
+class RetryPolicy(object):
+    """Retry policy of a service or updater, from its "retries", "backoff",
+    "backoff-factor", "max-backoff" and "retry-on" arguments.
+
+    "retry-on" is a list of patterns. Numbers match the return code of the
+    last command that was executed, strings are regular expressions that
+    are searched in its stderr, or in the message of the exception that was
+    raised. Without "retry-on", any failure is retried"""
+
+    def __init__(self, args):
+        args = args or {}
+        self.retries = int(args.get('retries', 0))
+        self.backoff = float(args.get('backoff', 10))
+        self.factor = float(args.get('backoff-factor', 2))
+        self.max_backoff = float(args.get('max-backoff', 300))
+
+        self.retry_on = args.get('retry-on')
+        if self.retry_on is not None and not isinstance(
+                self.retry_on, list):
+            self.retry_on = [self.retry_on]
+
+    def delay(self, attempt):
+        """Seconds to wait before retry number @attempt (starting at 1)"""
+        return min(self.max_backoff,
+                   self.backoff * self.factor ** (attempt - 1))
+
+    def matches(self, exception=None):
+        """Returns the pattern of "retry-on" that matches @exception, or
+        the last command if there is no exception, or None"""
+        if self.retry_on is None:
+            return 'any failure'
+
+        cmd = last_command()
+        for pattern in self.retry_on:
+            if isinstance(pattern, int):
+                if exception is None and cmd is not None and (
+                        cmd['returncode'] == pattern):
+                    return 'return code {}'.format(pattern)
+            elif exception is not None:
+                if re.search(str(pattern), str(exception)):
+                    return pattern
+            elif cmd is not None and re.search(
+                    str(pattern), cmd['stderr'] or ''):
+                return pattern
+
+        return None
+
+    def run(self, func, host_name, description, sleep=time.sleep):
+        """Runs @func() until it returns a true value, retrying failures
+        that match the policy. Returns the result of the last attempt.
+        Exceptions are raised if they do not match, or if no retries are
+        left. Deadlines are never retried. @sleep is called with the delay
+        before each retry"""
+        attempt = 0
+        while True:
+            clear_last_command()
+            exception = None
+            try:
+                result = func()
+                if result:
+                    return result
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                exception = e
+
+            reason = self.matches(exception)
+            if attempt >= self.retries or reason is None:
+                if exception is not None:
+                    raise exception
+                return result
+
+            attempt += 1
+            delay = self.delay(attempt)
+            log.warning('[{}] {} failed ({}), retry {} of {} in {:g}s'.format(
+                host_name, description, reason, attempt, self.retries, delay))
+            sleep(delay)
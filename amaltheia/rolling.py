@@ -0,0 +1,141 @@
+# Copyright (C) 2019  GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import math
+
+import amaltheia.log as log
+from amaltheia.strategy import ParallelStrategy
+
+
+def max_unavailable(size, min_available):
+    """Returns how many hosts of a group of @size hosts can be out of
+    service at the same time. @min_available is either a number of hosts,
+    or a percentage string, e.g. "75%" """
+    if isinstance(min_available, str) and min_available.endswith('%'):
+        required = math.ceil(size * float(min_available[:-1]) / 100)
+    else:
+        required = int(min_available)
+
+    return max(0, size - required)
+
+
+class RollingStrategy(ParallelStrategy):
+    '''run updates on up to N hosts in parallel, keeping at least a minimum
+    number of hosts of each group in service'''
+
+    # group sizes require the complete inventory
+    streaming = False
+
+    @property
+    def name(self):
+        return 'Rolling-{}'.format(self.nparallel)
+
+    def __getstate__(self):
+        state = super(RollingStrategy, self).__getstate__()
+        for key in ('_queue', '_groups', '_unavailable', '_limit'):
+            state.pop(key, None)
+        return state
+
+    def group(self, host_name):
+        """Returns group of @host_name, or None if it has no group"""
+        group = self.hosts[host_name].get(
+            self.strategy_args.get('group-key', 'zone'))
+        return None if group is None else str(group)
+
+    def group_name(self, group):
+        if group is None:
+            return '(no {})'.format(
+                self.strategy_args.get('group-key', 'zone'))
+
+        return group
+
+    def setup(self):
+        """Computes group sizes and limits, once"""
+        if hasattr(self, '_queue'):
+            return
+
+        min_available = self.strategy_args.get('min-available', '50%')
+        overrides = self.strategy_args.get('groups') or {}
+
+        self._queue = list(self.hosts)
+        self._groups = {}
+        for host_name in self._queue:
+            self._groups.setdefault(self.group(host_name), []).append(
+                host_name)
+
+        self._unavailable = {group: set() for group in self._groups}
+        self._limit = {}
+        for group, members in self._groups.items():
+            # hosts without a group are processed one at a time
+            limit = 1
+            if group is not None:
+                limit = max_unavailable(len(members), (
+                    overrides.get(group) or {}).get(
+                        'min-available', min_available))
+
+            if limit < 1:
+                log.warning('[amaltheia] Group {} is too small to keep its '
+                            'minimum available, its hosts are skipped'.format(
+                                group))
+
+            self._limit[group] = limit
+
+        if None in self._groups:
+            log.warning('[amaltheia] {} hosts have no {}, processing them '
+                        'one at a time'.format(
+                            len(self._groups[None]), self.strategy_args.get(
+                                'group-key', 'zone')))
+
+        log.info('[amaltheia] Rolling groups: {}'.format(', '.join(
+            '{} ({} of {} at a time)'.format(
+                self.group_name(group), self._limit[group], len(members))
+            for group, members in sorted(
+                self._groups.items(), key=lambda g: str(g[0])))))
+
+    def next_host(self):
+        self.setup()
+
+        for host_name in self._queue:
+            group = self.group(host_name)
+            if len(self._unavailable[group]) < self._limit[group]:
+                self._queue.remove(host_name)
+                self._unavailable[group].add(host_name)
+                return host_name, self.hosts[host_name]
+
+        return None
+
+    def host_done(self, result):
+        # failed hosts are considered out of service for the rest of the run
+        if not result.exception and result.failed == 0:
+            self._unavailable[self.group(result.host_name)].discard(
+                result.host_name)
+
+    def unscheduled(self):
+        result = []
+        for host_name in getattr(self, '_queue', []):
+            group = self.group(host_name)
+            failed = len(self._unavailable[group])
+            if failed:
+                reason = 'group {} has {} failed hosts'.format(
+                    self.group_name(group), failed)
+            else:
+                reason = 'group {} must keep {} of {} hosts available'.format(
+                    self.group_name(group),
+                    len(self._groups[group]) - self._limit[group],
+                    len(self._groups[group]))
+
+            result.append((host_name, reason))
+
+        return result
@@ -0,0 +1,143 @@
+# Copyright (C) 2019  GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Host selectors are lists of terms, or strings of comma separated terms:
+#
+#   lar04*              host name matches glob
+#   ~lar04..            host name matches regular expression
+#   zone=az1            field matches glob
+#   host.site.slug~ath  field matches regular expression
+#
+# Fields are host arguments, or data of the discoverer (e.g. "host" for
+# NetBox), with "." for nested fields. "name" is the host name. A host is
+# selected if it matches any plain term (or there are none), all terms
+# starting with "&" and no terms starting with "!".
+
+import fnmatch
+import re
+
+_PREDICATE = re.compile(r'^([\w-]+(?:\.[\w-]+)*)([=~])(.*)$')
+
+# marker for fields that a host does not have
+_MISSING = object()
+
+
+def parse_terms(spec):
+    """Returns list of terms of selector @spec, a list of terms or a string
+    of comma separated terms"""
+    if not spec:
+        return []
+
+    if isinstance(spec, str):
+        spec = spec.split(',')
+
+    return [str(term).strip() for term in spec if str(term).strip()]
+
+
+def compile_term(term):
+    """Returns (path, match) for @term, where path is a tuple of field names
+    and match is the compiled match() of the pattern. Raises ValueError on
+    invalid regular expressions"""
+    if term.startswith('~'):
+        path, op, pattern = ('name', ), '~', term[1:]
+    else:
+        m = _PREDICATE.match(term)
+        if m:
+            path, op, pattern = tuple(m.group(1).split('.')), m.group(2), (
+                m.group(3))
+        else:
+            path, op, pattern = ('name', ), '=', term
+
+    if op == '=':
+        pattern = fnmatch.translate(pattern)
+
+    try:
+        return path, re.compile(pattern).match
+    except re.error as e:
+        raise ValueError('invalid host selector "{}": {}'.format(term, e))
+
+
+def _matches(match, value):
+    if value is _MISSING or value is None:
+        return False
+
+    if isinstance(value, (list, tuple, set)):
+        return any(_matches(match, v) for v in value)
+
+    if isinstance(value, bool):
+        value = 'true' if value else 'false'
+
+    return match(str(value)) is not None
+
+
+class Selector(object):
+    """Host selector @spec, compiled once and evaluated for each host"""
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.include, self.require, self.exclude = [], [], []
+
+        for term in parse_terms(spec):
+            if term.startswith('!'):
+                self.exclude.append(compile_term(term[1:]))
+            elif term.startswith('&'):
+                self.require.append(compile_term(term[1:]))
+            else:
+                self.include.append(compile_term(term))
+
+    def __bool__(self):
+        return bool(self.include or self.require or self.exclude)
+
+    def __call__(self, host_name, host_args=None, **fields):
+        """Returns True if the host is selected. @fields are extra data of
+        the host, e.g. the item returned by an API"""
+        def test(term):
+            path, match = term
+            return _matches(match, self.lookup(
+                path, host_name, host_args, fields))
+
+        if self.include and not any(test(t) for t in self.include):
+            return False
+
+        return all(test(t) for t in self.require) and not any(
+            test(t) for t in self.exclude)
+
+    @staticmethod
+    def lookup(path, host_name, host_args, fields):
+        head, rest = path[0], path[1:]
+        if head == 'name' and not rest:
+            return host_name
+
+        if head in fields:
+            value = fields[head]
+        elif isinstance(host_args, dict) and head in host_args:
+            value = host_args[head]
+        else:
+            return _MISSING
+
+        for key in rest:
+            if not isinstance(value, dict) or key not in value:
+                return _MISSING
+            value = value[key]
+
+        return value
+
+
+def select_hosts(items, spec):
+    """Yields (host_name, host_args) of @items selected by @spec"""
+    selector = spec if isinstance(spec, Selector) else Selector(spec)
+    for host_name, host_args in items:
+        if selector(host_name, host_args):
+            yield host_name, host_args
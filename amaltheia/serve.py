@@ -0,0 +1,536 @@
+# Copyright (C) 2019  GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# "amaltheia serve" runs jobs submitted over a local HTTP API, one at a time,
+# in a single long-running process. Jobs run in the main thread (deadlines
+# rely on SIGALRM), while the HTTP server runs in a background thread.
+# Process-wide caches (compiled templates, discovered hosts with the
+# "discovery-cache-ttl" option, Thruk hosts) stay warm between jobs. So do ssh
+# connections to jump hosts, but only for the serial strategy: parallel
+# strategies fork new workers for each job, which connect again. OpenStack
+# commands start a new client (and session) each time.
+#
+# Jobs can run arbitrary commands (e.g. the "exec" updater), so the API
+# requires a token on TCP addresses, including loopback ones, which any local
+# user or web page (e.g. with DNS rebinding) can reach. Only unix sockets,
+# which only the current user can connect to, work without a token.
+
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import queue
+import re
+import socket
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+from argparse import ArgumentParser
+from collections import OrderedDict, deque
+from functools import partial
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import yaml
+
+import amaltheia.log as log
+from amaltheia.amaltheia import parse_pairs, prepare_job
+from amaltheia.config import config
+from amaltheia.log import PlainFormatter
+from amaltheia.results import status
+from amaltheia.strategy import run_strategy
+
+
+def result_json(result):
+    """Returns dictionary for HostResult @result"""
+    data = dict(result.compact())
+    data['status'] = status(result)
+    return data
+
+
+class Job(object):
+    """Job submitted to the daemon. Only the last @max_log_lines lines of
+    its log are kept"""
+
+    def __init__(self, job_id, job, variables, max_log_lines=10000):
+        self.id = job_id
+        self.job = job
+        self.variables = variables
+
+        self.status = 'queued'
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+        self.strategy = None
+        self.log = deque(maxlen=max_log_lines)
+        self.log_lines = 0
+        self.changed = threading.Condition()
+
+    @property
+    def done(self):
+        return self.status in ('done', 'failed')
+
+    @property
+    def results(self):
+        if self.strategy is None:
+            return []
+
+        return list(self.strategy.results)
+
+    def add_log(self, line):
+        with self.changed:
+            self.log.append(line)
+            self.log_lines += 1
+            self.changed.notify_all()
+
+    def last_log(self):
+        """Returns total number of log lines, and list of the ones that are
+        kept"""
+        with self.changed:
+            return self.log_lines, list(self.log)
+
+    def last_results(self):
+        results = self.results
+        return len(results), results
+
+    def notify(self):
+        with self.changed:
+            self.changed.notify_all()
+
+    def summary(self):
+        result = OrderedDict([
+            ('id', self.id),
+            ('status', self.status),
+            ('submitted', self.submitted),
+            ('started', self.started),
+            ('finished', self.finished),
+        ])
+        if self.error is not None:
+            result['error'] = self.error
+        if self.strategy is not None:
+            result['strategy'] = self.strategy.name
+            result['hosts'] = self.strategy.stats()
+
+        return result
+
+    def follow(self, items, wait=True):
+        """Yields entries as they are added. @items() returns the total
+        number of entries so far, and a list of the last ones. With @wait,
+        keeps waiting for new entries until the job is done"""
+        sent = 0
+        while True:
+            done = self.done
+            total, current = items()
+            for item in current[max(0, sent - (total - len(current))):]:
+                yield item
+            sent = total
+
+            if done or not wait:
+                return
+
+            # results are not announced, check again every second
+            with self.changed:
+                self.changed.wait(timeout=1)
+
+
+class JobLogHandler(logging.Handler):
+    """Keeps log lines of a job, for GET /jobs/<id>/log"""
+
+    def __init__(self, job):
+        super(JobLogHandler, self).__init__()
+        self.job = job
+        self.setFormatter(PlainFormatter('%(asctime)s %(levelname)s %(msg)s'))
+
+    def emit(self, record):
+        self.job.add_log(self.format(record))
+
+
+class Daemon(object):
+    """Accepts jobs and runs them one at a time. At most @keep_jobs
+    finished jobs, and @max_log_lines lines of the log of each job, are
+    remembered. @defaults are configuration options applied before the
+    "config" block of each job"""
+
+    def __init__(self, keep_jobs=100, defaults=None, max_log_lines=10000):
+        self.keep_jobs = keep_jobs
+        self.max_log_lines = max_log_lines
+        self.jobs = OrderedDict()
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.next_id = 1
+
+        config.load(defaults or {})
+        self.config = dict(config._entries)
+
+    def submit(self, job, overrides=(), variables=()):
+        """Queues @job, returns the Job. Raises ValueError for invalid
+        jobs"""
+        if not isinstance(job, dict):
+            raise ValueError('Job must be a YAML object')
+
+        variables = prepare_job(job, overrides, variables)
+        with self.lock:
+            j = Job(str(self.next_id), job, variables, self.max_log_lines)
+            self.next_id += 1
+            self.jobs[j.id] = j
+
+        self.queue.put(j)
+        return j
+
+    def prune(self):
+        """Forgets the oldest finished jobs, keeping @keep_jobs of them"""
+        with self.lock:
+            finished = [j for j in self.jobs.values() if j.done]
+            for j in finished[:max(0, len(finished) - self.keep_jobs)]:
+                del self.jobs[j.id]
+
+    def run(self, job):
+        """Runs @job in the current thread"""
+        # each job starts from the daemon configuration
+        config._entries.clear()
+        config._entries.update(self.config)
+        config.variables = job.variables
+        config.load(job.job.get('config', {}))
+
+        log.setup(level=config.log_level,
+                  json_file=config.log_json_file,
+                  host_dir=config.log_host_dir,
+                  extra_handlers=[JobLogHandler(job)])
+
+        job.status, job.started = 'running', time.time()
+        job.notify()
+        try:
+            log.info('[amaltheia] Running job {}'.format(job.id))
+            run_strategy(job.job, created=partial(setattr, job, 'strategy'))
+            job.status = 'done'
+        except (Exception, SystemExit) as e:
+            log.exception('[amaltheia] Job {} failed'.format(job.id))
+            job.status, job.error = 'failed', str(e) or type(e).__name__
+        finally:
+            log.shutdown()
+            job.finished = time.time()
+            job.notify()
+            self.prune()
+
+    def run_forever(self):
+        while True:
+            self.run(self.queue.get())
+
+
+# accepted Content-Type of submitted jobs
+JOB_CONTENT_TYPES = ('application/yaml', 'application/json')
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """HTTP API of the daemon, see docs/configuration.md"""
+
+    routes = [
+        ('GET', r'/jobs', 'list_jobs'),
+        ('POST', r'/jobs', 'submit_job'),
+        ('GET', r'/jobs/(\w+)', 'get_job'),
+        ('GET', r'/jobs/(\w+)/results', 'get_results'),
+        ('GET', r'/jobs/(\w+)/log', 'get_log'),
+    ]
+
+    @property
+    def daemon(self):
+        return self.server.daemon
+
+    def address_string(self):
+        # clients of unix sockets have no address
+        return str(self.client_address[0] if self.client_address else 'unix')
+
+    def authorized(self):
+        """Checks the "Authorization: Bearer <token>" header, if the server
+        requires a token"""
+        token = self.server.token
+        if not token:
+            return True
+
+        header = self.headers.get('Authorization', '')
+        return hmac.compare_digest(header.encode(), 'Bearer {}'.format(
+            token).encode())
+
+    def valid_host(self):
+        """Checks that the Host header names the address the server listens
+        on, to reject requests of web pages through DNS rebinding"""
+        hosts = getattr(self.server, 'allowed_hosts', None)
+        return hosts is None or self.headers.get(
+            'Host', '').lower() in hosts
+
+    def route(self, method):
+        if not self.authorized():
+            self.send_json(401, {'error': 'Unauthorized'},
+                           {'WWW-Authenticate': 'Bearer'})
+            return
+
+        if not self.valid_host():
+            self.send_json(400, {'error': 'Invalid Host header'})
+            return
+
+        url = urllib.parse.urlsplit(self.path)
+        self.query = urllib.parse.parse_qs(url.query)
+        for route_method, pattern, handler in self.routes:
+            match = re.fullmatch(pattern, url.path.rstrip('/'))
+            if route_method == method and match:
+                try:
+                    return getattr(self, handler)(*match.groups())
+                except BrokenPipeError:
+                    return
+
+        self.send_json(404, {'error': 'Not found'})
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def send_json(self, code, data, headers=None):
+        body = json.dumps(data, default=str).encode()
+        self.send_response(code)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self, content_type, lines):
+        """Sends @lines as they are produced, until the connection is
+        closed"""
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.end_headers()
+        for line in lines:
+            self.wfile.write(line.encode() + b'\n')
+            self.wfile.flush()
+
+    def job(self, job_id):
+        job = self.daemon.jobs.get(job_id)
+        if job is None:
+            self.send_json(404, {'error': 'Unknown job {}'.format(job_id)})
+
+        return job
+
+    @property
+    def follow(self):
+        return self.query.get('follow', ['0'])[0] not in ('0', 'false', 'no')
+
+    def list_jobs(self):
+        self.send_json(200, [
+            job.summary() for job in list(self.daemon.jobs.values())])
+
+    def submit_job(self):
+        # browsers can only send other content types across origins
+        # without a preflight request
+        content_type = self.headers.get('Content-Type', '').split(';')[0]
+        if content_type.strip().lower() not in JOB_CONTENT_TYPES:
+            self.send_json(415, {'error': 'Content-Type must be one of {}'
+                                 .format(', '.join(JOB_CONTENT_TYPES))})
+            return
+
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            job = self.daemon.submit(
+                yaml.safe_load(self.rfile.read(length)),
+                self.query.get('override', []),
+                self.query.get('variable', []))
+        except (ValueError, yaml.YAMLError) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+
+        self.send_json(201, job.summary())
+
+    def get_job(self, job_id):
+        job = self.job(job_id)
+        if job is not None:
+            data = job.summary()
+            data['results'] = [result_json(r) for r in job.results]
+            self.send_json(200, data)
+
+    def get_results(self, job_id):
+        job = self.job(job_id)
+        if job is not None:
+            self.send_stream('application/x-ndjson', (
+                json.dumps(result_json(r), default=str)
+                for r in job.follow(job.last_results, self.follow)))
+
+    def get_log(self, job_id):
+        job = self.job(job_id)
+        if job is not None:
+            self.send_stream('text/plain', job.follow(
+                job.last_log, self.follow))
+
+
+class Server(socketserver.ThreadingMixIn, HTTPServer):
+    """HTTP API on a TCP address. Requests must carry @token, if set, and
+    a Host header naming the address, see allowed_hosts()"""
+    daemon_threads = True
+
+    def __init__(self, address, daemon, token=None):
+        HTTPServer.__init__(self, address, RequestHandler)
+        self.daemon = daemon
+        self.token = token
+        self.allowed_hosts = allowed_hosts(address[0], self.server_address[1])
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP API on a unix socket, that only the current user can connect
+    to"""
+    daemon_threads = True
+
+    def __init__(self, path, daemon, token=None):
+        if os.path.exists(path):
+            os.unlink(path)
+
+        umask = os.umask(0o077)
+        try:
+            socketserver.UnixStreamServer.__init__(self, path, RequestHandler)
+        finally:
+            os.umask(umask)
+
+        self.daemon = daemon
+        self.token = token
+
+    def server_close(self):
+        super(UnixServer, self).server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def parse_address(listen):
+    """Parses "[host:]port" and returns (host, port)"""
+    host, _, port = listen.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def is_loopback(host):
+    """Returns True if all addresses of @host are loopback addresses"""
+    try:
+        addresses = [info[4][0] for info in socket.getaddrinfo(host, None)]
+    except (socket.gaierror, UnicodeError):
+        return False
+
+    return bool(addresses) and all(
+        ipaddress.ip_address(address.split('%')[0]).is_loopback
+        for address in addresses)
+
+
+def allowed_hosts(host, port):
+    """Returns set of Host headers that requests to @host and @port may
+    send, or None for wildcard addresses, where any name of the machine
+    may be used"""
+    if host in ('', '0.0.0.0', '::'):
+        return None
+
+    names = {host}
+    if is_loopback(host):
+        names.update(('localhost', '127.0.0.1', '::1'))
+
+    result = set()
+    for name in names:
+        if ':' in name:
+            name = '[{}]'.format(name)
+
+        result.add('{}:{}'.format(name, port).lower())
+        if port == 80:
+            result.add(name.lower())
+
+    return result
+
+
+def create_server(listen, daemon, token=None):
+    """Returns server for @listen, "unix:<path>" or "[host:]port". Raises
+    ValueError for TCP addresses without a @token"""
+    if listen.startswith('unix:'):
+        return UnixServer(listen[len('unix:'):], daemon, token)
+
+    host, port = parse_address(listen)
+    if not token:
+        raise ValueError(
+            'refusing to listen on {} without a token, jobs can run '
+            'arbitrary commands. Use --token-file, or a unix '
+            'socket'.format(host))
+
+    return Server((host, port), daemon, token)
+
+
+def read_token(path):
+    """Returns token from file @path, or from the AMALTHEIA_SERVE_TOKEN
+    environment variable if @path is not set"""
+    if path is None:
+        return os.getenv('AMALTHEIA_SERVE_TOKEN') or None
+
+    with open(path) as fin:
+        return fin.read().strip() or None
+
+
+def main(argv):
+    parser = ArgumentParser(
+        prog='amaltheia serve',
+        description='Run amaltheia jobs submitted over a local HTTP API')
+
+    parser.add_argument('-l',
+                        '--listen',
+                        default='127.0.0.1:8080',
+                        help='"[host:]port" or "unix:<path>" to listen on')
+    parser.add_argument('--token-file',
+                        help='File with a token that requests must send as '
+                             '"Authorization: Bearer <token>". Default is '
+                             'the AMALTHEIA_SERVE_TOKEN environment variable')
+    parser.add_argument('-c',
+                        '--config',
+                        nargs='*',
+                        required=False,
+                        default=[],
+                        help='"key=value" pairs for default configuration')
+    parser.add_argument('--keep-jobs',
+                        type=int,
+                        default=100,
+                        help='Number of finished jobs to remember')
+    parser.add_argument('--max-log-lines',
+                        type=int,
+                        default=10000,
+                        help='Number of log lines to keep for each job')
+
+    args = parser.parse_args(argv)
+
+    daemon = Daemon(keep_jobs=args.keep_jobs,
+                    defaults=dict(parse_pairs(args.config, 'option')),
+                    max_log_lines=args.max_log_lines)
+    try:
+        server = create_server(
+            args.listen, daemon, read_token(args.token_file))
+    except (OSError, ValueError) as e:
+        print('[amaltheia] {}'.format(e))
+        sys.exit(-1)
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    print('[amaltheia] Listening on {}{}'.format(
+        args.listen, ' (token required)' if server.token else ''))
+
+    try:
+        daemon.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -14,18 +14,24 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import json
-from time import sleep
+from time import sleep, time
 from shlex import quote
 
 import amaltheia.log as log
+from amaltheia.registry import Registry
 from amaltheia.utils import (
-    openstack_cmd, openstack_cmd_table, str_or_dict, jinja,
-    thruk_get_host, thruk_set_notifications)
+    openstack_cmd, openstack_cmd_batch, openstack_cmd_json,
+    openstack_cmd_table, str_or_dict, jinja, thruk_get_host, thruk_get_hosts,
+    thruk_set_notifications_bulk)
 
 
 class Service():
     """Base class for handling evacution/restoring of services"""
 
+    # set to True for services that implement evacuate_batch() and
+    # restore_batch(), see ServiceCoordinator
+    batch = False
+
     @property
     def name(self):
         return '<unnamed>'
@@ -34,8 +40,33 @@ class Service():
         self.host_args = host_args
         self.service_args = service_args
 
+        # True if part of evacuate/restore is done by evacuate_batch()
+        # and restore_batch() for multiple hosts at once
+        self.batched = False
+
         self.host = self.fix_hostname(host)
 
+    @classmethod
+    def prepare(cls, service_args):
+        """Called once per run in the main process, before any workers are
+        started, e.g. to retrieve data needed by all hosts only once"""
+        pass
+
+    @classmethod
+    def evacuate_batch(cls, handlers):
+        """Handles the part of evacuating that can be done for multiple
+        hosts at once (e.g. with a single API session), before each host
+        is evacuated with evacuate(). Returns list of True/False for each
+        handler of @handlers"""
+        raise NotImplementedError
+
+    @classmethod
+    def restore_batch(cls, handlers):
+        """Handles the part of restoring that can be done for multiple
+        hosts at once, after each host is restored with restore(). Returns
+        list of True/False for each handler of @handlers"""
+        raise NotImplementedError
+
     def evacuate(self):
         """Handles evacuating a host that is running the service. Typical
         actions include stopping and disabling services, migrating running
@@ -58,13 +89,61 @@ class Service():
         return host
 
 
+def nova_compute_set(hosts, enable):
+    """Enable or disable nova-compute on multiple @hosts using a single
+    OpenStack client session. Returns dictionary of host -> success"""
+    if not hosts:
+        return {}
+
+    cmds = ['compute service set {} nova-compute {}'.format(
+        quote(host), '--enable' if enable else '--disable') for host in hosts]
+
+    # a single host takes one client run, like without "batch-services",
+    # instead of a session and a status check
+    if len(hosts) == 1:
+        p = openstack_cmd('openstack ' + cmds[0])
+        return {hosts[0]: p.returncode == 0}
+
+    openstack_cmd_batch(cmds)
+
+    try:
+        status = {s['Host']: s['Status'] for s in openstack_cmd_json(
+            'openstack compute service list --service nova-compute -f json')}
+    except (json.JSONDecodeError, ValueError, KeyError, TypeError):
+        log.exception('[amaltheia] Failed to retrieve nova-compute status')
+        status = {}
+
+    expected = 'enabled' if enable else 'disabled'
+    return {host: status.get(host) == expected for host in hosts}
+
+
 class NovaComputeService(Service):
     """Service handler for nova-compute"""
 
+    batch = True
+
     @property
     def name(self):
         return 'nova-compute'
 
+    @classmethod
+    def evacuate_batch(cls, handlers):
+        """Disable nova-compute service on all hosts at once"""
+        hosts = [h.host for h in handlers
+                 if not h.service_args.get('skip-evacuate')]
+        result = nova_compute_set(hosts, enable=False)
+
+        return [result.get(h.host, True) for h in handlers]
+
+    @classmethod
+    def restore_batch(cls, handlers):
+        """Enable nova-compute service on all hosts at once"""
+        hosts = [h.host for h in handlers
+                 if not h.service_args.get('skip-restore')]
+        result = nova_compute_set(hosts, enable=True)
+
+        return [result.get(h.host, True) for h in handlers]
+
     def evacuate(self):
         """Disable nova-compute service on this host, migrate away
         all running and stopped instances"""
@@ -72,10 +151,11 @@ class NovaComputeService(Service):
         if self.service_args.get('skip-evacuate'):
             return True
 
-        # Disable nova-compute
-        openstack_cmd(
-            'openstack compute service set {} nova-compute --disable'.format(
-                quote(self.host)))
+        # Disable nova-compute, unless already done by evacuate_batch()
+        if not self.batched:
+            openstack_cmd(
+                'openstack compute service set {} nova-compute --disable'
+                .format(quote(self.host)))
 
         # Retrieve list of VMs, indexable by their Instance ID
         server_list = openstack_cmd_table(
@@ -154,6 +234,10 @@ class NovaComputeService(Service):
         if self.service_args.get('skip-restore'):
             return True
 
+        # nova-compute will be enabled by restore_batch()
+        if self.batched:
+            return True
+
         openstack_cmd(
             'openstack compute service set {} nova-compute --enable'.format(
                 quote(self.host)))
@@ -161,8 +245,59 @@ class NovaComputeService(Service):
         return True
 
 
+# Thruk API URL -> {address: Nagios hostname}, see thruk_hosts()
+_thruk_hosts = {}
+
+# Thruk API URLs for which hosts were retrieved from the API (not the cache
+# file) by this process
+_thruk_fresh = set()
+
+
+def thruk_hosts(thruk_url, thruk_username, thruk_password, cache_file=None,
+                cache_ttl=3600, refresh=False):
+    """Returns dictionary of address -> Nagios hostname for all hosts known
+    to Thruk. Hosts are retrieved with a single API request, and are kept
+    in memory and, if @cache_file is set, on disk for @cache_ttl seconds.
+    With @refresh, cached hosts are retrieved again, unless they were
+    already retrieved from the API by this process"""
+    if thruk_url in _thruk_hosts and (
+            not refresh or thruk_url in _thruk_fresh):
+        return _thruk_hosts[thruk_url]
+
+    cache = {}
+    if cache_file:
+        try:
+            with open(cache_file) as fin:
+                cache = json.load(fin)
+        except (OSError, ValueError):
+            cache = {}
+
+        entry = cache.get(thruk_url) or {}
+        if not refresh and time() - entry.get('time', 0) < cache_ttl:
+            _thruk_hosts[thruk_url] = entry.get('hosts', {})
+            return _thruk_hosts[thruk_url]
+
+    log.debug('[amaltheia] Retrieving Nagios hosts from {}'.format(thruk_url))
+    _thruk_hosts[thruk_url] = thruk_get_hosts(
+        thruk_url, thruk_username, thruk_password)
+    _thruk_fresh.add(thruk_url)
+
+    if cache_file:
+        cache[thruk_url] = {'time': time(), 'hosts': _thruk_hosts[thruk_url]}
+        try:
+            with open(cache_file, 'w') as fout:
+                json.dump(cache, fout)
+        except OSError:
+            log.exception('[amaltheia] Failed to write {}'.format(cache_file))
+
+    return _thruk_hosts[thruk_url]
+
+
 class ThrukDowntimeService(Service):
     """Service handler for thruk-downtime."""
+
+    batch = True
+
     @property
     def name(self):
         return 'thruk-downtime'
@@ -178,45 +313,139 @@ class ThrukDowntimeService(Service):
         self.thruk_password = host_args.get(
             'thruk-password', service_args.get('thruk-password'))
 
+        self.cache_file = service_args.get('cache-file')
+        self.cache_ttl = service_args.get('cache-ttl', 3600)
+
+    @property
+    def api(self):
+        return self.thruk_url, self.thruk_username, self.thruk_password
+
+    @classmethod
+    def prepare(cls, service_args):
+        """Retrieve the list of Thruk hosts, so that workers do not need to
+        retrieve it separately"""
+        if not service_args.get('thruk-url'):
+            return
+
+        try:
+            thruk_hosts(
+                service_args['thruk-url'], service_args.get('thruk-username'),
+                service_args.get('thruk-password'),
+                cache_file=service_args.get('cache-file'),
+                cache_ttl=service_args.get('cache-ttl', 3600))
+        except (OSError, json.JSONDecodeError, ValueError, KeyError,
+                TypeError):
+            log.exception('[amaltheia] Failed to retrieve Thruk hosts')
+
+    def nagios_hostname(self):
+        """Returns Nagios hostname for this host, or None. Uses the cached
+        list of Thruk hosts, which is refreshed once if the host is missing,
+        falling back to a lookup for this host only"""
+        try:
+            hosts = thruk_hosts(
+                *self.api, cache_file=self.cache_file,
+                cache_ttl=self.cache_ttl)
+            if self.host not in hosts:
+                hosts = thruk_hosts(
+                    *self.api, cache_file=self.cache_file,
+                    cache_ttl=self.cache_ttl, refresh=True)
+
+            if self.host in hosts:
+                return hosts[self.host]
+
+            hosts[self.host] = thruk_get_host(*self.api, self.host)
+            return hosts[self.host]
+
+        except (OSError, json.JSONDecodeError, ValueError, KeyError,
+                IndexError, TypeError):
+            log.fatal('[{}] Failed to retrieve Nagios name'.format(
+                self.host))
+
+        return None
+
+    @classmethod
+    def set_notifications_batch(cls, handlers, enable):
+        """Set notifications for all @handlers, looking up their Nagios
+        names in the list of Thruk hosts. Returns list of True/False"""
+        names, apis = {}, {}
+        for handler in handlers:
+            if handler.thruk_url is None:
+                continue
+
+            names[handler] = handler.nagios_hostname()
+            if names[handler] is not None:
+                apis.setdefault(handler.api, []).append(names[handler])
+
+        result = {}
+        for api, api_names in apis.items():
+            log.info('[amaltheia] {} notifications for {} hosts'.format(
+                'Enabling' if enable else 'Disabling', len(api_names)))
+
+            result[api] = thruk_set_notifications_bulk(
+                *api, api_names, enable)
+
+        return [
+            result.get(h.api, {}).get(names.get(h), False) for h in handlers]
+
+    @classmethod
+    def evacuate_batch(cls, handlers):
+        """Disable notifications for all hosts at once"""
+        return cls.set_notifications_batch(handlers, False)
+
+    @classmethod
+    def restore_batch(cls, handlers):
+        """Enable notifications for all hosts at once"""
+        return cls.set_notifications_batch(handlers, True)
+
     def evacuate(self):
         """Use the Thruk Rest API to disable notifications for this host."""
+        if self.batched:
+            return True
 
         if self.thruk_url is None:
             return False
 
-        try:
-            self.nagios_hostname = thruk_get_host(self.thruk_url,
-                                                  self.thruk_username,
-                                                  self.thruk_password,
-                                                  self.host)
-
-        except (json.JSONDecodeError, ValueError, KeyError, TypeError):
-            log.fatal('[{}] Failed to retrieve Nagios name'.format(
-                self.host))
+        nagios_hostname = self.nagios_hostname()
+        if nagios_hostname is None:
+            return False
 
-        response = thruk_set_notifications(
-            self.thruk_url, self.thruk_username, self.thruk_password,
-            self.nagios_hostname, False)
+        response = thruk_set_notifications_bulk(
+            *self.api, [nagios_hostname], False)
 
-        if response.status != 200:
+        if not response[nagios_hostname]:
             log.fatal('[{}] Failed to disable notifications for {}'.format(
-                self.host, self.nagios_hostname))
+                self.host, nagios_hostname))
+            return False
+
+        return True
 
     def restore(self):
         """Use the Thruk Rest API to enable notifications for this host"""
-        response = thruk_set_notifications(
-            self.thruk_url, self.thruk_username, self.thruk_password,
-            self.nagios_hostname, True)
+        if self.batched:
+            return True
+
+        if self.thruk_url is None:
+            return False
 
-        if response.status != 200:
+        nagios_hostname = self.nagios_hostname()
+        if nagios_hostname is None:
+            return False
+
+        response = thruk_set_notifications_bulk(
+            *self.api, [nagios_hostname], True)
+
+        if not response[nagios_hostname]:
             log.fatal('[{}] Failed to re-enable notifications for {}'.format(
-                self.host, self.nagios_hostname))
+                self.host, nagios_hostname))
+            return False
+
+        return True
 
 
-services = {
+services = Registry('amaltheia.services', {
     'nova-compute': NovaComputeService,
     'thruk-downtime': ThrukDowntimeService,
-}
+})
 
 
 def get_service(host_name, host_args, service):
@@ -228,3 +457,83 @@ def get_service(host_name, host_args, service):
         return Service(host_name, host_args, service_args)
 
     raise ValueError('Invalid service name {}'.format(service_name))
+
+
+def prepare_services(service_list):
+    """Calls Service.prepare() for each service of @service_list"""
+    for service in service_list:
+        service_name, service_args = str_or_dict(service)
+        service_class = services.get(service_name)
+        if service_class is not None:
+            service_class.prepare(service_args)
+
+
+class ServiceCoordinator(object):
+    """Evacuates and restores services for a batch of hosts at once, for
+    services that support it (see Service.batch). @services is the default
+    list of services, hosts may override it with the "services" host
+    argument"""
+
+    def __init__(self, services):
+        self.services = services
+
+    def handlers(self, items):
+        """Returns dictionary of Service class -> list of (host_name,
+        handler) for services of @items that support batches"""
+        result = {}
+        for host_name, host_args in items:
+            for service in host_args.get('services', self.services):
+                handler = get_service(host_name, host_args, service)
+                if handler.batch:
+                    result.setdefault(type(handler), []).append(
+                        (host_name, handler))
+
+        return result
+
+    def evacuate(self, items):
+        """Evacuates batch of (host_name, host_args) @items. Returns two
+        dictionaries of host_name -> list of service names, one for services
+        that were evacuated, one for those that failed. For hosts with
+        failures, any services that were evacuated are restored"""
+        batched, failed = {}, {}
+        for service_class, handlers in self.handlers(items).items():
+            log.info('[amaltheia] Evacuating {} on {} hosts'.format(
+                handlers[0][1].name, len(handlers)))
+
+            success = service_class.evacuate_batch([h for _, h in handlers])
+            for (host_name, handler), ok in zip(handlers, success):
+                if ok:
+                    batched.setdefault(host_name, []).append(handler.name)
+                else:
+                    failed.setdefault(host_name, []).append(handler.name)
+                    log.fatal('[{}] Failed to disable service {}'.format(
+                        host_name, handler.name))
+
+        undo = [(h, args) for h, args in items if h in failed and h in batched]
+        if undo:
+            self.restore(undo, {h: batched.pop(h) for h, _ in undo})
+
+        return batched, failed
+
+    def restore(self, items, batched):
+        """Restores services of @items, which were evacuated with evacuate().
+        @batched is the first dictionary returned by evacuate(). Returns
+        dictionary of host_name -> list of service names that failed"""
+        failed = {}
+        for service_class, handlers in self.handlers(items).items():
+            handlers = [(host_name, handler) for host_name, handler in handlers
+                        if handler.name in batched.get(host_name, [])]
+            if not handlers:
+                continue
+
+            log.info('[amaltheia] Restoring {} on {} hosts'.format(
+                handlers[0][1].name, len(handlers)))
+
+            success = service_class.restore_batch([h for _, h in handlers])
+            for (host_name, handler), ok in zip(handlers, success):
+                if not ok:
+                    failed.setdefault(host_name, []).append(handler.name)
+                    log.fatal('[{}] Failed to restore service {}'.format(
+                        host_name, handler.name))
+
+        return failed
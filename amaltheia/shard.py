@@ -0,0 +1,64 @@
+# Copyright (C) 2019  GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+
+import amaltheia.log as log
+
+
+def parse_shard(spec):
+    """Parses "i/n" and returns (i, n), with 1 <= i <= n. Raises
+    ValueError on invalid specs"""
+    try:
+        index, count = (int(x) for x in str(spec).split('/'))
+    except (TypeError, ValueError):
+        raise ValueError('invalid shard "{}", expected "i/n"'.format(spec))
+
+    if not 1 <= index <= count:
+        raise ValueError('invalid shard "{}", expected 1 <= i <= n'.format(
+            spec))
+
+    return index, count
+
+
+def shard_of(key, count):
+    """Returns shard (1 to @count) of @key, using rendezvous hashing: each
+    key goes to the shard with the highest hash of (shard, key). A key only
+    depends on itself, so adding or removing hosts never moves other hosts,
+    and changing @count only moves the keys of added or removed shards"""
+    def score(shard):
+        digest = hashlib.sha1('{}:{}'.format(shard, key).encode()).digest()
+        return int.from_bytes(digest[:8], 'big')
+
+    return max(range(1, count + 1), key=score)
+
+
+def shard_hosts(items, spec, key=None):
+    """Yields (host_name, host_args) of @items that belong to shard @spec
+    ("i/n"). With @key, hosts are placed by the value of this host
+    argument (e.g. "zone"), so that all hosts with the same value end up
+    in the same shard"""
+    index, count = parse_shard(spec)
+    for host_name, host_args in items:
+        value = host_name
+        if key is not None:
+            value = (host_args or {}).get(key)
+            if value is None:
+                log.debug('[amaltheia] Host {} has no {}, sharding by '
+                          'name'.format(host_name, key))
+                value = host_name
+
+        if shard_of(value, count) == index:
+            yield host_name, host_args
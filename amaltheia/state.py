@@ -0,0 +1,109 @@
+# Copyright (C) 2019  GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from datetime import datetime
+
+import amaltheia.log as log
+from amaltheia.results import HostResult, status
+
+
+def fingerprint(job, host_args, keys=None):
+    """Returns fingerprint of a host, from its @host_args (only @keys, if
+    set) and the services and update actions that @job would run on it"""
+    if keys is not None:
+        args = {key: host_args.get(key) for key in keys}
+    else:
+        args = host_args
+
+    data = json.dumps({
+        'host_args': args,
+        'services': host_args.get('services', job.get('services')),
+        'updates': host_args.get('updates', job.get('updates')),
+    }, sort_keys=True, default=str)
+
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+class StateStore(object):
+    """Results of the last run of each host, kept in JSON file @path:
+    {"hosts": {"host_name": {"fingerprint": "", "status": "", "time": ""}}}
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.hosts = {}
+
+        try:
+            with open(path) as fin:
+                self.hosts = json.load(fin).get('hosts', {})
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            log.warning('[amaltheia] Ignoring invalid state file {}: '
+                        '{}'.format(path, e))
+
+    def unchanged(self, host_name, value):
+        """Returns the state of @host_name if its last run was successful
+        and its fingerprint is still @value, otherwise None"""
+        state = self.hosts.get(host_name)
+        if state and state['status'] == 'ok' and (
+                state['fingerprint'] == value):
+            return state
+
+        return None
+
+    def update(self, results, fingerprints):
+        """Records HostResult list @results, with dictionary of host name
+        -> fingerprint @fingerprints"""
+        now = datetime.now().isoformat()
+        for result in results:
+            if getattr(result, 'unchanged', False):
+                continue
+
+            self.hosts[result.host_name] = {
+                'fingerprint': fingerprints.get(result.host_name),
+                'status': status(result),
+                'time': now,
+            }
+
+    def save(self):
+        tmp = '{}.tmp'.format(self.path)
+        with open(tmp, 'w') as fout:
+            json.dump({'hosts': self.hosts}, fout, indent=2, sort_keys=True)
+
+        os.replace(tmp, self.path)
+
+
+def changed_hosts(hosts, job, store, keys=None):
+    """Returns dictionary of @hosts that changed or failed since their last
+    run in StateStore @store, and list of HostResult for the rest"""
+    remaining, results = OrderedDict(), []
+    for host_name, host_args in hosts.items():
+        state = store.unchanged(host_name, fingerprint(job, host_args, keys))
+        if state is None:
+            remaining[host_name] = host_args
+        else:
+            results.append(HostResult(
+                host_name=host_name, unchanged=True,
+                skipped='unchanged since {}'.format(state['time'])))
+
+    log.info('[amaltheia] Incremental run: {} hosts changed, {} '
+             'unchanged'.format(len(remaining), len(results)))
+
+    return remaining, results
@@ -16,21 +16,325 @@
 
 import json
 import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
 
 import amaltheia.log as log
-from amaltheia.discover import discover
-from amaltheia.services import get_service
+from amaltheia.discover import discover, iter_discover
+from amaltheia.history import (
+    History, estimate_remaining, format_duration, host_duration)
+from amaltheia.ordering import order_hosts
+from amaltheia.preflight import preflight
+from amaltheia.services import (
+    get_service, prepare_services, ServiceCoordinator)
 from amaltheia.update import update
-from amaltheia.results import HostResult
+from amaltheia.results import HostResult, status
 from amaltheia.config import config
-from amaltheia.utils import str_or_dict, bold
+from amaltheia.registry import Registry
+from amaltheia.retry import RetryPolicy
+from amaltheia.state import StateStore, changed_hosts, fingerprint
+from amaltheia.utils import str_or_dict, bold, DeadlineExceeded
+
+
+# Per-phase semaphores shared by all worker processes of a strategy, see
+# ParallelStrategy.phase_limits()
+_limits = {}
+
+# WorkerSlots of the pool, see ParallelStrategy.check_deadlines(), and the
+# strategy whose inventory tasks refer to, see _run_task()
+_worker = {'slots': None, 'strategy': None}
+
+# seconds between attempts to get a phase slot, and between log messages
+# about hosts that are still waiting for one
+SLOT_POLL_INTERVAL = 0.05
+SLOT_WAIT_WARNING = 60
+
+
+class WorkerSlots(object):
+    """Process id of each worker of a pool, the task it is working on and
+    the phase limits (see phase_limit()) it holds, in shared memory. All
+    changes happen under a lock, which is also held while killing a worker,
+    so that a worker is only killed while it is still working on the task
+    it is killed for, and the phase slots it held can be released"""
+
+    def __init__(self, size, keys):
+        self.keys = list(keys)
+        self.lock = multiprocessing.Lock()
+        self.pids = multiprocessing.RawArray('l', size)
+        self.tasks = multiprocessing.RawArray('l', size)
+        self.held = multiprocessing.RawArray('l', size)
+        self.index = None
+
+    def register(self):
+        """Called in each worker process, takes a free slot"""
+        with self.lock:
+            for i, pid in enumerate(self.pids):
+                if pid == 0:
+                    self.pids[i] = os.getpid()
+                    self.tasks[i] = self.held[i] = 0
+                    self.index = i
+                    return
+
+        log.warning('[amaltheia] No free worker slot, deadlines of worker '
+                    '{} cannot be enforced'.format(os.getpid()))
+
+    def set_task(self, task):
+        if self.index is not None:
+            with self.lock:
+                self.tasks[self.index] = task
+
+    def acquire(self, key, semaphore):
+        """Takes a slot of phase limit @key without blocking. Returns True
+        if it was free"""
+        if self.index is None:
+            return semaphore.acquire(False)
+
+        with self.lock:
+            if not semaphore.acquire(False):
+                return False
+
+            self.held[self.index] |= 1 << self.keys.index(key)
+            return True
+
+    def release(self, key, semaphore):
+        if self.index is None:
+            semaphore.release()
+            return
+
+        with self.lock:
+            semaphore.release()
+            self.held[self.index] &= ~(1 << self.keys.index(key))
+
+    def kill(self, task, limits, locks=()):
+        """Kills the worker that is working on @task, if any, and releases
+        the phase slots that it held, from dictionary of semaphores @limits.
+        @locks (e.g. of queues that workers write to) are held while
+        killing, so that the worker does not die while holding them.
+        Returns the process id of the killed worker, or None"""
+        with self.lock:
+            for i, pid in enumerate(self.pids):
+                if pid and self.tasks[i] == task:
+                    break
+            else:
+                return None
+
+            acquired = [lock for lock in locks if lock.acquire(timeout=5)]
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+            finally:
+                for lock in acquired:
+                    lock.release()
+
+            for bit, key in enumerate(self.keys):
+                if self.held[i] & (1 << bit):
+                    limits[key].release()
+
+            self.pids[i] = self.tasks[i] = self.held[i] = 0
+            return pid
+
+
+def _init_worker(limits, slots=None, strategy=None):
+    """Pool initializer, sets per-phase semaphores of the worker process.
+    @strategy is handed to each worker once (inherited when forking), so
+    that tasks do not carry the whole inventory"""
+    _limits.clear()
+    _limits.update(limits)
+    _worker['slots'] = slots
+    _worker['strategy'] = strategy
+
+    if slots is not None:
+        slots.register()
+
+
+def _run_task(method, host_name, host_args, batched, task=0):
+    """Runs @method of the worker strategy for a host. @host_args is None
+    for hosts that were in the inventory when the pool was started. @task
+    identifies this task in WorkerSlots. Returns the HostResult in compact
+    form"""
+    strategy = _worker['strategy']
+    if host_args is None:
+        host_args = strategy._hosts[host_name]
+
+    slots = _worker['slots']
+    if slots is not None:
+        slots.set_task(task)
+
+    try:
+        return getattr(strategy, method)(
+            (host_name, host_args, batched)).compact()
+    finally:
+        log.set_host(None)
+        if slots is not None:
+            slots.set_task(0)
+
+
+def _acquire(key, semaphore, description):
+    """Waits for a slot of phase limit @key, logging a warning about
+    @description every SLOT_WAIT_WARNING seconds"""
+    slots = _worker['slots']
+    start = last_warning = time.monotonic()
+    while True:
+        if slots is not None:
+            if slots.acquire(key, semaphore):
+                return
+            time.sleep(SLOT_POLL_INTERVAL)
+        elif semaphore.acquire(timeout=SLOT_WAIT_WARNING):
+            return
+
+        now = time.monotonic()
+        if now - last_warning >= SLOT_WAIT_WARNING:
+            last_warning = now
+            log.warning('[amaltheia] Still waiting for {} slot after '
+                        '{:.0f} seconds'.format(description, now - start))
+
+
+def _release(key, semaphore):
+    slots = _worker['slots']
+    if slots is not None:
+        slots.release(key, semaphore)
+    else:
+        semaphore.release()
+
+
+@contextmanager
+def phase_limit(phase, name):
+    """Waits until there is a free slot for @phase ("evacuate", "update" or
+    "restore") and, if limited separately, for service or updater @name.
+    Yields a function that sleeps for the given seconds without holding the
+    slots, e.g. for the backoff of retries"""
+    keys = [key for key in (phase, (phase, name)) if key in _limits]
+
+    description = '{} {}'.format(phase, name)
+    acquired = []
+
+    def acquire():
+        if keys:
+            log.debug('[amaltheia] Waiting for {} slot'.format(description))
+
+        for key in keys:
+            _acquire(key, _limits[key], description)
+            acquired.append(key)
+
+    def release():
+        while acquired:
+            key = acquired.pop()
+            _release(key, _limits[key])
+
+    def sleep(seconds):
+        release()
+        time.sleep(seconds)
+        acquire()
+
+    try:
+        acquire()
+        yield sleep
+    finally:
+        release()
+
+
+@contextmanager
+def deadline(seconds):
+    """Raises DeadlineExceeded in the main thread if the block does not
+    finish within @seconds. Blocking calls (e.g. reading from a socket or
+    waiting for a subprocess) are interrupted by SIGALRM. Yields a list,
+    which is non-empty if the deadline expired, even if the exception was
+    caught inside the block"""
+    expired = []
+    if seconds is None:
+        yield expired
+        return
+
+    if threading.current_thread() is not threading.main_thread():
+        log.warning('[amaltheia] Deadline of {} seconds is not enforced '
+                    'outside the main thread'.format(seconds))
+        yield expired
+        return
+
+    def expire(signum, frame):
+        expired.append(True)
+        raise DeadlineExceeded()
+
+    previous = signal.signal(signal.SIGALRM, expire)
+    signal.setitimer(signal.ITIMER_REAL, max(seconds, 0.001))
+    try:
+        yield expired
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def run_phase(result, phase, name, func, timeout=None, retry=None):
+    """Runs @func() as a step of @phase for service or updater @name,
+    respecting phase limits, and adds its duration (excluding the time
+    waiting for a slot) to @result.durations, and to @result.steps if set.
+    Failures are retried according to RetryPolicy @retry, if any, releasing
+    the phase slots while waiting to retry. If it does not finish within
+    @timeout seconds (including retries), it is interrupted and
+    @result.timed_out is set to @phase. Returns the result of @func(), or
+    False if it timed out"""
+    if timeout is not None and timeout <= 0:
+        expired = [True]
+    else:
+        with phase_limit(phase, name) as sleep:
+            start = time.monotonic()
+            try:
+                with deadline(timeout) as expired:
+                    if retry is None:
+                        success = func()
+                    else:
+                        success = retry.run(func, result.host_name,
+                                            '{} {}'.format(phase, name),
+                                            sleep)
+            except DeadlineExceeded:
+                pass
+            finally:
+                duration = time.monotonic() - start
+                result.durations[phase] = result.durations.get(
+                    phase, 0) + duration
+                if getattr(result, 'steps', None) is not None:
+                    result.steps.append((phase, name, duration))
+
+    if expired:
+        result.timed_out = phase
+        log.fatal(bold('[{}] Timed out during {} {}'.format(
+            result.host_name, phase, name)))
+        return False
+
+    return success
 
 
 class Strategy():
-    """Base class for strategy handling"""
+    """Base class for strategy handling. @hosts is either a dictionary, or
+    an iterable of (host_name, host_args) tuples, for strategies that can
+    start working on hosts while they are still being discovered"""
+
+    # set to True for strategies that use iter_hosts() instead of
+    # requiring the complete inventory before starting
+    streaming = False
+
+    # "config" block of the job, set by create_strategy()
+    job_config = {}
+
+    # exception that stopped discovery, see _discover_next()
+    discovery_error = None
+
+    # queue of hosts found by the discovery thread, see start_discovery()
+    _discovered = None
 
     def __init__(self, hosts, services, updates, strategy_args):
-        self.hosts = hosts
+        if isinstance(hosts, dict):
+            self._hosts, self._pending = OrderedDict(hosts), None
+        else:
+            self._hosts, self._pending = OrderedDict(), iter(hosts)
+
         self.services = services
         self.updates = updates
         self.strategy_args = strategy_args
@@ -38,12 +342,104 @@ class Strategy():
         self.results = []
 
         log.debug({
-            'hosts': self.hosts,
+            'hosts': self._hosts if self._pending is None else '<streaming>',
             'updates': self.updates,
             'services': self.services,
             'strategy_args': self.strategy_args
         })
 
+    def __getstate__(self):
+        # discovery and scheduling state stays with the main process
+        state = self.__dict__.copy()
+        state['_pending'] = None
+        state['results'] = []
+        state.pop('_next_hosts', None)
+        for key in ('coordinator', '_slots', '_tasks', '_deadlines',
+                    '_limits', '_running', '_shared', '_expected',
+                    '_discovered'):
+            state.pop(key, None)
+        return state
+
+    def _discover_next(self):
+        """Retrieve next host from the discovery iterator, or from the
+        discovery thread if start_discovery() was called. Returns
+        (host_name, host_args), or None if discovery is over. If discovery
+        fails, the error is logged and kept in @discovery_error, and hosts
+        that were already discovered are still processed"""
+        if self._pending is None:
+            return None
+
+        try:
+            if self._discovered is None:
+                item = next(self._pending)
+            else:
+                item = self._discovered.get()
+                if isinstance(item, Exception):
+                    raise item
+                if item is None:
+                    raise StopIteration
+        except StopIteration:
+            self._pending = None
+            return None
+        except Exception as e:
+            self._pending = None
+            self.discovery_error = e
+            log.exception(bold('[amaltheia] Discovery failed, no more hosts '
+                               'will be started'))
+            return None
+
+        host_name, host_args = item
+        self._hosts[host_name] = host_args
+        return host_name, host_args
+
+    def start_discovery(self, notify):
+        """Continues any pending discovery in a background thread, so that
+        a slow discoverer (e.g. waiting for the next page of an HTTP API)
+        does not hold up hosts that are already running. @notify is called
+        from that thread for each host found, and when discovery is over"""
+        if self._pending is None or self._discovered is not None:
+            return
+
+        self._discovered = queue.Queue()
+        threading.Thread(target=self._discover_thread,
+                         args=(self._pending, notify), daemon=True).start()
+
+    def _discover_thread(self, pending, notify):
+        try:
+            for item in pending:
+                self._discovered.put(item)
+                notify()
+        except Exception as e:
+            self._discovered.put(e)
+        finally:
+            self._discovered.put(None)
+            notify()
+
+    def discovery_ready(self):
+        """False if the next host is still being looked for by the
+        discovery thread, see start_discovery()"""
+        return (self._pending is None or self._discovered is None
+                or not self._discovered.empty())
+
+    @property
+    def hosts(self):
+        """Host inventory. Waits for any pending discovery to complete"""
+        while self._discover_next() is not None:
+            pass
+
+        return self._hosts
+
+    def iter_hosts(self):
+        """Yields (host_name, host_args) tuples for all hosts in the
+        inventory. Hosts are yielded as soon as they are discovered"""
+        for item in list(self._hosts.items()):
+            yield item
+
+        item = self._discover_next()
+        while item is not None:
+            yield item
+            item = self._discover_next()
+
     def execute(self):
         raise NotImplementedError
 
@@ -51,25 +447,87 @@ class Strategy():
     def name(self):
         raise NotImplementedError
 
-    def do_host(self, host_name, host_args):
-        """Execute the whole process for a single host"""
-        r = HostResult(host_name=host_name)
+    def deadlines(self, host_args):
+        """Returns dictionary of deadlines in seconds, for the whole "host"
+        and for each phase. Set with the "deadlines" strategy argument, and
+        overridden with the "deadlines" host argument"""
+        result = dict(self.strategy_args.get('deadlines') or {})
+        result.update(host_args.get('deadlines') or {})
 
-        log.info(bold('[{}] Starting, arguments: {}'.format(
-            host_name, host_args)))
+        return {key: float(value) for key, value in result.items()
+                if value is not None}
 
+    def service_handlers(self, host_name, host_args, batched=()):
+        """Returns service handlers for @host_name. @batched is a list of
+        service names, for which part of the evacuate/restore actions are
+        performed for multiple hosts at once, see ServiceCoordinator"""
         # allow host to override services
         services = host_args.get('services', self.services)
 
         handlers = list(get_service(
             host_name, host_args, service) for service in services)
+        for handler in handlers:
+            handler.batched = handler.name in batched
+
+        return handlers
+
+    def checkpoint(self, host_name):
+        """Called before each step of a host. Subclasses can raise an
+        exception here to stop working on the host"""
+        pass
+
+    def restore_services(self, r, host_name, handlers, deadlines):
+        """Restore services of @handlers, updating HostResult @r"""
+        r.restored = True
+        for handler in handlers:
+            self.checkpoint(host_name)
+            log.info(bold('[{}] Restoring {} {}'.format(
+                host_name, handler.name, handler.__dict__)))
+            if not run_phase(r, 'restore', handler.name, handler.restore,
+                             deadlines.get('restore'),
+                             RetryPolicy(handler.service_args)):
+                r.restored = False
+                r.failed += 1
+
+                log.fatal('[{}] Failed to restore service {}'.format(
+                    host_name, handler))
+
+    def do_host(self, host_name, host_args, batched=()):
+        """Execute the whole process for a single host. @batched is a list
+        of service names, for which part of the evacuate/restore actions
+        are performed for multiple hosts at once, see ServiceCoordinator"""
+        r = HostResult(host_name=host_name, durations={}, steps=[])
+        log.set_host(host_name)
+
+        log.info(bold('[{}] Starting, arguments: {}'.format(
+            host_name, host_args)))
+
+        handlers = self.service_handlers(host_name, host_args, batched)
+
+        # the host deadline covers evacuating and updating, services are
+        # always restored
+        deadlines = self.deadlines(host_args)
+        host_end = None
+        if 'host' in deadlines:
+            host_end = time.monotonic() + deadlines['host']
+
+        def timeout(phase):
+            values = [deadlines.get(phase)]
+            if host_end is not None:
+                values.append(host_end - time.monotonic())
+
+            values = [v for v in values if v is not None]
+            return min(values) if values else None
 
         # cleanup services
         r.evacuated = True
         for handler in handlers:
+            self.checkpoint(host_name)
             log.info(bold('[{}] Evacuating {} {}'.format(
                 host_name, handler.name, handler.__dict__)))
-            this_success = handler.evacuate()
+            this_success = run_phase(
+                r, 'evacuate', handler.name, handler.evacuate,
+                timeout('evacuate'), RetryPolicy(handler.service_args))
             if not this_success:
                 r.evacuated = False
                 r.failed += 1
@@ -85,9 +543,13 @@ class Strategy():
         # do updates
         if r.evacuated:
             for u in updates:
+                self.checkpoint(host_name)
                 log.info(bold('[{}] Running update action: {}'.format(
                     host_name, u)))
-                if update(host_name, host_args, u):
+                updater_name, updater_args = str_or_dict(u)
+                if run_phase(r, 'update', updater_name,
+                             partial(update, host_name, host_args, u),
+                             timeout('update'), RetryPolicy(updater_args)):
                     r.updated += 1
                 else:
                     r.failed += 1
@@ -95,44 +557,90 @@ class Strategy():
                     log.fatal('[{}] Failed update action {}'.format(
                         host_name, u))
 
-        # restore services
-        r.restored = True
-        for handler in handlers:
-            log.info(bold('[{}] Restoring {} {}'.format(
-                host_name, handler.name, handler.__dict__)))
-            if not handler.restore():
-                r.restored = False
-                r.failed += 1
+                if getattr(r, 'timed_out', None):
+                    break
 
-                log.fatal('[{}] Failed to restore service {}'.format(
-                    host_name, handler))
+        # restore services
+        self.restore_services(r, host_name, handlers, deadlines)
 
         log.info(bold('[{}] Done'.format(host_name)))
         return r
 
+    def restore_host(self, host_name, host_args, batched=()):
+        """Restore services of a host whose worker was killed, after its
+        deadline expired"""
+        r = HostResult(host_name=host_name, durations={}, steps=[], failed=1,
+                       timed_out='host')
+        log.set_host(host_name)
+
+        log.fatal(bold('[{}] Restoring services after timeout'.format(
+            host_name)))
+
+        self.restore_services(
+            r, host_name, self.service_handlers(host_name, host_args, batched),
+            self.deadlines(host_args))
+
+        return r
+
+    def log_progress(self, concurrency=1):
+        """Logs number of hosts done and, once discovery is complete, the
+        estimated remaining time, from the history of past runs (see the
+        "history-db" option) and the durations of hosts done so far"""
+        if self._pending is not None:
+            return
+
+        done = set(r.host_name for r in self.results)
+        remaining = [h for h in self._hosts if h not in done]
+        if not hasattr(self, '_expected'):
+            self._expected = {}
+            if config.history_db:
+                history = History(config.history_db)
+                self._expected = history.expected()
+                history.close()
+
+        eta = estimate_remaining(remaining, self._expected, [
+            d for d in map(host_duration, self.results) if d is not None],
+            concurrency)
+        log.info('[amaltheia] Progress: {} of {} hosts done{}'.format(
+            len(self._hosts) - len(remaining), len(self._hosts),
+            ', ETA {}'.format(format_duration(eta)) if remaining and (
+                eta is not None) else ''))
+
     def output_stats(self):
+        log.flush()
         print(bold('\n\n*****************************************'))
-        ok, err = 0, 0
         for result in self.results:
             print(result)
-            if result.exception or result.failed > 0:
-                err += 1
-            else:
-                ok += 1
 
+        stats = self.stats()
         print(bold('\n\n*****************************************'))
-        print('[amaltheia] {} hosts OK, {} hosts ERROR'.format(ok, err))
+        print('[amaltheia] {} hosts OK, {} hosts ERROR, {} hosts SKIPPED'
+              .format(stats['ok'], stats['error'], stats['skipped']))
+        if self.discovery_error is not None:
+            print(bold('[amaltheia] Discovery failed, hosts that were not '
+                       'discovered were not processed: {}'.format(
+                           self.discovery_error)))
+
+    def stats(self):
+        """Returns number of hosts per status, see results.status()"""
+        result = {'ok': 0, 'error': 0, 'skipped': 0}
+        for r in self.results:
+            result[status(r)] += 1
+
+        return result
 
 
 class SerialStrategy(Strategy):
     '''run updates on hosts one-by-one'''
 
+    streaming = True
+
     @property
     def name(self):
         return 'Serial'
 
     def execute(self):
-        for host_name, host_args in self.hosts.items():
+        for host_name, host_args in self.iter_hosts():
             success = True
             result = HostResult(host_name=host_name)
             try:
@@ -153,7 +661,9 @@ class SerialStrategy(Strategy):
                         host_name)))
 
             finally:
+                log.set_host(None)
                 self.results.append(result)
+                self.log_progress()
 
             if not success and self.strategy_args.get('quit-on-error'):
                 log.fatal(
@@ -162,12 +672,14 @@ class SerialStrategy(Strategy):
 
 
 class ParallelStrategy(Strategy):
-    '''run updates on hosts one-by-one'''
+    '''run updates on up to N hosts in parallel'''
 
     defaults = {
         'nparallel': 2
     }
 
+    streaming = True
+
     @property
     def name(self):
         return 'Parallel-{}'.format(self.nparallel)
@@ -179,9 +691,30 @@ class ParallelStrategy(Strategy):
         except (ValueError, TypeError):
             return self.defaults['nparallel']
 
-    def execute_one(self, host_name):
+    def phase_limits(self):
+        """Returns semaphores for the "limits" strategy argument, e.g.
+        {"evacuate": 4, "update": {"total": 30, "reboot": 10}}. Keys are
+        phase names for limits of the whole phase, and (phase, name) for
+        limits of a single service or updater"""
+        result = {}
+        for phase, value in (self.strategy_args.get('limits') or {}).items():
+            if phase not in ('evacuate', 'update', 'restore'):
+                log.fatal('[amaltheia] Ignoring limits for unknown phase '
+                          '{}'.format(phase))
+                continue
+
+            if not isinstance(value, dict):
+                value = {'total': value}
+
+            for name, limit in value.items():
+                key = phase if name == 'total' else (phase, name)
+                result[key] = multiprocessing.BoundedSemaphore(int(limit))
+
+        return result
+
+    def execute_one(self, host_name, host_args, batched=()):
         try:
-            result = self.do_host(host_name, self.hosts[host_name])
+            result = self.do_host(host_name, host_args, batched)
             if result.failed > 0:
                 log.fatal(bold('[{}] [amaltheia] Host failed'.format(
                     host_name)))
@@ -198,32 +731,364 @@ class ParallelStrategy(Strategy):
 
             return HostResult(host_name=host_name, exception=True)
 
+    def execute_item(self, item):
+        return self.execute_one(*item)
+
+    def restore_item(self, item):
+        try:
+            return self.restore_host(*item)
+        except Exception:
+            log.exception(bold(
+                '[{}] [amaltheia] An unhandled exception occured'.format(
+                    item[0])))
+
+            return HostResult(host_name=item[0], exception=True,
+                              timed_out='host')
+
+    def backstop(self, host_args):
+        """Returns seconds after which the worker of a host is killed, if it
+        has not finished by itself, or None. This is the "host" deadline,
+        plus the "restore" deadline for each service, plus a grace period"""
+        deadlines = self.deadlines(host_args)
+        if 'host' not in deadlines:
+            return None
+
+        services = host_args.get('services', self.services)
+        return (deadlines['host']
+                + deadlines.get('restore', 0) * len(services)
+                + float(self.strategy_args.get('deadline-grace', 60)))
+
+    def check_deadlines(self, pool, running, results):
+        """Kills the workers of hosts in @running that did not finish within
+        their backstop() deadline, and restores their services in another
+        worker"""
+        now = time.monotonic()
+        for host_name, end in list(self._deadlines.items()):
+            if host_name not in running:
+                del self._deadlines[host_name]
+                continue
+
+            if now < end:
+                continue
+
+            log.fatal(bold('[{}] [amaltheia] Deadline expired, killing '
+                           'its worker'.format(host_name)))
+
+            # workers write log records and results to queues, do not kill
+            # them while they hold the lock of a queue
+            locks = [lock for lock in (
+                log.queue_lock(), getattr(pool._outqueue, '_wlock', None))
+                if lock is not None]
+            pid = self._slots.kill(
+                self._tasks[host_name], self._limits, locks)
+            if pid is None:
+                # not started yet, or its result is on the way
+                self._deadlines[host_name] = now + 1
+                continue
+
+            del self._deadlines[host_name]
+            log.fatal(bold('[{}] [amaltheia] Killed worker {}'.format(
+                host_name, pid)))
+            self.submit(pool, 'restore_item', host_name, results)
+
+    def wait_result(self, pool, running, results, done):
+        """Waits for the next HostResult of a host in @running, checking
+        deadlines while waiting. Returns None when new hosts were
+        discovered in the meantime"""
+        while True:
+            try:
+                result = results.get(timeout=1 if self._deadlines else None)
+            except queue.Empty:
+                self.check_deadlines(pool, running, results)
+                continue
+
+            # woken up by the discovery thread, see start_discovery()
+            if result is None:
+                return None
+
+            if self.accept_result(result, running, done):
+                return result
+
+    def accept_result(self, result, running, done):
+        """False for results of hosts that are not in @running, or already
+        @done (e.g. late results of killed workers)"""
+        return result.host_name in running and result.host_name not in (
+            r.host_name for r in done)
+
+    def concurrency(self):
+        """Returns number of hosts that may be in progress at the same time.
+        Subclasses can override this to adapt it during execution"""
+        return self.nparallel
+
+    def next_host(self):
+        """Returns next (host_name, host_args) to start, or None if no host
+        can be started right now. Subclasses can override this, along with
+        host_done() and unscheduled(), to control the order of hosts. The
+        default is to start hosts in the order they are discovered"""
+        if not hasattr(self, '_next_hosts'):
+            self._next_hosts = self.iter_hosts()
+
+        return next(self._next_hosts, None)
+
+    def host_done(self, result):
+        """Called in the main process with the @result of each host"""
+        pass
+
+    def unscheduled(self):
+        """Returns list of (host_name, reason) for hosts that were not
+        started when execution finished"""
+        return []
+
+    def start_hosts(self, pool, items, running, results):
+        """Start processing (host_name, host_args) @items in @pool. With
+        "batch-services", services of all @items are evacuated at once"""
+        batched, failed = {}, {}
+        if self.coordinator is not None and items:
+            batched, failed = self.coordinator.evacuate(items)
+
+        for host_name, host_args in items:
+            if host_name in failed:
+                result = HostResult(
+                    host_name=host_name, evacuated=False, failed=1)
+                self.results.append(result)
+                self.host_done(result)
+                continue
+
+            running[host_name] = (host_args, batched.get(host_name, []))
+            self.submit(pool, 'execute_item', host_name, results)
+
+            backstop = self.backstop(host_args)
+            if backstop is not None:
+                self._deadlines[host_name] = time.monotonic() + backstop
+
+    def submit(self, pool, method, host_name, results):
+        """Runs @method ("execute_item" or "restore_item") for @host_name in
+        @pool. Arguments of hosts that the workers already know are not
+        sent, see _run_task()"""
+        host_args, batched = self._running[host_name]
+        if host_name in self._shared:
+            host_args = None
+
+        self._task = getattr(self, '_task', 0) + 1
+        self._tasks[host_name] = self._task
+
+        pool.apply_async(
+            _run_task, (method, host_name, host_args, batched, self._task),
+            callback=partial(self.put_result, results),
+            error_callback=partial(self.on_error, results, host_name))
+
+    def put_result(self, results, compact):
+        results.put(HostResult.from_compact(compact))
+
+    def on_error(self, results, host_name, e):
+        log.fatal(bold('[{}] [amaltheia] Worker error: {}'.format(
+            host_name, e)))
+        results.put(HostResult(host_name=host_name, exception=True))
+
+    def finish_hosts(self, done, running):
+        """Handle list of HostResult @done. With "batch-services", any
+        services that were evacuated together are restored at once"""
+        if self.coordinator is not None and done:
+            failed = self.coordinator.restore(
+                [(r.host_name, running[r.host_name][0]) for r in done],
+                {r.host_name: running[r.host_name][1] for r in done})
+
+            for result in done:
+                if result.host_name in failed:
+                    result.restored = False
+                    result.failed += 1
+
+        for result in done:
+            running.pop(result.host_name, None)
+            self.results.append(result)
+            self.host_done(result)
+
+        self.log_progress(self.concurrency())
+
     def execute(self):
-        with multiprocessing.Pool(processes=self.nparallel) as p:
-            self.results = p.map(self.execute_one, self.hosts)
+        results = queue.Queue()
+        running, done = {}, []
+
+        # with "waves", batches of hosts start and finish together
+        waves = self.strategy_args.get('waves')
+
+        self.coordinator = None
+        if self.strategy_args.get('batch-services'):
+            self.coordinator = ServiceCoordinator(self.services)
+
+        # data shared by all hosts is retrieved once, before forking workers
+        prepare_services(self.services)
+
+        # workers report the task they are working on, see check_deadlines()
+        self._limits = self.phase_limits()
+        self._slots = WorkerSlots(self.nparallel, self._limits)
+        self._tasks, self._deadlines = {}, {}
+
+        # hosts discovered so far are handed to the workers once, along
+        # with the strategy
+        self._running = running
+        self._shared = set(self._hosts)
+
+        with multiprocessing.Pool(
+                processes=self.nparallel, initializer=_init_worker,
+                initargs=(self._limits, self._slots, self)) as p:
+            # the rest of the hosts are discovered while the first ones are
+            # running, the thread starts after the workers have been forked
+            self.start_discovery(partial(results.put, None))
 
+            while True:
+                items, discovering = [], False
+                while not (waves and running) and (
+                        len(running) + len(items) < self.concurrency()):
+                    if not self.discovery_ready():
+                        discovering = True
+                        break
 
-strategies = {
+                    item = self.next_host()
+                    if item is None:
+                        break
+
+                    items.append(item)
+
+                self.start_hosts(p, items, running, results)
+                if not running and not discovering:
+                    # hosts whose batch failed are already finished, keep
+                    # starting hosts until there are no more
+                    if items:
+                        continue
+                    break
+
+                # collect all results that are available
+                result = self.wait_result(p, running, results, done)
+                if result is None:
+                    continue
+
+                done.append(result)
+                while True:
+                    try:
+                        result = results.get_nowait()
+                    except queue.Empty:
+                        break
+
+                    if result is not None and self.accept_result(
+                            result, running, done):
+                        done.append(result)
+
+                if waves and len(done) < len(running):
+                    continue
+
+                self.finish_hosts(done, running)
+                done = []
+
+        for host_name, reason in self.unscheduled():
+            log.fatal(bold('[{}] [amaltheia] Skipped: {}'.format(
+                host_name, reason)))
+            self.results.append(
+                HostResult(host_name=host_name, skipped=reason))
+
+
+strategies = Registry('amaltheia.strategies', {
     'serial': SerialStrategy,
-    'parallel': ParallelStrategy
-}
+    'parallel': ParallelStrategy,
+    'dag': 'amaltheia.dag:DagStrategy',
+    'capacity': 'amaltheia.capacity:CapacityStrategy',
+    'rolling': 'amaltheia.rolling:RollingStrategy',
+    'canary': 'amaltheia.canary:CanaryStrategy',
+    'adaptive': 'amaltheia.adaptive:AdaptiveStrategy',
+    'distributed': 'amaltheia.distributed:DistributedStrategy',
+})
 
 
-def run_strategy(job):
+def create_strategy(job):
+    """Discovers the hosts of @job, runs any pre-flight checks and returns
+    the strategy that will process them"""
     # TODO: this needs to change for strategy configuration
     strategy_name, strategy_args = str_or_dict(job['strategy'])
 
-    hosts = discover(job)
     if config.list_hosts:
-        log.info(json.dumps(hosts, indent=2))
+        log.info(json.dumps(discover(job), indent=2))
         exit(0)
 
-    Strategy = strategies[strategy_name]
+    Strategy = strategies.get(strategy_name)
+    if Strategy is None:
+        log.fatal('[amaltheia] Unknown strategy {}, available: {}'.format(
+            strategy_name, ', '.join(strategies.names())))
+        exit(-1)
+
+    # re-ordering hosts, incremental runs and pre-flight checks require the
+    # complete inventory
+    order = strategy_args.get('order', 'as-discovered')
+    preflight_args = job.get('preflight')
+    streaming = (Strategy.streaming and order == 'as-discovered'
+                 and not preflight_args and not config.incremental)
+
+    if streaming:
+        hosts = iter_discover(job)
+    else:
+        hosts = order_hosts(discover(job), order)
+
+    results = []
+    if config.incremental:
+        hosts, results = changed_hosts(
+            hosts, job, StateStore(config.state_file),
+            config.incremental_keys)
+
+    if preflight_args:
+        hosts, checked = preflight(
+            hosts, preflight_args if isinstance(preflight_args, dict) else {})
+        results.extend(checked)
+
     s = Strategy(hosts, job['services'], job['updates'], strategy_args)
+    s.job_config = job.get('config') or {}
+    s.results.extend(results)
+
+    if streaming:
+        log.info('[amaltheia] Strategy: {} with streaming discovery'.format(
+            s.name))
+    else:
+        log.info('[amaltheia] Strategy: {} with {} hosts'.format(
+            s.name, len(hosts)))
+
+    return s
+
 
-    log.info('[amaltheia] Strategy: {} with {} hosts'.format(
-        s.name, len(hosts)))
+def save_state(job, s):
+    """Records the results of strategy @s in the state file, see
+    amaltheia.state"""
+    hosts = s.hosts
+    store = StateStore(config.state_file)
+    store.update(s.results, {
+        host_name: fingerprint(job, host_args, config.incremental_keys)
+        for host_name, host_args in hosts.items()})
+    store.save()
+
+
+def save_history(s, started):
+    """Appends the results of strategy @s to the history database"""
+    history = History(config.history_db)
+    try:
+        history.record(started, time.time(), s.name, s.results)
+    finally:
+        history.close()
+
+
+def run_strategy(job, created=None):
+    """Runs @job. @created is called with the strategy before it starts"""
+    started = time.time()
+    s = create_strategy(job)
+    if created is not None:
+        created(s)
 
     s.execute()
+    if config.state_file:
+        save_state(job, s)
+    if config.history_db:
+        save_history(s, started)
 
     s.output_stats()
+
+    # hosts that were discovered before the error have been processed
+    if s.discovery_error is not None:
+        raise s.discovery_error
+
+    return s
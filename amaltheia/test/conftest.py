@@ -0,0 +1,12 @@
+import pytest
+
+from amaltheia.config import config
+
+
+@pytest.fixture
+def restore_config():
+    """Restores configuration options changed by the test"""
+    entries = dict(config._entries)
+    yield
+    config._entries.clear()
+    config._entries.update(entries)
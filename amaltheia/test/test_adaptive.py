@@ -0,0 +1,81 @@
+from collections import OrderedDict
+
+from amaltheia.adaptive import AIMDController, AdaptiveStrategy
+from amaltheia.update import Updater, updaters
+
+
+class FailUpdater(Updater):
+    """Fails for hosts with the "fail" host argument"""
+    def update(self):
+        return not self.host_args.get('fail')
+
+
+class TracedStrategy(AdaptiveStrategy):
+    """Records the concurrency after each host and the hosts in progress
+    after each scheduling round"""
+    def start_hosts(self, pool, items, running, results):
+        super(TracedStrategy, self).start_hosts(pool, items, running, results)
+        self.events.append(('running', len(running)))
+
+    def host_done(self, result):
+        super(TracedStrategy, self).host_done(result)
+        self.events.append((result.host_name, self.controller.concurrency))
+
+
+class TestAIMDController:
+
+    def test_additive_increase(self):
+        c = AIMDController(minimum=1, maximum=10)
+        for _ in range(3):
+            c.healthy()
+        assert c.concurrency == 2
+
+    def test_maximum(self):
+        c = AIMDController(minimum=1, maximum=2, start=2)
+        for _ in range(10):
+            c.healthy()
+        assert c.concurrency == 2
+
+    def test_multiplicative_decrease(self):
+        c = AIMDController(minimum=1, maximum=10, start=8)
+        assert c.unhealthy(c.start())
+        assert c.concurrency == 4
+
+    def test_decrease_once_per_window(self):
+        c = AIMDController(minimum=1, maximum=10, start=8)
+        first, second = c.start(), c.start()
+        assert c.unhealthy(first)
+        assert not c.unhealthy(second)
+        assert c.unhealthy(c.start())
+        assert c.concurrency == 2
+
+    def test_minimum(self):
+        c = AIMDController(minimum=2, maximum=10, start=2)
+        c.unhealthy(c.start())
+        assert c.concurrency == 2
+
+
+class TestAdaptiveStrategy:
+
+    def test_execute(self, monkeypatch):
+        monkeypatch.setitem(updaters._entries, 'fail', FailUpdater)
+        hosts = OrderedDict([('fail', {'fail': True})])
+        hosts.update(('host{}'.format(i), {}) for i in range(15))
+        s = TracedStrategy(hosts, [], ['fail'], {
+            'nparallel': 4, 'start': 2, 'increase': 0.5})
+        s.events = []
+        s.execute()
+
+        assert sorted(r.host_name for r in s.results) == sorted(hosts)
+        events = s.events
+        assert events[0] == ('running', 2)
+
+        # the failure halves concurrency, only one host runs after it
+        failed = events.index(('fail', 1))
+        running = [n for name, n in events[failed:] if name == 'running']
+        assert running[0] == 1
+
+        # healthy hosts grow it again
+        assert max(n for name, n in events[failed:]
+                   if name not in ('fail', 'running')) >= 3
+        assert max(running) >= 3
@@ -0,0 +1,71 @@
+from amaltheia.canary import CanaryStrategy, check_gate
+from amaltheia.results import HostResult, percentile
+from amaltheia.update import Updater, updaters
+
+
+class FailUpdater(Updater):
+    """Fails for hosts with the "fail" host argument"""
+    def update(self):
+        return not self.host_args.get('fail')
+
+
+def result(failed=0, **durations):
+    return HostResult(host_name='host', failed=failed, durations=durations)
+
+
+class TestCheckGate:
+
+    def test_success_rate(self):
+        results = [result(), result(failed=1)]
+        assert check_gate(results, [], success_rate=1.0) is not None
+        assert check_gate(results, [], success_rate=0.5) is None
+
+    def test_durations(self):
+        baseline = [result(update=10)]
+        assert check_gate([result(update=15)], baseline,
+                          duration_ratio=2) is None
+        assert check_gate([result(update=25)], baseline,
+                          duration_ratio=2) is not None
+
+    def test_durations_per_phase(self):
+        baseline = [result(update=10, restore=1)]
+        results = [result(update=10, restore=5)]
+        assert check_gate(results, baseline,
+                          duration_ratio={'update': 2}) is None
+        assert check_gate(results, baseline,
+                          duration_ratio={'restore': 2}) is not None
+
+
+class TestCanaryStrategy:
+
+    def run(self, monkeypatch, hosts):
+        monkeypatch.setitem(updaters._entries, 'fail', FailUpdater)
+        s = CanaryStrategy(hosts, [], ['fail'], {'nparallel': 4})
+        s.execute()
+        return {r.host_name: r for r in s.results}
+
+    def test_failed_canary(self, monkeypatch):
+        results = self.run(monkeypatch, {
+            'a': {'fail': True}, 'b': {}, 'c': {}, 'd': {}})
+
+        assert results['a'].failed == 1
+        for host_name in ('b', 'c', 'd'):
+            assert results[host_name].skipped.startswith(
+                'canary gate failed: 0 of 1 hosts succeeded')
+
+    def test_steps(self, monkeypatch):
+        results = self.run(monkeypatch, {
+            'a': {}, 'b': {}, 'c': {}, 'd': {'fail': True}, 'e': {}})
+
+        # steps of 1, 2 and 2 (of 4) hosts, only the last one fails
+        assert sorted(results) == ['a', 'b', 'c', 'd', 'e']
+        assert [results[h].updated for h in 'abce'] == [1, 1, 1, 1]
+        assert results['d'].failed == 1
+
+
+class TestPercentile:
+
+    def test_percentile(self):
+        assert percentile([], 50) is None
+        assert percentile([3, 1, 2], 50) == 2
+        assert percentile(range(1, 101), 95) == 95
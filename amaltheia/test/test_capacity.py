@@ -0,0 +1,133 @@
+import amaltheia.capacity
+from amaltheia.capacity import (
+    CapacityStrategy, check_capacity, hypervisor_stats)
+from amaltheia.results import HostResult
+
+
+def stats(*used, zone='az1'):
+    return {
+        '{}-c{}'.format(zone, i): {
+            'zone': zone,
+            'used': {'ram': u},
+            'total': {'ram': 100.0},
+        }
+        for i, u in enumerate(used)
+    }
+
+
+class TestCheckCapacity:
+
+    def test_fits(self):
+        assert check_capacity(stats(60, 60, 10, 10), {'az1-c0', 'az1-c1'},
+                              headroom=0.1) is None
+
+    def test_headroom(self):
+        assert check_capacity(stats(60, 60, 10, 10), {'az1-c0', 'az1-c1'},
+                              headroom=0.5) is not None
+
+    def test_too_many(self):
+        draining = {'az1-c0', 'az1-c1', 'az1-c2'}
+        assert check_capacity(stats(60, 60, 10, 10), draining,
+                              headroom=0) is not None
+
+    def test_zones(self):
+        s = stats(90, 90)
+        s.update(stats(10, 10, zone='az2'))
+        assert check_capacity(s, {'az1-c0'}, headroom=0) is not None
+
+    def test_allocation_ratio(self):
+        assert check_capacity(stats(90, 90), {'az1-c0'}, headroom=0,
+                              ratios={'ram': 2}) is None
+
+    def test_min_up(self):
+        assert check_capacity(stats(0, 0, 0, 0), {'az1-c0', 'az1-c1'},
+                              min_up=0.75) is not None
+
+    def test_hypervisor_stats(self):
+        result = hypervisor_stats(
+            {'c0.domain': {'Memory MB Used': 10, 'Memory MB': 100}},
+            {'c0': 'az1'})
+        assert result == {'c0.domain': {
+            'zone': 'az1', 'used': {'ram': 10.0}, 'total': {'ram': 100.0}}}
+
+
+class TestCapacityStrategy:
+
+    def strategy(self, monkeypatch, hosts, **args):
+        self.calls = 0
+        self.fail = False
+
+        def hypervisors():
+            self.calls += 1
+            if self.fail:
+                raise OSError('nova unreachable')
+            return {'c{}.cloud'.format(i): {
+                'Memory MB Used': 40, 'Memory MB': 100} for i in range(4)}
+
+        monkeypatch.setattr(amaltheia.capacity, 'nova_hypervisors',
+                            hypervisors)
+        monkeypatch.setattr(amaltheia.capacity, 'nova_zones', lambda: {
+            'c{}'.format(i): 'az1' for i in range(4)})
+
+        args.setdefault('headroom', 0)
+        return CapacityStrategy(hosts, [], [], dict(args, nparallel=4))
+
+    def started(self, s):
+        result = []
+        item = s.next_host()
+        while item is not None:
+            result.append(item[0])
+            item = s.next_host()
+
+        return result
+
+    def test_schedule(self, monkeypatch):
+        s = self.strategy(monkeypatch, {
+            'c0': {}, 'c1.cloud': {}, 'c2': {}, 'c3': {}, 'other': {}})
+
+        # 160 MB used in total, 2 hypervisors of 100 MB must stay up
+        assert self.started(s) == ['c0', 'c1.cloud', 'other']
+        s.host_done(HostResult(host_name='other'))
+        assert self.started(s) == []
+        assert self.calls == 1
+
+        s.host_done(HostResult(host_name='c0'))
+        assert self.started(s) == ['c2']
+        assert self.calls == 2
+        assert [h for h, _ in s.unscheduled()] == ['c3']
+
+    def test_fix_hostname(self, monkeypatch):
+        rendered = []
+
+        def jinja(template, **kwargs):
+            rendered.append(kwargs['host'])
+            return kwargs['host_args']['hypervisor']
+
+        monkeypatch.setattr(amaltheia.capacity, 'jinja', jinja)
+        s = self.strategy(monkeypatch, {
+            'a': {'hypervisor': 'c0'}, 'b': {'hypervisor': 'c1'},
+            'c': {'hypervisor': 'c2'}}, **{'fix-hostname': '{{ x }}'})
+
+        assert self.started(s) == ['a', 'b']
+        assert s.hypervisor('c') == 'c2.cloud'
+        assert sorted(rendered) == ['a', 'b', 'c']
+
+    def test_stats_unavailable(self, monkeypatch):
+        s = self.strategy(monkeypatch, {'c0': {}, 'c1': {}, 'other': {}})
+        self.fail = True
+
+        # without any stats, nothing is started
+        assert self.started(s) == []
+        assert s.unscheduled() == [
+            (h, 'hypervisor stats unavailable') for h in ('c0', 'c1', 'other')]
+
+    def test_stats_failed_refresh(self, monkeypatch):
+        s = self.strategy(monkeypatch, {
+            'c0': {}, 'c1': {}, 'c2': {}, 'c3': {}})
+        assert self.started(s) == ['c0', 'c1']
+
+        # the last known stats are still used
+        self.fail = True
+        s.host_done(HostResult(host_name='c0'))
+        assert self.calls == 2
+        assert self.started(s) == ['c2']
@@ -0,0 +1,38 @@
+from amaltheia.utils import OutputCapture
+
+
+class TestOutputCapture:
+
+    def test_lines(self):
+        c = OutputCapture('host', 'cmd')
+        c.feed('stdout', b'hel')
+        c.feed('stdout', b'lo\nworld\n')
+        c.close()
+        assert c.stdout == 'hello\nworld\n'
+        assert c.stderr == ''
+
+    def test_incomplete_line(self):
+        c = OutputCapture('host', 'cmd')
+        c.feed('stderr', b'error')
+        c.close()
+        assert c.stderr == 'error\n'
+
+    def test_bounded(self):
+        c = OutputCapture('host', 'cmd', max_lines=2)
+        c.feed('stdout', b'1\n2\n3\n4\n')
+        c.close()
+        assert c.stdout == '3\n4\n'
+        assert c.total['stdout'] == 4
+
+    def test_split_utf8(self):
+        c = OutputCapture('host', 'cmd')
+        c.feed('stdout', b'\xce')
+        c.feed('stdout', b'\xb1\n')
+        c.close()
+        assert c.stdout == 'α\n'
+
+    def test_spill(self, tmpdir):
+        c = OutputCapture('host', 'cmd', max_lines=1, spill_dir=str(tmpdir))
+        c.feed('stdout', b'1\n2\n')
+        c.close()
+        assert 'stdout: 1\nstdout: 2\n' in tmpdir.join('host.out').read()
@@ -0,0 +1,103 @@
+import pytest
+
+from amaltheia.dag import DagScheduler, DagStrategy
+
+
+def run_all(scheduler, fail=()):
+    """Start hosts until none can start, then finish them. Returns list of
+    host waves"""
+    waves = []
+    while True:
+        wave = []
+        host_name = scheduler.next()
+        while host_name is not None:
+            wave.append(host_name)
+            host_name = scheduler.next()
+
+        if not wave:
+            return waves
+
+        waves.append(wave)
+        for host_name in wave:
+            scheduler.finish(host_name, host_name not in fail)
+
+
+class TestDagScheduler:
+
+    def test_no_constraints(self):
+        s = DagScheduler({'a': {}, 'b': {}, 'c': {}})
+        assert run_all(s) == [['a', 'b', 'c']]
+
+    def test_group_after(self):
+        s = DagScheduler({
+            'c1': {'group': 'compute'},
+            's1': {'group': 'storage'},
+            's2': {'group': 'storage'},
+        }, groups={'compute': {'after': ['storage']}})
+        assert run_all(s) == [['s1', 's2'], ['c1']]
+
+    def test_max_parallel(self):
+        s = DagScheduler({
+            'ctl1': {'group': 'controller'},
+            'ctl2': {'group': 'controller'},
+            'c1': {},
+        }, groups={'controller': {'max-parallel': 1}})
+        assert run_all(s) == [['ctl1', 'c1'], ['ctl2']]
+
+    def test_exclusive(self):
+        s = DagScheduler({
+            'ha1': {}, 'ha2': {}, 'ha3': {'exclusive-with': ['ha1']},
+        }, exclusive=[['ha1', 'ha2']])
+        assert run_all(s) == [['ha1'], ['ha2', 'ha3']]
+
+    def test_host_after(self):
+        s = DagScheduler({'a': {'after': 'b'}, 'b': {}})
+        assert run_all(s) == [['b'], ['a']]
+
+    def test_failed_dependency(self):
+        s = DagScheduler({'a': {'after': 'b'}, 'b': {}, 'c': {}})
+        assert run_all(s, fail=['b']) == [['b', 'c']]
+        assert s.unscheduled() == [('a', 'failed dependencies b')]
+
+    def test_cycle(self):
+        with pytest.raises(ValueError, match='cycle between hosts a, b$'):
+            DagScheduler({'a': {'after': 'b'}, 'b': {'after': 'a'}, 'c': {},
+                          'd': {'after': 'a'}})
+
+    def test_unknown_target(self):
+        with pytest.raises(ValueError, match='unknown host or group storge'):
+            DagScheduler({'c1': {'after': 'storge'}, 's1': {
+                'group': 'storage'}})
+
+        # groups without hosts may be declared
+        s = DagScheduler({'c1': {'after': 'storage'}},
+                         groups={'storage': {'max-parallel': 1}})
+        assert run_all(s) == [['c1']]
+
+    def test_strategy_checks_first(self):
+        s = DagStrategy({'a': {'after': 'b'}, 'b': {'after': 'a'}}, [],
+                        ['dummy'], {})
+        with pytest.raises(ValueError):
+            s.execute()
+
+        assert s.results == []
+
+    def test_inventory_order(self):
+        s = DagScheduler({
+            'a': {'after': 'c'}, 'b': {}, 'c': {}, 'd': {'after': 'b'}})
+        assert run_all(s) == [['b', 'c'], ['a', 'd']]
+
+    def test_run_failed_dependencies(self):
+        s = DagScheduler({'a': {'after': 'b'}, 'b': {}},
+                         skip_failed_dependencies=False)
+        assert run_all(s, fail=['b']) == [['b'], ['a']]
+
+    def test_large(self):
+        hosts = {'ctl{}'.format(i): {'group': 'ctl'} for i in range(500)}
+        hosts.update({'c{}'.format(i): {'group': 'compute', 'after': 'ctl'}
+                      for i in range(500)})
+        s = DagScheduler(hosts, groups={'ctl': {'max-parallel': 100}})
+
+        waves = run_all(s)
+        assert [len(wave) for wave in waves] == [100] * 5 + [500]
+        assert s.unmet == {host_name: 0 for host_name in hosts}
@@ -0,0 +1,117 @@
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+
+import amaltheia.log as log
+from amaltheia.results import HostResult
+from amaltheia.strategy import ParallelStrategy, WorkerSlots, run_phase
+from amaltheia.update import Updater, updaters
+
+
+def slow():
+    time.sleep(5)
+    return True
+
+
+def swallow():
+    try:
+        time.sleep(5)
+    except Exception:
+        pass
+
+    return True
+
+
+class TestRunPhase:
+
+    def setup_method(self):
+        self.result = HostResult(host_name='host', durations={})
+
+    def test_no_timeout(self):
+        assert run_phase(self.result, 'update', 'dummy', lambda: True)
+        assert not hasattr(self.result, 'timed_out')
+        assert 'update' in self.result.durations
+
+    def test_timeout(self):
+        start = time.monotonic()
+        assert not run_phase(self.result, 'update', 'dummy', slow, 0.1)
+        assert time.monotonic() - start < 1
+        assert self.result.timed_out == 'update'
+
+    def test_timeout_swallowed(self):
+        assert not run_phase(self.result, 'evacuate', 'svc', swallow, 0.1)
+        assert self.result.timed_out == 'evacuate'
+
+    def test_expired(self):
+        assert not run_phase(self.result, 'update', 'dummy', slow, 0)
+        assert self.result.timed_out == 'update'
+
+
+class HangUpdater(Updater):
+    """Ignores the deadline of its phase, so that only killing its worker
+    can stop it"""
+    def update(self):
+        if self.host_args.get('hang'):
+            signal.signal(signal.SIGALRM, signal.SIG_IGN)
+            time.sleep(30)
+
+        return True
+
+
+class TestBackstop:
+
+    def test_kill(self, monkeypatch):
+        monkeypatch.setitem(updaters._entries, 'hang', HangUpdater)
+        hosts = {'stuck': {'hang': True, 'deadlines': {'host': 0.3}},
+                 'a': {}, 'b': {}}
+        s = ParallelStrategy(hosts, [], ['hang'], {
+            'nparallel': 2, 'limits': {'update': 1}, 'deadline-grace': 0.2})
+
+        # the update slot of the killed worker must be released, otherwise
+        # the other hosts wait forever. Workers only log through the queue,
+        # since pool workers that replace killed ones are forked by a thread
+        log.setup(logging.WARNING)
+        try:
+            thread = threading.Thread(target=s.execute, daemon=True)
+            thread.start()
+            thread.join(20)
+            assert not thread.is_alive()
+        finally:
+            log.shutdown()
+
+        results = {r.host_name: r for r in s.results}
+        assert sorted(results) == ['a', 'b', 'stuck']
+        assert results['stuck'].timed_out == 'host'
+        assert results['a'].updated == results['b'].updated == 1
+
+
+def busy_worker(slots, semaphore, ready):
+    slots.register()
+    assert slots.acquire('update', semaphore)
+    slots.set_task(5)
+    ready.set()
+    time.sleep(30)
+
+
+class TestWorkerSlots:
+
+    def test_kill(self):
+        semaphore = multiprocessing.BoundedSemaphore(1)
+        slots = WorkerSlots(2, ['update'])
+        ready = multiprocessing.Event()
+        worker = multiprocessing.Process(
+            target=busy_worker, args=(slots, semaphore, ready))
+        worker.start()
+        assert ready.wait(10)
+
+        # only the worker of the task is killed, and its slot is released
+        assert slots.kill(4, {'update': semaphore}) is None
+        assert worker.is_alive()
+        assert slots.kill(5, {'update': semaphore}) == worker.pid
+
+        worker.join(10)
+        assert worker.exitcode == -signal.SIGKILL
+        assert semaphore.acquire(False)
+        assert list(slots.pids) == [0, 0]
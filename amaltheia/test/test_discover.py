@@ -0,0 +1,78 @@
+import logging
+import time
+
+from amaltheia.config import config
+from amaltheia.discover import discover, iter_discover
+from amaltheia.strategy import ParallelStrategy
+
+JOB = {'hosts': [
+    {'static': ['a', {'b': {'n': 1}}, 'c']},
+    {'static': [{'b': {'n': 2}}, 'd']},
+]}
+
+
+class TestIterDiscover:
+
+    def test_hosts(self):
+        it = iter_discover(JOB)
+        assert next(it) == ('a', {})
+        assert list(it) == [('b', {'n': 1}), ('c', {}), ('d', {})]
+
+    def test_duplicates(self, caplog):
+        with caplog.at_level(logging.WARNING, logger='amaltheia'):
+            assert dict(iter_discover(JOB))['b'] == {'n': 1}
+            assert discover(JOB)['b'] == {'n': 2}
+
+        assert [r.getMessage() for r in caplog.records] == [
+            '[amaltheia] Host b found more than once, using the first one',
+            '[amaltheia] Host b found more than once, using the last one']
+
+    def test_limit_and_shard(self, restore_config):
+        config.load({'limit': '!c'})
+        assert [h for h, _ in iter_discover(JOB)] == ['a', 'b', 'd']
+
+        config.load({'limit': None})
+        shards = []
+        for shard in ('1/2', '2/2'):
+            config.load({'shard': shard})
+            shards.append([h for h, _ in iter_discover(JOB)])
+            assert sorted(shards[-1]) == sorted(discover(JOB))
+
+        assert sorted(shards[0] + shards[1]) == ['a', 'b', 'c', 'd']
+
+
+class TimedStrategy(ParallelStrategy):
+    """Records when the result of each host arrives"""
+    def host_done(self, result):
+        self.done_at[result.host_name] = time.monotonic()
+
+
+def slow_discovery(error=None):
+    yield 'a', {}
+    time.sleep(1)
+    yield 'b', {}
+    if error is not None:
+        raise error
+
+
+class TestStreamingDiscovery:
+
+    def test_slow_discovery(self):
+        s = TimedStrategy(slow_discovery(), [], ['dummy'], {'nparallel': 2})
+        s.done_at = {}
+        start = time.monotonic()
+        s.execute()
+
+        # "a" does not wait for the next host to be discovered
+        assert s.done_at['a'] - start < 0.8
+        assert sorted(r.host_name for r in s.results) == ['a', 'b']
+
+    def test_discovery_error(self, caplog):
+        s = ParallelStrategy(slow_discovery(RuntimeError('bad page')), [],
+                             ['dummy'], {'nparallel': 2})
+        s.execute()
+
+        assert sorted(r.host_name for r in s.results) == ['a', 'b']
+        assert all(r.updated == 1 for r in s.results)
+        assert str(s.discovery_error) == 'bad page'
+        assert 'Discovery failed' in caplog.text
@@ -0,0 +1,158 @@
+import multiprocessing
+import time
+
+from amaltheia.config import config
+from amaltheia.distributed import (
+    DistributedStrategy, WorkQueue, apply_config, process_host, run_worker)
+from amaltheia.results import HostResult
+from amaltheia.update import Updater, updaters
+
+
+calls = []
+
+
+class SleepUpdater(Updater):
+    def update(self):
+        calls.append(self.host)
+        time.sleep(0.1)
+        return True
+
+
+class LostQueue(object):
+    """Queue that fails to renew leases"""
+    lease = 0.03
+
+    def renew(self, job_id, host_name, worker):
+        return False
+
+
+def queue(tmp_path, lease=300):
+    return WorkQueue(str(tmp_path / 'queue.db'), lease=lease)
+
+
+class TestWorkQueue:
+
+    def test_claim_in_order(self, tmp_path):
+        q = queue(tmp_path)
+        job = q.create_job({})
+        for name in ('b', 'a', 'c'):
+            q.enqueue(job, name, {'name': name})
+
+        assert q.claim('w1') == (job, 'b', {'name': 'b'})
+        assert q.claim('w2') == (job, 'a', {'name': 'a'})
+        assert q.claim('w1') == (job, 'c', {'name': 'c'})
+        assert q.claim('w1') is None
+
+    def test_complete(self, tmp_path):
+        q = queue(tmp_path)
+        job = q.create_job({})
+        q.enqueue(job, 'a', {})
+        q.claim('w1')
+        assert q.remaining(job) == 1
+
+        q.complete(job, 'a', 'w1', HostResult(host_name='a', updated=1))
+        q.complete(job, 'a', 'w2', HostResult(host_name='a', failed=1))
+        assert q.remaining(job) == 0
+        [result] = q.results(job)
+        assert result.updated == 1 and result.failed == 0
+        assert q.results(job, known={'a'}) == []
+
+    def test_lease_expiry(self, tmp_path):
+        q = queue(tmp_path, lease=0.1)
+        job = q.create_job({}, max_attempts=2)
+        q.enqueue(job, 'a', {})
+
+        assert q.claim('dead')[1] == 'a'
+        assert q.claim('w2') is None
+        assert not q.renew(job, 'a', 'w2')
+
+        time.sleep(0.2)
+        assert q.claim('w2')[1] == 'a'
+        assert q.renew(job, 'a', 'w2')
+
+        time.sleep(0.2)
+        assert q.claim('w3') is None
+        assert q.expire(job, 2) == ['a']
+        assert q.results(job)[0].failed == 1
+
+    def test_finished_job(self, tmp_path):
+        q = queue(tmp_path)
+        job = q.create_job({})
+        q.enqueue(job, 'a', {})
+        q.finish_job(job)
+        assert q.claim('w1') is None
+
+
+class TestDistributedStrategy:
+
+    def test_execute(self, tmp_path):
+        path = str(tmp_path / 'queue.db')
+        hosts = {'host{}'.format(i): {} for i in range(4)}
+        s = DistributedStrategy(hosts, [], ['dummy'], {
+            'queue': path, 'poll-interval': 0.1})
+
+        # the worker waits for the job to be queued
+        workers = [multiprocessing.Process(target=run_worker, args=(path, ),
+                                           kwargs={'interval': 0.1})
+                   for _ in range(2)]
+        for w in workers:
+            w.start()
+
+        try:
+            s.execute()
+        finally:
+            for w in workers:
+                w.terminate()
+                w.join()
+
+        assert sorted(r.host_name for r in s.results) == sorted(hosts)
+        assert all(r.updated == 1 for r in s.results)
+
+    def test_done_while_reading_results(self, tmp_path, monkeypatch):
+        results = WorkQueue.results
+
+        def finish_all(q, job_id, known=()):
+            # a worker finishes all hosts right after results are read
+            done = results(q, job_id, known)
+            item = q.claim('w1')
+            while item is not None:
+                q.complete(job_id, item[1], 'w1', HostResult(
+                    host_name=item[1], updated=1))
+                item = q.claim('w1')
+
+            return done
+
+        monkeypatch.setattr(WorkQueue, 'results', finish_all)
+        s = DistributedStrategy({'a': {}, 'b': {}}, [], ['dummy'], {
+            'queue': str(tmp_path / 'queue.db'), 'poll-interval': 0.01})
+        s.execute()
+
+        assert sorted(r.host_name for r in s.results) == ['a', 'b']
+
+
+class TestWorker:
+
+    def test_lease_lost(self, monkeypatch):
+        monkeypatch.setitem(updaters._entries, 'sleep', SleepUpdater)
+        del calls[:]
+        job = {'services': [], 'updates': ['sleep', 'sleep'],
+               'strategy_args': {}}
+
+        assert process_host(LostQueue(), 1, job, 'a', {}, 'w1') is None
+        assert calls == ['a']
+
+    def test_config(self, restore_config):
+        config.load({'ssh-user': 'worker', 'ssh-output-lines': 5})
+        defaults = dict(config._entries)
+        job = {'config': {'ssh-user': 'job', 'ssh-jump-channels': 2},
+               'variables': {'x': 1}}
+
+        apply_config(job, defaults, {'ssh-user': 'override'})
+        assert config.ssh_user == 'override'
+        assert config.ssh_jump_channels == 2
+        assert config.ssh_output_lines == 5
+        assert config.variables == {'x': 1}
+
+        apply_config({}, defaults, {})
+        assert config.ssh_user == 'worker'
+        assert config.ssh_jump_channels == defaults['ssh_jump_channels']
@@ -0,0 +1,91 @@
+from amaltheia.history import (
+    History, estimate_remaining, format_duration, main)
+from amaltheia.ordering import order_hosts
+from amaltheia.results import HostResult
+from amaltheia.strategy import run_phase
+
+
+def result(host_name, evacuate, update, failed=0):
+    return HostResult(
+        host_name=host_name, failed=failed,
+        durations={'evacuate': evacuate, 'update': update},
+        steps=[('evacuate', 'nova-compute', evacuate),
+               ('update', 'apt', update)])
+
+
+def history(tmp_path):
+    h = History(str(tmp_path / 'history.db'))
+    for i in range(1, 4):
+        h.record(1000 * i, 1000 * i + 100, 'Parallel-2', [
+            result('fast', 10, 5 * i),
+            result('slow', 100, 50 * i, failed=int(i == 3)),
+            HostResult(host_name='skipped', skipped='nothing to do'),
+        ])
+
+    return h
+
+
+class TestHistory:
+
+    def test_host_stats(self, tmp_path):
+        h = history(tmp_path)
+        assert h.host_stats() == [('slow', 3, 200, 250), ('fast', 3, 20, 25)]
+        assert h.host_stats('update', runs=2) == [
+            ('slow', 2, 100, 150), ('fast', 2, 10, 15)]
+
+    def test_step_stats(self, tmp_path):
+        assert history(tmp_path).step_stats() == [
+            ('update', 'apt', 6, 15, 150, 150),
+            ('evacuate', 'nova-compute', 6, 10, 100, 100),
+        ]
+
+    def test_trend(self, tmp_path):
+        trend = history(tmp_path).trend(limit=2)
+        assert [row[0] for row in trend] == [2, 3]
+        assert trend[-1][3:7] == (1, 1, 1, 100)
+
+    def test_cost_order(self, tmp_path):
+        db = str(tmp_path / 'history.db')
+        history(tmp_path).close()
+        order = {'cost': {'source': {'history': {'db': db}}}}
+        hosts = {'new': {}, 'fast': {}, 'slow': {}}
+        assert list(order_hosts(hosts, order)) == ['slow', 'new', 'fast']
+        assert list(order_hosts(hosts, {'cost': {'source': {'history': {
+            'db': db, 'phase': 'evacuate'}}}})) == ['slow', 'new', 'fast']
+
+    def test_main(self, tmp_path, capsys):
+        history(tmp_path).close()
+        main(['-d', str(tmp_path / 'history.db'), 'steps'])
+        lines = capsys.readouterr().out.splitlines()
+        assert lines[0].split() == ['PHASE', 'NAME', 'COUNT', 'P50', 'P95',
+                                    'MAX']
+        assert lines[1].split() == ['update', 'apt', '6', '15.0s', '2m30s',
+                                    '2m30s']
+
+
+class TestEstimate:
+
+    def test_history(self):
+        assert estimate_remaining(
+            ['a', 'b'], {'a': 100, 'b': 300}, [], 2) == 200
+
+    def test_fallback(self):
+        assert estimate_remaining(['a', 'new'], {'a': 100}, [10, 20, 30],
+                                  1) == 120
+        assert estimate_remaining(['a'], {}, [], 1) is None
+
+    def test_format(self):
+        assert format_duration(4.25) == '4.2s'
+        assert format_duration(125) == '2m05s'
+        assert format_duration(3725) == '1h02m'
+
+
+class TestSteps:
+
+    def test_run_phase(self):
+        r = HostResult(host_name='host', durations={}, steps=[])
+        run_phase(r, 'update', 'apt', lambda: True)
+        run_phase(r, 'update', 'reboot', lambda: True)
+        assert [step[:2] for step in r.steps] == [
+            ('update', 'apt'), ('update', 'reboot')]
+        assert 'steps' not in str(r)
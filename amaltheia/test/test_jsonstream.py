@@ -0,0 +1,140 @@
+import io
+import json
+
+import pytest
+
+from amaltheia.discover import HttpDiscoverer
+from amaltheia.jsonstream import iter_items
+
+DOCUMENT = {
+    'count': 3,
+    'meta': {'note': 'brackets ] } and "quotes" \\ in strings', 'list': [
+        [1, 2, {'x': '['}], {}]},
+    'data': {
+        'skip': [{'results': 'not these'}],
+        'hosts': [
+            {'name': 'h1', 'ip': '10.0.0.1', 'tags': ['a', 'b']},
+            {'name': 'héà', 'ip': None, 'weight': 1.5e3},
+            12345,
+        ],
+    },
+    'byname': {'h1': {'ip': '10.0.0.1'}, 'h2': {'ip': '10.0.0.2'}},
+}
+
+
+class SplitFile(object):
+    """Returns @data in two reads, split at @offset"""
+    def __init__(self, data, offset):
+        self.parts = [data[:offset], data[offset:]]
+
+    def read(self, size):
+        return self.parts.pop(0) if self.parts else b''
+
+
+def items(document, path, chunk_size=65536, **kwargs):
+    data = json.dumps(document, **kwargs).encode()
+    return list(iter_items(io.BytesIO(data), path, chunk_size=chunk_size))
+
+
+class TestIterItems:
+
+    @pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 64, 65536])
+    def test_array(self, chunk_size):
+        expected = DOCUMENT['data']['hosts']
+        assert items(DOCUMENT, 'data.hosts', chunk_size) == expected
+        assert items(DOCUMENT, 'data.hosts', chunk_size, indent=2,
+                     ensure_ascii=False) == expected
+
+    @pytest.mark.parametrize('chunk_size', [1, 5, 65536])
+    def test_object(self, chunk_size):
+        assert items(DOCUMENT, 'byname', chunk_size) == [
+            {'key': 'h1', 'value': {'ip': '10.0.0.1'}},
+            {'key': 'h2', 'value': {'ip': '10.0.0.2'}},
+        ]
+
+    def test_top_level(self):
+        assert items([1, [2], {'a': 3}], '', 2) == [1, [2], {'a': 3}]
+        assert items([], '') == []
+        assert items({'results': {}}, 'results') == []
+
+    @pytest.mark.parametrize('number', [
+        '1.5', '-0.25', '10e10', '1E+2', '2.5e-3', '-12'])
+    def test_split_numbers(self, number):
+        data = '{{"count": {0}, "b": [{0}, {{"x": {0}}}, 2]}}'.format(
+            number).encode()
+        expected = [json.loads(number), {'x': json.loads(number)}, 2]
+        for offset in range(1, len(data)):
+            assert list(iter_items(SplitFile(data, offset), 'b')) == expected
+
+    def test_errors(self):
+        with pytest.raises(KeyError):
+            items(DOCUMENT, 'data.missing')
+        with pytest.raises(ValueError):
+            list(iter_items(io.BytesIO(b'{"results": [1, 2'), 'results'))
+
+    def test_bounded_buffer(self):
+        hosts = [{'name': 'host{}'.format(i), 'pad': 'x' * 100}
+                 for i in range(5000)]
+        data = json.dumps({'skipped': hosts, 'results': hosts}).encode()
+
+        it = iter_items(io.BytesIO(data), 'results', chunk_size=1024)
+        assert next(it) == hosts[0]
+        assert len(it.gi_frame.f_locals['reader'].buffer) < 4096
+        assert sum(1 for _ in it) == len(hosts) - 1
+
+
+class TestHttpDiscoverer:
+
+    def test_stream(self, monkeypatch):
+        document = {'results': [
+            {'name': 'h{}'.format(i), 'role': 'compute' if i % 2 else 'db'}
+            for i in range(6)]}
+        monkeypatch.setattr('urllib.request.urlopen', lambda request: (
+            io.BytesIO(json.dumps(document).encode())))
+
+        d = HttpDiscoverer({
+            'request': {'url': 'http://cmdb'},
+            'stream': 'results',
+            'match': [{'regex': 'compute', 'value': '{{ item.role }}'}],
+            'select': '!h5',
+            'parse': {'host-name': '{{ item.name }}',
+                      'host-args': {'role': '{{ item.role }}'}},
+        })
+        assert d.discover() == {'h1': {'role': 'compute'},
+                                'h3': {'role': 'compute'}}
+
+    def test_match_item(self, monkeypatch):
+        document = {'results': [
+            {'name': 'a', 'role': 'compute', 'want': 'comp'},
+            {'name': 'b', 'role': 'compute', 'want': 'db'},
+            {'name': 'c', 'role': 'db', 'want': '[db]'}]}
+        monkeypatch.setattr('urllib.request.urlopen', lambda request: (
+            io.BytesIO(json.dumps(document).encode())))
+
+        d = HttpDiscoverer({
+            'request': {'url': 'http://cmdb'},
+            'results': '{{ response.results }}',
+            'match': [
+                {'regex': '^{{ item.want }}', 'value': '{{ item.role }}'},
+                {'regex': '[a-c]', 'value': '{{ item.name }}'}],
+            'parse': {'host-name': '{{ item.name }}', 'host-args': {}},
+        })
+        assert list(d.discover()) == ['a', 'c']
+
+    def test_connection_closed(self, monkeypatch):
+        response = io.BytesIO(json.dumps({'results': [
+            {'name': 'h{}'.format(i), 'pad': 'x' * 100}
+            for i in range(100)]}).encode())
+        monkeypatch.setattr('urllib.request.urlopen', lambda request: (
+            response))
+        monkeypatch.setattr(HttpDiscoverer, 'spool_size', 1024)
+
+        d = HttpDiscoverer({
+            'request': {'url': 'http://cmdb'},
+            'stream': 'results',
+            'parse': {'host-name': '{{ item.name }}', 'host-args': {}},
+        })
+        hosts = d.iter_hosts()
+        assert next(hosts) == ('h0', {})
+        assert response.closed
+        assert len(list(hosts)) == 99
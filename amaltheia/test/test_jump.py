@@ -0,0 +1,78 @@
+import pytest
+
+import amaltheia.utils as utils
+from amaltheia.utils import _JumpChannel, _parse_jump_host, _ssh_client
+
+
+class FakeChannel:
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestJumpHost:
+
+    def test_parse(self):
+        assert _parse_jump_host('bastion') == (None, 'bastion', 22)
+        assert _parse_jump_host('me@bastion:2222') == ('me', 'bastion', 2222)
+        assert _parse_jump_host('[::1]:2222') == (None, '::1', 2222)
+
+    def test_parse_chain(self):
+        with pytest.raises(ValueError):
+            _parse_jump_host('a, me@b')
+
+    def test_release_once(self):
+        released = []
+        channel = _JumpChannel(FakeChannel(), lambda: released.append(1))
+        channel.close()
+        channel.close()
+        assert channel.closed
+        assert released == [1]
+
+
+class FakeTransport:
+    """Transport to jump host @name, recording the channels it opens"""
+    def __init__(self, name, opened):
+        self.name = name
+        self.opened = opened
+
+    def open_channel(self, kind, dest, src, timeout=None):
+        self.opened.append((self.name, dest))
+        return FakeChannel()
+
+
+class TestSSHClient:
+
+    @pytest.fixture
+    def opened(self, monkeypatch):
+        opened = []
+        monkeypatch.setattr(utils.JumpHost, 'transport', lambda self: (
+            FakeTransport(self.host_name, opened)))
+        monkeypatch.setitem(utils._jump_hosts, 'pid', None)
+        return opened
+
+    def test_direct(self, opened):
+        _, args = _ssh_client('target', {'ssh-jump-host': False})
+        assert 'sock' not in args
+        assert opened == []
+
+    def test_jump_host(self, opened):
+        _, args = _ssh_client('target', {'ssh-jump-host': 'me@b:2222'})
+        assert isinstance(args['sock'], _JumpChannel)
+        assert opened == [('b', ('target', 22))]
+
+        jump = utils.jump_host('me@b:2222', {})
+        assert (jump.user, jump.port) == ('me', 2222)
+        assert jump.host_args['ssh-jump-host'] is False
+
+    def test_chain(self, opened):
+        _, args = _ssh_client('target', {'ssh-jump-host': 'a, me@b:2222'})
+        assert opened == [('b', ('target', 22))]
+
+        # the last jump host is reached through the previous one
+        jump = utils.jump_host('a,me@b:2222', {})
+        assert jump.host_args['ssh-jump-host'] == 'a'
+        _, args = _ssh_client(jump.host_name, jump.host_args, port=jump.port)
+        assert opened[-1] == ('a', ('b', 2222))
+        assert utils.jump_host('a', {}).host_args['ssh-jump-host'] is False
@@ -0,0 +1,93 @@
+import logging
+import threading
+import time
+
+import pytest
+
+import amaltheia.strategy
+from amaltheia.strategy import ParallelStrategy, _limits, phase_limit
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    """Sets phase limits of the current process"""
+    def set_limits(values):
+        for key, limit in values.items():
+            monkeypatch.setitem(_limits, key, threading.BoundedSemaphore(
+                limit))
+
+    return set_limits
+
+
+def holding(phase, name, event):
+    """Holds a slot of @phase until @event is set"""
+    with phase_limit(phase, name):
+        event.wait()
+
+
+class TestPhaseLimits:
+
+    def test_parse(self, caplog):
+        s = ParallelStrategy({}, [], [], {'limits': {
+            'evacuate': 4, 'update': {'total': 3, 'reboot': 1},
+            'upgrade': 2}})
+
+        limits = s.phase_limits()
+        assert set(limits) == {'evacuate', 'update', ('update', 'reboot')}
+        assert [limits['update'].acquire(block=False)
+                for _ in range(4)] == [True, True, True, False]
+        assert 'Ignoring limits for unknown phase upgrade' in caplog.text
+
+    def test_unlimited(self):
+        with phase_limit('update', 'dummy') as sleep:
+            sleep(0)
+
+
+class TestPhaseLimit:
+
+    def test_name_limit(self, limits):
+        limits({('update', 'reboot'): 1})
+        done = threading.Event()
+        thread = threading.Thread(target=holding,
+                                  args=('update', 'reboot', done))
+        thread.start()
+        time.sleep(0.1)
+
+        # other update actions are not limited
+        with phase_limit('update', 'apt'):
+            pass
+
+        assert not _limits[('update', 'reboot')].acquire(timeout=0.1)
+        done.set()
+        thread.join()
+
+        with phase_limit('update', 'reboot'):
+            assert not _limits[('update', 'reboot')].acquire(blocking=False)
+
+    def test_released_on_error(self, limits):
+        limits({'evacuate': 1})
+        with pytest.raises(RuntimeError):
+            with phase_limit('evacuate', 'nova-compute'):
+                raise RuntimeError()
+
+        assert _limits['evacuate'].acquire(blocking=False)
+
+    def test_wait_warning(self, limits, monkeypatch, caplog):
+        limits({'restore': 1})
+        monkeypatch.setattr(amaltheia.strategy, 'SLOT_WAIT_WARNING', 0.1)
+        done = threading.Event()
+        thread = threading.Thread(target=holding,
+                                  args=('restore', 'nova-compute', done))
+        thread.start()
+        time.sleep(0.05)
+
+        threading.Timer(0.35, done.set).start()
+        with caplog.at_level(logging.WARNING, logger='amaltheia'):
+            with phase_limit('restore', 'nova-compute'):
+                pass
+
+        thread.join()
+        warnings = [r.getMessage() for r in caplog.records]
+        assert len(warnings) >= 2
+        assert warnings[0].startswith(
+            '[amaltheia] Still waiting for restore nova-compute slot after')
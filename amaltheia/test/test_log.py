@@ -0,0 +1,98 @@
+import json
+import logging
+import multiprocessing
+import sys
+
+import amaltheia.log as log
+from amaltheia.config import config
+from amaltheia.log import HostFileHandler, JsonFormatter, PlainFormatter
+from amaltheia.strategy import SerialStrategy
+
+
+def record(message, host=None):
+    r = logging.makeLogRecord({'msg': message, 'levelname': 'INFO',
+                               'name': 'amaltheia'})
+    r.host = host
+    return r
+
+
+def log_from_worker(host_name):
+    log.set_host(host_name)
+    log.info('\x1b[1mworker\x1b[22m')
+
+
+class TestFormatters:
+
+    def test_plain(self):
+        assert PlainFormatter('%(msg)s').format(
+            record('\x1b[1mbold\x1b[22m')) == 'bold'
+
+    def test_json(self):
+        data = json.loads(JsonFormatter().format(record('\x1b[1mx', 'h1')))
+        assert data['message'] == 'x'
+        assert data['host'] == 'h1'
+        assert data['level'] == 'INFO'
+
+
+class TestHostFileHandler:
+
+    def test_files(self, tmp_path):
+        handler = HostFileHandler(str(tmp_path), max_open=2)
+        handler.setFormatter(PlainFormatter('%(msg)s'))
+
+        for i in range(3):
+            for host in ('a', 'b', 'c', 'd/e'):
+                handler.emit(record('{} {}'.format(host, i), host))
+            handler.emit(record('no host'))
+
+            assert len(handler.handlers) == 2
+
+        handler.close()
+        assert sorted(p.name for p in tmp_path.iterdir()) == [
+            'a.log', 'b.log', 'c.log', 'd_e.log']
+        assert (tmp_path / 'a.log').read_text().splitlines() == [
+            'a 0', 'a 1', 'a 2']
+
+
+class TestSetup:
+
+    def test_sinks(self, tmp_path):
+        json_file = str(tmp_path / 'log.json')
+        log.setup(logging.INFO, json_file=json_file,
+                  host_dir=str(tmp_path / 'hosts'))
+        try:
+            log.info('main')
+            worker = multiprocessing.Process(
+                target=log_from_worker, args=('host1', ))
+            worker.start()
+            worker.join()
+        finally:
+            log.shutdown()
+
+        lines = [json.loads(line) for line in open(json_file)]
+        assert [(x['host'], x['message']) for x in lines] == [
+            (None, 'main'), ('host1', 'worker')]
+        assert (tmp_path / 'hosts' / 'host1.log').read_text().endswith(
+            'INFO worker\n')
+
+    def test_host_reset(self, tmp_path):
+        log.setup(logging.INFO, host_dir=str(tmp_path))
+        try:
+            SerialStrategy({'host1': {}}, [], ['dummy'], {}).execute()
+            log.info('main')
+        finally:
+            log.shutdown()
+
+        assert 'main' not in (tmp_path / 'host1.log').read_text()
+
+    def test_colorama(self, monkeypatch):
+        monkeypatch.delitem(sys.modules, 'colorama', raising=False)
+        monkeypatch.setitem(config._entries, 'color', False)
+        log.setup(logging.INFO)
+        log.shutdown()
+        assert 'colorama' not in sys.modules
+
+        monkeypatch.setitem(config._entries, 'color', True)
+        log.setup(logging.INFO)
+        log.shutdown()
+        assert 'colorama' in sys.modules
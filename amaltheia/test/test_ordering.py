@@ -0,0 +1,70 @@
+from collections import OrderedDict
+
+from amaltheia.ordering import find_hypervisor, order_hosts
+
+HOSTS = {'c': {'cost': 1}, 'a': {'cost': 3}, 'b': {}}
+
+
+def order(spec, hosts=HOSTS):
+    return list(order_hosts(hosts, spec))
+
+
+class TestOrderHosts:
+
+    def test_simple(self):
+        assert order('as-discovered') == ['c', 'a', 'b']
+        assert order('name') == ['a', 'b', 'c']
+        assert order({'random': {'seed': 1}}) == order(
+            {'random': {'seed': 1}})
+        assert sorted(order('random')) == ['a', 'b', 'c']
+
+        # dictionaries keep no order before Python 3.7
+        assert isinstance(order_hosts(HOSTS, 'name'), OrderedDict)
+
+    def test_host_args(self):
+        assert order({'cost': {'source': 'host-args'}}) == ['a', 'c', 'b']
+        assert order_hosts(HOSTS, {'cost': {'source': 'host-args'}}) == (
+            HOSTS)
+
+    def test_unknown(self):
+        assert order('size') == ['c', 'a', 'b']
+        assert order({'cost': {'source': 'nvoa'}}) == ['c', 'a', 'b']
+
+    def test_nova_vms(self, monkeypatch):
+        calls = []
+
+        def openstack_cmd_json(cmd):
+            calls.append(cmd)
+            return [{'Host': 'c.cloud'}, {'Host': 'a.cloud'},
+                    {'Host': 'c.cloud'}, {'Host': None}]
+
+        monkeypatch.setattr('amaltheia.ordering.openstack_cmd_json',
+                            openstack_cmd_json)
+        assert order({'cost': {'source': {
+            'nova': {'metric': 'vms'}}}}) == ['c', 'a', 'b']
+        assert len(calls) == 1
+
+    def test_nova_ram(self, monkeypatch):
+        monkeypatch.setattr(
+            'amaltheia.ordering.openstack_cmd_json', lambda cmd: [
+                {'Hypervisor Hostname': 'b', 'Memory MB Used': 100},
+                {'Hypervisor Hostname': 'a', 'Memory MB Used': 10}])
+        assert order({'cost': {'source': 'nova'}}) == ['b', 'a', 'c']
+
+    def test_estimate_failure(self, monkeypatch):
+        def openstack_cmd_json(cmd):
+            raise RuntimeError('no credentials')
+
+        monkeypatch.setattr('amaltheia.ordering.openstack_cmd_json',
+                            openstack_cmd_json)
+        assert order({'cost': {'source': 'nova'}}) == ['c', 'a', 'b']
+
+
+class TestFindHypervisor:
+
+    def test_short_names(self):
+        hypervisors = {'a.cloud': 1, 'b': 2}
+        assert find_hypervisor(hypervisors, 'a.cloud') == 1
+        assert find_hypervisor(hypervisors, 'a') == 1
+        assert find_hypervisor(hypervisors, 'b.other') == 2
+        assert find_hypervisor(hypervisors, 'c') is None
@@ -0,0 +1,84 @@
+import socket
+import time
+
+import pytest
+
+import amaltheia.preflight
+from amaltheia.preflight import preflight
+from amaltheia.utils import OutputCapture, _drain_channel
+
+HOSTS = {'down': {}, 'current': {}, 'old': {}, 'stuck': {}}
+
+
+class HungChannel(object):
+    """Channel of a command that never finishes"""
+    closed = eof_received = False
+
+    def __init__(self):
+        self.sockets = socket.socketpair()
+
+    def fileno(self):
+        return self.sockets[0].fileno()
+
+    def recv_ready(self):
+        return False
+
+    recv_stderr_ready = recv_ready
+
+
+@pytest.fixture
+def checks(monkeypatch):
+    """Fake ssh, running commands locally"""
+    commands = []
+
+    def ssh_cmd(host_name, host_args, cmd, timeout, command_timeout):
+        commands.append((host_name, cmd, command_timeout))
+        if host_name == 'stuck':
+            raise socket.timeout('command did not finish')
+        return '0' if host_name == 'current' else '3', ''
+
+    monkeypatch.setattr(amaltheia.preflight, 'ssh_try_connect',
+                        lambda host_name, host_args, timeout: True)
+    monkeypatch.setattr(amaltheia.preflight, 'check_tcp', lambda h, p, t: (
+        'tcp port 22: refused' if h == 'down' else None))
+    monkeypatch.setattr(amaltheia.preflight, 'ssh_cmd', ssh_cmd)
+    return commands
+
+
+class TestPreflight:
+
+    def test_results(self, checks):
+        remaining, results = preflight(HOSTS, {'nparallel': 2, 'check': {
+            'command': 'count {{ host }}', 'skip-if-stdout': '^0$',
+            'timeout': 10}})
+
+        assert list(remaining) == ['old', 'stuck']
+        assert [(r.host_name, r.failed, getattr(r, 'skipped', None))
+                for r in results] == [
+            ('down', 1, None), ('current', 0, 'nothing to do')]
+        assert sorted(checks) == [('current', 'count current', 10),
+                                  ('old', 'count old', 10),
+                                  ('stuck', 'count stuck', 10)]
+
+    def test_defaults(self, checks):
+        remaining, results = preflight(HOSTS, {
+            'tcp': False, 'check': {'command': 'true'}})
+        assert list(remaining) == list(HOSTS)
+        assert results == []
+        assert {c[2] for c in checks} == {60}
+
+
+class TestCommandTimeout:
+
+    def test_timeout(self):
+        channel = HungChannel()
+        start = time.monotonic()
+        try:
+            with pytest.raises(socket.timeout):
+                _drain_channel(channel, OutputCapture('host', 'sleep'),
+                               poll_interval=0.05, timeout=0.2)
+        finally:
+            for sock in channel.sockets:
+                sock.close()
+
+        assert time.monotonic() - start < 1
@@ -0,0 +1,24 @@
+from amaltheia.registry import Registry
+
+
+class TestRegistry:
+
+    def test_class(self):
+        r = Registry('amaltheia.test', {'a': dict})
+        assert r.get('a') is dict
+        assert r['a'] is dict
+
+    def test_lazy_string(self):
+        r = Registry('amaltheia.test', {'od': 'collections:OrderedDict'})
+        assert 'od' in r
+        from collections import OrderedDict
+        assert r.get('od') is OrderedDict
+
+    def test_missing(self):
+        r = Registry('amaltheia.test', {})
+        assert r.get('missing') is None
+        assert 'missing' not in r
+
+    def test_names(self):
+        r = Registry('amaltheia.test', {'b': dict, 'a': list})
+        assert r.names() == ['a', 'b']
@@ -0,0 +1,142 @@
+import threading
+import time
+
+import pytest
+
+from amaltheia.results import HostResult
+from amaltheia.retry import RetryPolicy
+from amaltheia.strategy import _limits, run_phase
+from amaltheia.update import update
+from amaltheia.utils import _record_command, clear_last_command, last_command
+
+
+class Flaky(object):
+    """Fails @failures times, running @args, then succeeds"""
+    def __init__(self, failures, args=None, exception=None):
+        self.failures = failures
+        self.args = args
+        self.exception = exception
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls > self.failures:
+            return True
+
+        if self.exception is not None:
+            raise self.exception
+
+        if self.args is not None:
+            update('host', {}, {'exec': {'args': self.args}})
+
+        return False
+
+
+def policy(**kwargs):
+    kwargs.setdefault('backoff', 0)
+    return RetryPolicy(kwargs)
+
+
+class TestRetryPolicy:
+
+    def test_no_retries(self):
+        func = Flaky(1)
+        assert not policy().run(func, 'host', 'update dummy')
+        assert func.calls == 1
+
+    def test_retries(self):
+        func = Flaky(2)
+        assert policy(retries=2).run(func, 'host', 'update dummy')
+        assert func.calls == 3
+
+    def test_retries_exhausted(self):
+        func = Flaky(5)
+        assert not policy(retries=2).run(func, 'host', 'update dummy')
+        assert func.calls == 3
+
+    def test_retry_on_stderr(self):
+        func = Flaky(1, ['sh', '-c', 'echo "Could not get lock" >&2'])
+        assert policy(retries=1, **{'retry-on': ['get lock']}).run(
+            func, 'host', 'update dummy')
+
+        func = Flaky(1, ['sh', '-c', 'echo "No space left" >&2'])
+        assert not policy(retries=1, **{'retry-on': ['get lock']}).run(
+            func, 'host', 'update dummy')
+        assert func.calls == 1
+
+    def test_retry_on_returncode(self):
+        func = Flaky(1, ['sh', '-c', 'exit 100'])
+        assert policy(retries=1, **{'retry-on': [100]}).run(
+            func, 'host', 'update dummy')
+
+        func = Flaky(1, ['sh', '-c', 'exit 1'])
+        assert not policy(retries=1, **{'retry-on': 100}).run(
+            func, 'host', 'update dummy')
+
+    def test_retry_on_exception(self):
+        func = Flaky(1, exception=RuntimeError('HTTP 503'))
+        assert policy(retries=1, **{'retry-on': ['503']}).run(
+            func, 'host', 'evacuate nova-compute')
+
+        func = Flaky(1, exception=RuntimeError('HTTP 404'))
+        with pytest.raises(RuntimeError):
+            policy(retries=1, **{'retry-on': ['503']}).run(
+                func, 'host', 'evacuate nova-compute')
+
+    def test_delay(self):
+        p = RetryPolicy({'backoff': 5, 'max-backoff': 30})
+        assert [p.delay(i) for i in range(1, 5)] == [5, 10, 20, 30]
+
+    def test_deadline(self):
+        r = HostResult(host_name='host', durations={})
+        func = Flaky(100)
+        assert not run_phase(r, 'update', 'dummy', func, 0.5, RetryPolicy({
+            'retries': 10, 'backoff': 0.2}))
+        assert r.timed_out == 'update'
+        assert 1 < func.calls < 5
+
+    def test_backoff_releases_slot(self, monkeypatch):
+        monkeypatch.setitem(_limits, 'update', threading.BoundedSemaphore(1))
+        results = []
+
+        def retrying():
+            r = HostResult(host_name='a', durations={})
+            results.append(run_phase(r, 'update', 'dummy', Flaky(1), None,
+                                     RetryPolicy({'retries': 1,
+                                                  'backoff': 1})))
+
+        thread = threading.Thread(target=retrying)
+        thread.start()
+        time.sleep(0.2)
+
+        # host "a" is waiting to retry, without holding the update slot
+        start = time.monotonic()
+        r = HostResult(host_name='b', durations={})
+        assert run_phase(r, 'update', 'dummy', lambda: True)
+        assert time.monotonic() - start < 0.5
+
+        thread.join()
+        assert results == [True]
+
+    def test_last_command_per_thread(self):
+        clear_last_command()
+        thread = threading.Thread(target=_record_command, args=('ls', 1, ''))
+        thread.start()
+        thread.join()
+        assert last_command() is None
+
+        _record_command('ls', 2, 'error')
+        assert last_command()['returncode'] == 2
+
+
+class TestExecUpdater:
+
+    def test_expect_returncode(self):
+        assert update('host', {}, {'exec': {
+            'args': ['sh', '-c', 'exit 3'], 'expect-returncode': 3}})
+        assert not update('host', {}, {'exec': {
+            'args': ['sh', '-c', 'exit 3'], 'expect-returncode': 0}})
+
+    def test_expect_stdout(self):
+        assert update('host', {}, {'exec': {
+            'args': ['printf', 'OK'], 'expect-stdout': 'OK'}})
@@ -0,0 +1,70 @@
+from amaltheia.results import HostResult
+from amaltheia.rolling import RollingStrategy, max_unavailable
+
+
+class TestMaxUnavailable:
+
+    def test_count(self):
+        assert max_unavailable(10, 8) == 2
+
+    def test_percent(self):
+        assert max_unavailable(10, '75%') == 2
+        assert max_unavailable(4, '50%') == 2
+
+    def test_single_host(self):
+        assert max_unavailable(1, '50%') == 0
+        assert max_unavailable(1, 0) == 1
+
+    def test_more_than_size(self):
+        assert max_unavailable(2, 5) == 0
+
+
+def started(s):
+    result = []
+    item = s.next_host()
+    while item is not None:
+        result.append(item[0])
+        item = s.next_host()
+
+    return result
+
+
+class TestRollingStrategy:
+
+    def test_groups(self):
+        s = RollingStrategy({
+            'a1': {'zone': 'a'}, 'a2': {'zone': 'a'}, 'a3': {'zone': 'a'},
+            'a4': {'zone': 'a'}, 'b1': {'zone': 'b'}, 'b2': {'zone': 'b'},
+        }, [], [], {'nparallel': 8})
+
+        assert started(s) == ['a1', 'a2', 'b1']
+        s.host_done(HostResult(host_name='a1'))
+        s.host_done(HostResult(host_name='b1', failed=1))
+        assert started(s) == ['a3']
+        s.host_done(HostResult(host_name='a2', exception=True))
+        s.host_done(HostResult(host_name='a3', failed=1))
+        assert started(s) == []
+        assert s.unscheduled() == [('a4', 'group a has 2 failed hosts'),
+                                   ('b2', 'group b has 1 failed hosts')]
+
+    def test_small_groups(self, caplog):
+        s = RollingStrategy({
+            'a1': {'rack': 1}, 'b1': {'rack': 2}, 'b2': {'rack': 2},
+            'c1': {'rack': 3}, 'x1': {}, 'x2': {},
+        }, [], [], {'nparallel': 8, 'group-key': 'rack',
+                    'groups': {'2': {'min-available': 2},
+                               '3': {'min-available': 0}}})
+
+        assert started(s) == ['c1', 'x1']
+        assert 'Group 1 is too small' in caplog.text
+        assert 'Group 2 is too small' in caplog.text
+        assert '2 hosts have no rack' in caplog.text
+
+        for host_name in ('c1', 'x1'):
+            s.host_done(HostResult(host_name=host_name))
+
+        assert started(s) == ['x2']
+        assert s.unscheduled() == [
+            ('a1', 'group 1 must keep 1 of 1 hosts available'),
+            ('b1', 'group 2 must keep 2 of 2 hosts available'),
+            ('b2', 'group 2 must keep 2 of 2 hosts available')]
@@ -0,0 +1,82 @@
+import json
+
+import pytest
+
+from amaltheia.discover import NetBoxDiscoverer, PatchmanDiscoverer
+from amaltheia.selector import Selector, parse_terms, select_hosts
+
+
+HOSTS = [
+    ('lar0401', {'zone': 'az1', 'updates': ['apt'], 'reboot': True}),
+    ('lar0402', {'zone': 'az2', 'updates': [], 'reboot': False}),
+    ('lar0511', {'zone': 'az1', 'rack': {'row': 'B'}}),
+    ('db01', {}),
+]
+
+
+def selected(spec):
+    return [name for name, _ in select_hosts(HOSTS, spec)]
+
+
+class TestSelector:
+
+    def test_parse(self):
+        assert parse_terms(None) == []
+        assert parse_terms('a*, !b,,') == ['a*', '!b']
+        assert parse_terms(['x{1,2}']) == ['x{1,2}']
+
+    def test_names(self):
+        assert selected('') == ['lar0401', 'lar0402', 'lar0511', 'db01']
+        assert selected('lar04*') == ['lar0401', 'lar0402']
+        assert selected('~lar0.0') == ['lar0401', 'lar0402']
+        assert selected('lar*,!lar0402') == ['lar0401', 'lar0511']
+        assert selected('!db*') == ['lar0401', 'lar0402', 'lar0511']
+        assert selected('db01,lar0511') == ['lar0511', 'db01']
+
+    def test_fields(self):
+        assert selected('zone=az1') == ['lar0401', 'lar0511']
+        assert selected('lar04*,&zone=az1') == ['lar0401']
+        assert selected('updates=apt') == ['lar0401']
+        assert selected('reboot=true') == ['lar0401']
+        assert selected('rack.row~[A-C]') == ['lar0511']
+        assert selected('!zone=*') == ['db01']
+
+    def test_extra_fields(self):
+        selector = Selector(['host.site.slug=ath*'])
+        assert selector('a', {}, host={'site': {'slug': 'athens'}})
+        assert not selector('a', {}, host={'site': None})
+        assert not selector('a', {})
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            Selector('~lar(')
+
+
+class TestDiscoverers:
+
+    def test_netbox(self, monkeypatch):
+        devices = {'results': [{'name': n} for n in (
+            'lar0401', 'lar0402', 'db01')]}
+        monkeypatch.setattr('amaltheia.discover.GET',
+                            lambda url: json.dumps(devices))
+
+        d = NetBoxDiscoverer({
+            'netbox-url': 'http://netbox', 'host-name': '{{ host.name }}',
+            'filter-name': 'lar', 'select': '!*02'})
+        assert d.discover() == {'lar0401': {}}
+
+    def test_patchman(self):
+        d = PatchmanDiscoverer({
+            'patchman-url': 'http://patchman',
+            'host-name': '{{ host.hostname }}',
+            'host-args': {'os': '{{ host.os }}'},
+            'select': ['&os=Ubuntu*', 'host.reboot_required=true']})
+
+        def host(name, os, reboot):
+            return {'hostname': name, 'os': os, 'updates': False,
+                    'reboot_required': reboot}
+
+        assert d.parse_host(host('a', 'Ubuntu 18.04', True)) == (
+            'a', {'os': 'Ubuntu 18.04'})
+        assert d.parse_host(host('b', 'Ubuntu 18.04', False)) is None
+        assert d.parse_host(host('c', 'Debian 10', True)) is None
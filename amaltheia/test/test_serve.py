@@ -0,0 +1,176 @@
+import http.client
+import json
+import socket
+import threading
+import urllib.request
+
+import pytest
+
+from amaltheia.serve import (
+    Daemon, Job, Server, allowed_hosts, create_server, is_loopback,
+    parse_address)
+
+JOB = b'''
+requires: [name]
+hosts:
+- static:
+  - '{{ name }}1'
+  - '{{ name }}2'
+services: []
+updates:
+- dummy
+strategy: serial
+'''
+
+TOKEN = 'secret'
+
+
+def serving(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def server():
+    yield from serving(Server(('127.0.0.1', 0), Daemon(keep_jobs=1), TOKEN))
+
+
+def request(server, path, data=None, headers=None):
+    headers = dict({'Authorization': 'Bearer {}'.format(TOKEN),
+                    'Content-Type': 'application/yaml'}, **(headers or {}))
+    url = urllib.request.Request('http://127.0.0.1:{}{}'.format(
+        server.server_address[1], path), data=data, headers=headers)
+    try:
+        with urllib.request.urlopen(url) as r:
+            return r.status, r.read().decode()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read().decode()
+
+
+class TestServe:
+
+    def test_parse_address(self):
+        assert parse_address('9000') == ('127.0.0.1', 9000)
+        assert parse_address('0.0.0.0:9000') == ('0.0.0.0', 9000)
+
+    def test_submit_and_run(self, server):
+        code, body = request(server, '/jobs?variable=name=host', JOB)
+        assert code == 201
+        job_id = json.loads(body)['id']
+        assert json.loads(body)['status'] == 'queued'
+
+        server.daemon.run(server.daemon.queue.get_nowait())
+
+        code, body = request(server, '/jobs/{}'.format(job_id))
+        job = json.loads(body)
+        assert job['status'] == 'done'
+        assert job['hosts'] == {'ok': 2, 'error': 0, 'skipped': 0}
+        assert [r['host_name'] for r in job['results']] == ['host1', 'host2']
+
+        code, body = request(server, '/jobs/{}/results?follow=1'.format(
+            job_id))
+        assert [json.loads(line)['status'] for line in body.splitlines()] \
+            == ['ok', 'ok']
+
+        code, body = request(server, '/jobs/{}/log'.format(job_id))
+        assert 'Running job {}'.format(job_id) in body
+
+    def test_missing_variable(self, server):
+        code, body = request(server, '/jobs', JOB)
+        assert code == 400
+        assert 'name' in json.loads(body)['error']
+
+    def test_unknown_job(self, server):
+        assert request(server, '/jobs/42')[0] == 404
+
+    def test_keep_jobs(self, server):
+        daemon = server.daemon
+        for _ in range(3):
+            daemon.submit({'hosts': [], 'services': [], 'updates': [],
+                           'strategy': 'serial'})
+            daemon.run(daemon.queue.get_nowait())
+
+        assert len(json.loads(request(server, '/jobs')[1])) == 1
+
+
+class UnixConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        super(UnixConnection, self).__init__('localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+class TestSecurity:
+
+    def test_loopback(self):
+        assert is_loopback('127.0.0.1')
+        assert is_loopback('::1')
+        assert not is_loopback('0.0.0.0')
+        assert not is_loopback('invalid..host')
+
+    def test_tcp_requires_token(self):
+        for address in ('0.0.0.0:0', '127.0.0.1:0'):
+            with pytest.raises(ValueError):
+                create_server(address, Daemon())
+
+            server = create_server(address, Daemon(), token='secret')
+            server.server_close()
+
+    def test_token(self, server):
+        assert request(server, '/jobs', headers={
+            'Authorization': ''})[0] == 401
+        assert request(server, '/jobs', headers={
+            'Authorization': 'Bearer wrong'})[0] == 401
+        assert request(server, '/jobs') == (200, '[]')
+
+    def test_allowed_hosts(self):
+        assert allowed_hosts('0.0.0.0', 8080) is None
+        assert allowed_hosts('127.0.0.1', 8080) == {
+            '127.0.0.1:8080', 'localhost:8080', '[::1]:8080'}
+        assert allowed_hosts('10.0.0.1', 80) == {'10.0.0.1:80', '10.0.0.1'}
+
+    def test_host_header(self, server):
+        assert request(server, '/jobs', headers={
+            'Host': 'attacker.example:{}'.format(
+                server.server_address[1])})[0] == 400
+        assert request(server, '/jobs', headers={
+            'Host': 'LOCALHOST:{}'.format(
+                server.server_address[1])}) == (200, '[]')
+
+    def test_content_type(self, server):
+        for content_type in ('text/plain', 'application/x-www-form-urlencoded',
+                             ''):
+            assert request(server, '/jobs', JOB, headers={
+                'Content-Type': content_type})[0] == 415
+
+        assert not server.daemon.jobs
+        assert request(server, '/jobs?variable=name=host', b'{"hosts": []}',
+                       headers={'Content-Type': 'application/json'})[0] == 201
+
+    def test_unix_socket(self, tmp_path):
+        path = str(tmp_path / 'amaltheia.sock')
+        for _ in serving(create_server('unix:' + path, Daemon())):
+            conn = UnixConnection(path)
+            conn.request('GET', '/jobs')
+            response = conn.getresponse()
+            assert (response.status, response.read()) == (200, b'[]')
+            conn.close()
+
+        assert not (tmp_path / 'amaltheia.sock').exists()
+
+    def test_log_limit(self):
+        job = Job('1', {}, {}, max_log_lines=3)
+        for i in range(5):
+            job.add_log('line {}'.format(i))
+
+        job.status = 'done'
+        assert list(job.follow(job.last_log)) == [
+            'line 2', 'line 3', 'line 4']
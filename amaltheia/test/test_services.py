@@ -0,0 +1,189 @@
+import subprocess
+
+import amaltheia.services
+from amaltheia.config import config
+from amaltheia.services import (
+    Service, ServiceCoordinator, nova_compute_set, services)
+from amaltheia.strategy import ParallelStrategy
+from amaltheia.utils import openstack_cmd_batch
+
+
+class FakeService(Service):
+    """Batch service that fails for hosts in @failing"""
+    batch = True
+    failing = set()
+    calls = []
+
+    @property
+    def name(self):
+        return self.service_args.get('name', 'fake')
+
+    @classmethod
+    def evacuate_batch(cls, handlers):
+        cls.calls.append(('evacuate', [h.host for h in handlers]))
+        return [h.host not in cls.failing for h in handlers]
+
+    @classmethod
+    def restore_batch(cls, handlers):
+        cls.calls.append(('restore', [h.host for h in handlers]))
+        return [h.host not in cls.failing for h in handlers]
+
+    def evacuate(self):
+        return True
+
+    def restore(self):
+        return True
+
+
+class OtherService(FakeService):
+    @property
+    def name(self):
+        return self.service_args.get('name', 'other')
+
+
+class SingleService(Service):
+    @property
+    def name(self):
+        return 'single'
+
+
+class TestNovaComputeSet:
+
+    def test_batch(self, monkeypatch):
+        batches = []
+        monkeypatch.setattr(amaltheia.services, 'openstack_cmd_batch',
+                            batches.append)
+        monkeypatch.setattr(
+            amaltheia.services, 'openstack_cmd_json', lambda cmd: [
+                {'Host': 'a', 'Status': 'disabled'},
+                {'Host': 'b', 'Status': 'enabled'}])
+
+        assert nova_compute_set(['a', 'b', 'c d'], enable=False) == {
+            'a': True, 'b': False, 'c d': False}
+        assert batches == [[
+            'compute service set a nova-compute --disable',
+            'compute service set b nova-compute --disable',
+            "compute service set 'c d' nova-compute --disable"]]
+
+        assert nova_compute_set([], enable=True) == {}
+        assert len(batches) == 1
+
+    def test_status_error(self, monkeypatch):
+        def openstack_cmd_json(cmd):
+            raise ValueError('not JSON')
+
+        monkeypatch.setattr(amaltheia.services, 'openstack_cmd_batch',
+                            lambda cmds: None)
+        monkeypatch.setattr(amaltheia.services, 'openstack_cmd_json',
+                            openstack_cmd_json)
+        assert nova_compute_set(['a', 'b'], enable=True) == {
+            'a': False, 'b': False}
+
+    def test_single_host(self, monkeypatch):
+        cmds = []
+
+        def openstack_cmd(cmd):
+            cmds.append(cmd)
+            return subprocess.CompletedProcess(cmd, len(cmds) - 1)
+
+        monkeypatch.setattr(amaltheia.services, 'openstack_cmd',
+                            openstack_cmd)
+        monkeypatch.setattr(amaltheia.services, 'openstack_cmd_batch', None)
+        monkeypatch.setattr(amaltheia.services, 'openstack_cmd_json', None)
+
+        assert nova_compute_set(['a'], enable=False) == {'a': True}
+        assert nova_compute_set(['b'], enable=True) == {'b': False}
+        assert cmds == [
+            'openstack compute service set a nova-compute --disable',
+            'openstack compute service set b nova-compute --enable']
+
+    def test_skip(self, monkeypatch):
+        monkeypatch.setattr(amaltheia.services, 'nova_compute_set',
+                            lambda hosts, enable: {h: False for h in hosts})
+        handlers = [services['nova-compute']('a', {}, {}),
+                    services['nova-compute']('b', {}, {'skip-evacuate': True})]
+        assert services['nova-compute'].evacuate_batch(handlers) == [
+            False, True]
+
+
+class TestOpenstackCmdBatch:
+
+    def test_session(self, monkeypatch):
+        runs = []
+
+        def run(cmd, **kwargs):
+            runs.append((cmd, kwargs['input']))
+            return subprocess.CompletedProcess(cmd, 0, b'', b'')
+
+        monkeypatch.setattr('subprocess.run', run)
+        monkeypatch.setitem(config._entries, 'openstack_rc', 'admin.rc')
+        openstack_cmd_batch(['server list', 'host list'])
+
+        assert runs == [('bash -c ". admin.rc && openstack"',
+                         b'server list\nhost list\nquit')]
+
+
+class TestServiceCoordinator:
+
+    def coordinator(self, monkeypatch, failing=()):
+        monkeypatch.setitem(services._entries, 'fake', FakeService)
+        monkeypatch.setitem(services._entries, 'other', OtherService)
+        monkeypatch.setitem(services._entries, 'single', SingleService)
+        monkeypatch.setattr(FakeService, 'failing', set(failing))
+        del FakeService.calls[:]
+        return ServiceCoordinator(['fake', 'single'])
+
+    def test_evacuate_restore(self, monkeypatch):
+        c = self.coordinator(monkeypatch)
+        items = [('a', {}), ('b', {'services': ['single']}),
+                 ('c', {'services': ['fake', {'other': {'name': 'o'}}]})]
+
+        batched, failed = c.evacuate(items)
+        assert batched == {'a': ['fake'], 'c': ['fake', 'o']}
+        assert failed == {}
+        assert sorted(FakeService.calls) == [
+            ('evacuate', ['a', 'c']), ('evacuate', ['c'])]
+
+        del FakeService.calls[:]
+        assert c.restore(items, {'a': ['fake'], 'c': ['o']}) == {}
+        assert sorted(FakeService.calls) == [
+            ('restore', ['a']), ('restore', ['c'])]
+
+    def test_failure(self, monkeypatch):
+        c = self.coordinator(monkeypatch, failing=['b'])
+        items = [('a', {}), ('b', {'services': ['other', 'fake']})]
+
+        batched, failed = c.evacuate(items)
+        assert batched == {'a': ['fake']}
+        assert sorted(failed['b']) == ['fake', 'other']
+
+        # nothing was evacuated on "b", so there is nothing to restore
+        assert ('restore', ['b']) not in FakeService.calls
+
+    def test_undo(self, monkeypatch):
+        c = self.coordinator(monkeypatch)
+        monkeypatch.setattr(OtherService, 'evacuate_batch', classmethod(
+            lambda cls, handlers: [False for _ in handlers]))
+        items = [('a', {'services': ['fake', 'other']})]
+
+        batched, failed = c.evacuate(items)
+        assert batched == {}
+        assert failed == {'a': ['other']}
+        assert FakeService.calls == [('evacuate', ['a']), ('restore', ['a'])]
+
+
+class TestBatchServices:
+
+    def test_batch_failed(self, monkeypatch):
+        monkeypatch.setitem(services._entries, 'fake', FakeService)
+        monkeypatch.setattr(FakeService, 'failing', {'a', 'b'})
+        hosts = {name: {} for name in 'abcd'}
+        s = ParallelStrategy(hosts, ['fake'], ['dummy'], {
+            'nparallel': 2, 'batch-services': True})
+        s.execute()
+
+        # the first batch fails completely, the rest are still processed
+        results = {r.host_name: r for r in s.results}
+        assert sorted(results) == ['a', 'b', 'c', 'd']
+        assert results['a'].failed == 1
+        assert results['c'].updated == 1 and results['d'].updated == 1
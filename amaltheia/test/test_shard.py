@@ -0,0 +1,47 @@
+import pytest
+
+from amaltheia.shard import parse_shard, shard_hosts, shard_of
+
+
+def hosts(count, zones=3):
+    return [('host{}'.format(i), {'zone': 'az{}'.format(i % zones)})
+            for i in range(count)]
+
+
+class TestShard:
+
+    def test_parse(self):
+        assert parse_shard('2/4') == (2, 4)
+        for spec in ('0/4', '5/4', '1', 'a/b', None):
+            with pytest.raises(ValueError):
+                parse_shard(spec)
+
+    def test_partition(self):
+        items = hosts(200)
+        shards = [list(shard_hosts(items, '{}/4'.format(i)))
+                  for i in range(1, 5)]
+
+        assert sorted(sum(shards, [])) == sorted(items)
+        assert all(20 < len(shard) < 80 for shard in shards)
+
+    def test_stable(self):
+        before = {name: shard_of(name, 4) for name, _ in hosts(100)}
+        after = {name: shard_of(name, 4) for name, _ in hosts(150)}
+        assert all(after[name] == shard for name, shard in before.items())
+
+        # adding a shard only moves hosts to the new shard
+        grown = {name: shard_of(name, 5) for name in before}
+        assert all(grown[name] in (shard, 5)
+                   for name, shard in before.items())
+
+    def test_key(self):
+        items = hosts(60) + [('nozone', {})]
+        shard = {}
+        for i in range(1, 4):
+            for name, _ in shard_hosts(items, '{}/3'.format(i), key='zone'):
+                shard[name] = i
+
+        assert len(shard) == len(items)
+        for zone in ('az0', 'az1', 'az2'):
+            assert len(set(shard[name] for name, args in items
+                           if args.get('zone') == zone)) == 1
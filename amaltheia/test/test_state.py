@@ -0,0 +1,88 @@
+from amaltheia.config import config
+from amaltheia.results import HostResult, status
+from amaltheia.state import StateStore, changed_hosts, fingerprint
+from amaltheia.strategy import create_strategy
+
+JOB = {'services': ['nova-compute'], 'updates': ['apt']}
+
+
+class TestFingerprint:
+
+    def test_host_args(self):
+        assert fingerprint(JOB, {'kernel': '1'}) == fingerprint(
+            JOB, {'kernel': '1'})
+        assert fingerprint(JOB, {'kernel': '1'}) != fingerprint(
+            JOB, {'kernel': '2'})
+
+    def test_keys(self):
+        a = {'kernel': '1', 'uptime': 10}
+        b = {'kernel': '1', 'uptime': 20}
+        assert fingerprint(JOB, a) != fingerprint(JOB, b)
+        assert fingerprint(JOB, a, ['kernel']) == fingerprint(
+            JOB, b, ['kernel'])
+
+    def test_job(self):
+        assert fingerprint(JOB, {}) != fingerprint(
+            dict(JOB, updates=['apt', 'reboot']), {})
+        assert fingerprint(JOB, {}) != fingerprint(
+            JOB, {'updates': ['reboot']})
+
+
+class TestStateStore:
+
+    def test_incremental(self, tmp_path):
+        path = str(tmp_path / 'state.json')
+        hosts = {'ok': {'kernel': '1'}, 'failed': {'kernel': '1'},
+                 'changed': {'kernel': '1'}}
+
+        store = StateStore(path)
+        assert changed_hosts(hosts, JOB, store)[0] == hosts
+
+        store.update([
+            HostResult(host_name='ok', updated=1),
+            HostResult(host_name='failed', failed=1),
+            HostResult(host_name='changed', updated=1),
+        ], {name: fingerprint(JOB, args) for name, args in hosts.items()})
+        store.save()
+
+        hosts['changed'] = {'kernel': '2'}
+        remaining, results = changed_hosts(hosts, JOB, StateStore(path))
+        assert sorted(remaining) == ['changed', 'failed']
+        assert [r.host_name for r in results] == ['ok']
+        assert results[0].skipped.startswith('unchanged since')
+
+        # hosts that were skipped keep their state
+        store = StateStore(path)
+        store.update(results, {})
+        assert store.hosts['ok']['status'] == 'ok'
+
+    def test_invalid_file(self, tmp_path):
+        path = tmp_path / 'state.json'
+        path.write_text('not json')
+        assert StateStore(str(path)).hosts == {}
+
+
+class TestIncrementalRun:
+
+    def test_preflight(self, tmp_path, monkeypatch, restore_config):
+        path = str(tmp_path / 'state.json')
+        job = dict(JOB, strategy='serial', hosts=[{'static': [
+            'a', 'b', 'c', 'd']}], preflight={
+            'tcp': False, 'ssh': False,
+            'check': {'command': 'check', 'skip-if-stdout': 'skip'}})
+
+        store = StateStore(path)
+        store.update([HostResult(host_name=name, updated=1)
+                      for name in ('a', 'b')],
+                     {name: fingerprint(JOB, {}) for name in ('a', 'b')})
+        store.save()
+
+        # "c" is skipped by the pre-flight check
+        monkeypatch.setattr('amaltheia.preflight.ssh_cmd', lambda host, *a,
+                            **kw: ('skip' if host == 'c' else 'go', ''))
+        config.load({'incremental': True, 'state-file': path})
+
+        s = create_strategy(job)
+        assert list(s.hosts) == ['d']
+        assert sorted((r.host_name, status(r)) for r in s.results) == [
+            ('a', 'skipped'), ('b', 'skipped'), ('c', 'skipped')]
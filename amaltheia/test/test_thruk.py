@@ -0,0 +1,106 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import amaltheia.services as services
+import amaltheia.utils as utils
+
+
+class ThrukHandler(BaseHTTPRequestHandler):
+    """Records requests, fails for hosts named "down" """
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.server.requests.append((self.client_address[1], self.path,
+                                     self.headers['Authorization']))
+        code = 500 if 'down' in self.path else 200
+        self.send_response(code)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, *args):
+        pass
+
+
+class TestThrukHosts:
+
+    def setup_method(self):
+        services._thruk_hosts.clear()
+        services._thruk_fresh.clear()
+        self.calls = 0
+
+    def get_hosts(self, url, username, password):
+        self.calls += 1
+        return {'10.0.0.1': 'host1'}
+
+    def test_memory(self, monkeypatch):
+        monkeypatch.setattr(services, 'thruk_get_hosts', self.get_hosts)
+        services.thruk_hosts('url', 'u', 'p')
+        assert services.thruk_hosts('url', 'u', 'p') == {'10.0.0.1': 'host1'}
+        assert self.calls == 1
+
+    def test_refresh_once(self, monkeypatch):
+        monkeypatch.setattr(services, 'thruk_get_hosts', self.get_hosts)
+        services.thruk_hosts('url', 'u', 'p')
+        services.thruk_hosts('url', 'u', 'p', refresh=True)
+        assert self.calls == 1
+
+    def test_cache_file(self, monkeypatch, tmpdir):
+        monkeypatch.setattr(services, 'thruk_get_hosts', self.get_hosts)
+        cache_file = str(tmpdir.join('thruk.json'))
+        services.thruk_hosts('url', 'u', 'p', cache_file=cache_file)
+        services._thruk_hosts.clear()
+        services._thruk_fresh.clear()
+
+        hosts = services.thruk_hosts('url', 'u', 'p', cache_file=cache_file)
+        assert hosts == {'10.0.0.1': 'host1'}
+        assert self.calls == 1
+
+        # stale cache file entries are refreshed
+        services._thruk_hosts.clear()
+        services.thruk_hosts('url', 'u', 'p', cache_file=cache_file,
+                             cache_ttl=0)
+        assert self.calls == 2
+        assert json.load(open(cache_file))['url']['hosts'] == hosts
+
+
+class TestThrukNotifications:
+
+    def test_prepare(self, monkeypatch):
+        services._thruk_hosts.clear()
+        services._thruk_fresh.clear()
+        monkeypatch.setattr(services, 'thruk_get_hosts',
+                            lambda url, u, p: {'10.0.0.1': 'host1'})
+        services.prepare_services(
+            ['nova-compute', {'thruk-downtime': {'thruk-url': 'url'}}])
+        assert services._thruk_hosts == {'url': {'10.0.0.1': 'host1'}}
+
+        def fail(url, u, p):
+            raise OSError('connection refused')
+
+        services._thruk_hosts.clear()
+        monkeypatch.setattr(services, 'thruk_get_hosts', fail)
+        services.prepare_services([{'thruk-downtime': {'thruk-url': 'url'}}])
+        assert services._thruk_hosts == {}
+
+    def test_bulk(self):
+        server = HTTPServer(('127.0.0.1', 0), ThrukHandler)
+        server.requests = []
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            assert utils.thruk_set_notifications_bulk(
+                'http://127.0.0.1:{}/r/'.format(server.server_address[1]),
+                'u', 'p', ['a b', 'c', 'down', 'd'], False) == {
+                    'a b': True, 'c': True, 'down': False, 'd': True}
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        ports = [port for port, _, _ in server.requests]
+        assert server.requests[0][1:] == (
+            '/r/hosts/a%20b/disable_notifications', 'Basic dTpw')
+
+        # one connection, opened again after the failed request
+        assert ports[0] == ports[1] == ports[2] != ports[3]
@@ -0,0 +1,56 @@
+from amaltheia.results import HostResult
+from amaltheia.strategy import ParallelStrategy
+
+
+class FakePool:
+    def __init__(self):
+        self.tasks = []
+
+    def apply_async(self, func, args, callback=None, error_callback=None):
+        self.tasks.append(args)
+
+
+def hosts(names):
+    for name in names:
+        yield name, {'rack': name[-1]}
+
+
+class TestCompactResult:
+
+    def test_roundtrip(self):
+        r = HostResult(host_name='host', durations={'update': 1.5},
+                       evacuated=True, updated=2)
+        r.timed_out = 'update'
+
+        compact = r.compact()
+        assert ('failed', 0) not in compact
+        assert str(HostResult.from_compact(compact)) == str(r)
+        assert HostResult.from_compact(compact).__dict__ == r.__dict__
+
+
+class TestWorkerInventory:
+
+    def test_host_args_not_sent(self):
+        s = ParallelStrategy(hosts(['host1', 'host2']), [], ['dummy'], {})
+        s._running = {'host1': ({'rack': '1'}, []),
+                      'host2': ({'rack': '2'}, [])}
+        s._shared = {'host1'}
+        s._tasks = {}
+
+        pool = FakePool()
+        s.submit(pool, 'execute_item', 'host1', None)
+        s.submit(pool, 'execute_item', 'host2', None)
+        assert pool.tasks == [
+            ('execute_item', 'host1', None, [], 1),
+            ('execute_item', 'host2', {'rack': '2'}, [], 2),
+        ]
+
+    def test_execute(self):
+        names = ['host{}'.format(i) for i in range(6)]
+        s = ParallelStrategy(dict(hosts(names[:3])), [], ['dummy'],
+                             {'nparallel': 3})
+        s._pending = hosts(names[3:])
+        s.execute()
+
+        assert sorted(r.host_name for r in s.results) == names
+        assert all(r.updated == 1 and r.failed == 0 for r in s.results)
@@ -17,9 +17,8 @@
 from datetime import datetime, timedelta
 from time import sleep
 
-import jenkins
-
 import amaltheia.log as log
+from amaltheia.registry import Registry
 from amaltheia.utils import (
     ssh_cmd, ssh_try_connect, str_or_dict, jinja, exec_cmd)
 
@@ -187,9 +186,10 @@ class RebootUpdater(Updater):
 class ExecUpdater(Updater):
     """Execute an arbitrary command on the amaltheia host. Use with care"""
     def update(self):
-        stdout, stderr, rc = exec_cmd(
-            jinja(self.updater_args, host=self.fix_hostname(self.host),
-                  **self.host_args))
+        rc, stdout, stderr = exec_cmd(jinja(
+            {key: self.updater_args[key] for key in ('args', 'kwargs')
+             if key in self.updater_args},
+            host=self.host, **self.host_args))
 
         expected_rc = self.updater_args.get('expect-returncode')
         if expected_rc is not None:
@@ -245,6 +245,7 @@ class JenkinsUpdater(Updater):
         self.job = jinja(self.updater_args.get('job'))
 
         try:
+            import jenkins
             self.jenkins = jenkins.Jenkins(
                 self.server, self.username, self.password)
         except:
@@ -327,7 +328,7 @@ class JenkinsUpdater(Updater):
         return build_info['result'] == 'SUCCESS'
 
 
-updaters = {
+updaters = Registry('amaltheia.updaters', {
     'dummy': DummyUpdater,
     'apt': AptPackagesUpdater,
     'ssh': SSHCommandUpdater,
@@ -335,7 +336,7 @@ updaters = {
     'reboot': RebootUpdater,
     'exec': ExecUpdater,
     'jenkins': JenkinsUpdater,
-}
+})
 
 
 def update(host_name, host_args, updater):
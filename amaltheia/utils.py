@@ -14,23 +14,58 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
+# NOTE: third-party modules (paramiko, jinja2, jsonpath_ng, colorama) are
+# imported in the functions that need them, so that amaltheia only pays
+# their import cost when a job actually uses them.
+
+import codecs
+import http.client
 import json
-import jsonpath_ng
 import logging
+import os
+import re
+import select
 import socket
 import subprocess
+import threading
+import time
+import urllib.parse
 import urllib.request
 from base64 import b64encode
+from collections import deque
 from copy import deepcopy
-
-from jinja2 import BaseLoader, DebugUndefined
-from jinja2.nativetypes import NativeEnvironment
-import paramiko
-from colorama import Style, Fore
+from datetime import datetime
+from functools import lru_cache
 
 from amaltheia.config import config
 
 
+class DeadlineExceeded(Exception):
+    """Raised in the main thread when the deadline of a phase expires, see
+    amaltheia.strategy.deadline()"""
+
+
+# return code and stderr of the last command executed by each thread, see
+# last_command()
+_last_command = threading.local()
+
+
+def last_command():
+    """Returns dictionary with the "cmd", "returncode" and "stderr" of the
+    last command executed by the current thread (over ssh, OpenStack
+    client or local), or None. Used for matching retry-on patterns"""
+    cmd = getattr(_last_command, 'cmd', None)
+    return dict(cmd) if cmd else None
+
+
+def clear_last_command():
+    _last_command.cmd = None
+
+
+def _record_command(cmd, returncode, stderr):
+    _last_command.cmd = dict(cmd=cmd, returncode=returncode, stderr=stderr)
+
+
 def _openstack_parse_table_output(output):
     """Parses table output format from OpenStack commands. Raises
     IndexError, ValueError on bad output"""
@@ -59,10 +94,13 @@ def _openstack_parse_table_output(output):
 def _openstack_cmd(cmd):
     """Executes an OpenStack command, supplying the required credentials.
     This is a low-level function"""
-    return subprocess.run(
+    p = subprocess.run(
         'bash -c ". {} && {}"'.format(config.openstack_rc, cmd),
         shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
+    _record_command(cmd, p.returncode, p.stderr.decode())
+    return p
+
 
 def openstack_cmd(cmd):
     """Executes an OpenStack command"""
@@ -74,6 +112,23 @@ def openstack_cmd(cmd):
     return p
 
 
+def openstack_cmd_batch(cmds):
+    """Executes multiple OpenStack client commands (without the leading
+    "openstack") in a single interactive client session, so that the client
+    starts and authenticates only once"""
+    p = subprocess.run(
+        'bash -c ". {} && openstack"'.format(config.openstack_rc),
+        shell=True, input='\n'.join(cmds + ['quit']).encode(),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    _record_command('; '.join(cmds), p.returncode, p.stderr.decode())
+    logging.debug({
+        'cmds': cmds,
+        'stdout': p.stdout.decode(),
+        'stderr': p.stderr.decode()})
+    return p
+
+
 def openstack_cmd_json(cmd):
     """Executes OpenStack command and return parsed JSON output"""
     p = _openstack_cmd(cmd)
@@ -95,6 +150,147 @@ def openstack_cmd_table(cmd):
     return result
 
 
+def _parse_jump_host(jump_host):
+    """Parses "[user@]host[:port]" and returns (user, host, port)"""
+    if ',' in jump_host:
+        raise ValueError('expected a single jump host, got {}'.format(
+            jump_host))
+
+    user, _, host = jump_host.strip().rpartition('@')
+    host, port = re.match(r'^\[?([^\]]*?)\]?(?::(\d+))?$', host).groups()
+
+    return user or None, host, int(port or 22)
+
+
+class _JumpChannel(object):
+    """direct-tcpip channel used as the socket of an SSH connection. Frees
+    its slot on the jump host when closed"""
+    def __init__(self, channel, release):
+        self.channel = channel
+        self.release = release
+
+    def __getattr__(self, name):
+        return getattr(self.channel, name)
+
+    def close(self):
+        self.channel.close()
+        if self.release is not None:
+            self.release()
+            self.release = None
+
+
+class JumpHost(object):
+    """Single authenticated SSH transport to a jump host (bastion), shared
+    by all connections to hosts behind it. Each connection is a direct-tcpip
+    channel over the transport, and at most @max_channels can be open at
+    the same time. Both are per process, so parallel workers each have their
+    own transport and limit"""
+    def __init__(self, host_name, host_args, user, port, max_channels):
+        self.host_name = host_name
+        self.host_args = host_args
+        self.user = user
+        self.port = port
+        self.client = None
+        self.lock = threading.Lock()
+        self.channels = threading.BoundedSemaphore(max_channels)
+
+    def transport(self):
+        """Returns transport to the jump host, connecting if needed"""
+        with self.lock:
+            if self.client is not None:
+                transport = self.client.get_transport()
+                if transport is not None and transport.is_active():
+                    return transport
+
+                self.client.close()
+
+            client, args = _ssh_client(
+                self.host_name, self.host_args, port=self.port)
+            if self.user is not None:
+                args['username'] = self.user
+
+            logging.getLogger('amaltheia').debug(
+                '[amaltheia] Connecting to jump host {}'.format(
+                    self.host_name))
+
+            client.connect(**args)
+            self.client = client
+            return client.get_transport()
+
+    def open(self, host_name, port=22, timeout=None):
+        """Opens channel to @host_name:@port, waiting for a free slot"""
+        self.channels.acquire()
+        try:
+            channel = self.transport().open_channel(
+                'direct-tcpip', (host_name, port), ('127.0.0.1', 0),
+                timeout=timeout)
+        except BaseException:
+            self.channels.release()
+            raise
+
+        return _JumpChannel(channel, self.channels.release)
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+
+# (host, port, user, previous hops) -> JumpHost, for this process, see
+# jump_host()
+_jump_hosts = {'pid': None}
+
+
+def jump_host(jump_host, host_args):
+    """Returns shared JumpHost for "[user@]host[:port]" @jump_host. For
+    chains of jump hosts ("bastion1,user@bastion2"), returns the last one,
+    which is reached through the previous ones, like ssh ProxyJump. Jump
+    hosts are kept per process, since transports do not survive fork()"""
+    if _jump_hosts['pid'] != os.getpid():
+        _jump_hosts.clear()
+        _jump_hosts['pid'] = os.getpid()
+
+    hops = [hop.strip() for hop in jump_host.split(',') if hop.strip()]
+    user, host, port = _parse_jump_host(hops[-1])
+    via = ','.join(hops[:-1])
+
+    key = (host, port, user, via)
+    if key not in _jump_hosts:
+        # the first jump host of the chain is reached directly
+        args = {k: v for k, v in host_args.items()
+                if k not in ('ssh-jump-host', 'ssh-proxycommand')}
+        args['ssh-jump-host'] = via or False
+
+        _jump_hosts[key] = JumpHost(
+            host, args, user, port, int(host_args.get(
+                'ssh-jump-channels', config.ssh_jump_channels)))
+
+    return _jump_hosts[key]
+
+
+def ssh_proxy(host_name, host_args):
+    """Returns (jump host, proxy command) to use for connecting to
+    @host_name, from @host_args or the ssh config file. Both are None if
+    @host_name is reached directly"""
+    import paramiko
+
+    proxy_command = host_args.get('ssh-proxycommand')
+    proxy_jump = host_args.get('ssh-jump-host')
+    if proxy_command is None and proxy_jump is None:
+        try:
+            with open(config.ssh_config_file, 'r') as fin:
+                conf = paramiko.SSHConfig()
+                conf.parse(fin)
+
+                host_conf = conf.lookup(host_name)
+                proxy_jump = host_conf.get('proxyjump')
+                proxy_command = host_conf.get('proxycommand')
+        except Exception:
+            pass
+
+    return proxy_jump or None, proxy_command
+
+
 def _ssh_client(host_name, host_args, **kwargs):
     """prepare a paramiko.SSHClient with host keys and our
     custom config. Returns client object and connection arguments.
@@ -105,6 +301,7 @@ def _ssh_client(host_name, host_args, **kwargs):
     client.exec_command('echo hello')
 ```
     """
+    import paramiko
 
     client = paramiko.SSHClient()
 
@@ -121,27 +318,32 @@ def _ssh_client(host_name, host_args, **kwargs):
                                   config.ssh_id_rsa_password),
         'timeout': host_args.get('ssh-timeout', 5)
     }
+    args.update(**kwargs)
 
-    try:
-        proxy_command = host_args.get('ssh-proxycommand')
-        if proxy_command is None:
-            with open(config.ssh_config_file, 'r') as fin:
-                conf = paramiko.SSHConfig()
-                conf.parse(fin)
+    proxy_jump, proxy_command = ssh_proxy(host_name, host_args)
+    if 'sock' in args:
+        pass
 
-                proxy_command = conf.lookup(host_name).get('proxycommand')
+    elif proxy_jump:
+        logging.debug('[{}] Using jump host {}'.format(host_name, proxy_jump))
+        args['sock'] = jump_host(proxy_jump, host_args).open(
+            host_name, args.get('port') or 22, timeout=args['timeout'])
 
-        if proxy_command is not None:
-            logging.debug('[{}] Using proxy command {}'.format(
-                host_name, proxy_command))
-            args.update({'sock': paramiko.ProxyCommand(proxy_command)})
+    elif proxy_command is not None:
+        logging.debug('[{}] Using proxy command {}'.format(
+            host_name, proxy_command))
+        args['sock'] = paramiko.ProxyCommand(proxy_command)
 
-    except Exception:
-        pass
+    return client, args
 
-    args.update(**kwargs)
 
-    return client, args
+def _ssh_close(client, args):
+    """Closes @client, and the proxy socket in @args, if any, in case the
+    connection failed before the client took ownership of it"""
+    owned = client.get_transport() is not None
+    client.close()
+    if not owned and args.get('sock') is not None:
+        args['sock'].close()
 
 
 def exec_cmd(_kwargs):
@@ -157,39 +359,161 @@ def exec_cmd(_kwargs):
     p = subprocess.run(**kwargs)
 
     rc, stdout, stderr = p.returncode, p.stdout.decode(), p.stderr.decode()
+    _record_command(kwargs.get('args'), rc, stderr)
     logging.debug({'exec_args': kwargs, 'stdout': stdout,
                    'stderr': stderr, 'returncode': rc})
 
     return rc, stdout, stderr
 
 
-def ssh_cmd(host_name, host_args, cmd, **kwargs):
+class OutputCapture(object):
+    """Bounded capture of the output of a command running on @host_name.
+    Only the last @max_lines lines of stdout and stderr are kept in memory.
+    Complete lines are forwarded to the log as they arrive, and, if
+    @spill_dir is set, the full output is appended to a per-host file"""
+
+    def __init__(self, host_name, cmd, max_lines=1000, spill_dir=None):
+        self.host_name = host_name
+        self.lines = {
+            'stdout': deque(maxlen=max_lines),
+            'stderr': deque(maxlen=max_lines),
+        }
+        self.partial = {'stdout': '', 'stderr': ''}
+        self.decoders = {
+            'stdout': codecs.getincrementaldecoder('utf-8')('replace'),
+            'stderr': codecs.getincrementaldecoder('utf-8')('replace'),
+        }
+        self.total = {'stdout': 0, 'stderr': 0}
+
+        self.spill = None
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            self.spill = open(host_file(spill_dir, host_name, 'out'), 'a')
+            self.spill.write('# {} $ {}\n'.format(
+                datetime.now().isoformat(), cmd))
+
+    def feed(self, stream, data, final=False):
+        """Adds raw bytes @data to @stream ('stdout' or 'stderr')"""
+        text = self.partial[stream] + self.decoders[stream].decode(
+            data, final)
+        lines = text.split('\n')
+        self.partial[stream] = lines.pop()
+
+        if final and self.partial[stream]:
+            lines.append(self.partial[stream])
+            self.partial[stream] = ''
+
+        for line in lines:
+            self.lines[stream].append(line)
+            self.total[stream] += 1
+            if self.spill is not None:
+                self.spill.write('{}: {}\n'.format(stream, line))
+
+            logging.getLogger('amaltheia').debug('[{}] {}: {}'.format(
+                self.host_name, stream, line))
+
+    def close(self):
+        """Flushes any incomplete lines and closes the spill file"""
+        for stream in self.partial:
+            self.feed(stream, b'', final=True)
+
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+
+    def output(self, stream):
+        """Returns captured output of @stream, as a string. If output was
+        longer than the buffer, only the last lines are returned"""
+        if not self.lines[stream]:
+            return ''
+
+        return '\n'.join(self.lines[stream]) + '\n'
+
+    @property
+    def stdout(self):
+        return self.output('stdout')
+
+    @property
+    def stderr(self):
+        return self.output('stderr')
+
+
+def _drain_channel(channel, capture, chunk_size=32768, poll_interval=0.1,
+                   timeout=None):
+    """Reads stdout and stderr of paramiko @channel as data arrives, feeding
+    it to @capture. Both streams are drained concurrently, so that the
+    remote command never blocks on a full pipe. Returns exit status. Raises
+    socket.timeout if the command does not finish within @timeout seconds"""
+    if timeout is not None:
+        expires = time.monotonic() + timeout
+
+    while True:
+        got_data = False
+        if channel.recv_ready():
+            capture.feed('stdout', channel.recv(chunk_size))
+            got_data = True
+
+        if channel.recv_stderr_ready():
+            capture.feed('stderr', channel.recv_stderr(chunk_size))
+            got_data = True
+
+        if got_data:
+            continue
+
+        if channel.closed or (
+                channel.eof_received and channel.exit_status_ready()):
+            break
+
+        if timeout is not None and time.monotonic() >= expires:
+            raise socket.timeout(
+                'command did not finish within {} seconds'.format(timeout))
+
+        # NOTE: select() only wakes up for stdout, so poll for stderr
+        select.select([channel], [], [], poll_interval)
+
+    return channel.recv_exit_status()
+
+
+def ssh_cmd(host_name, host_args, cmd, command_timeout=None, **kwargs):
     """Executes ssh command @cmd on @host_name, @host_args. Any extra arguments
-    will be passed to SSHClient.connect().
+    will be passed to SSHClient.connect(). Output is streamed to the log
+    while the command is running, see OutputCapture. Raises socket.timeout
+    if the command does not finish within @command_timeout seconds
 
     Returns stdout, stderr of command (as strings)"""
     client, args = _ssh_client(host_name, host_args, **kwargs)
-    client.connect(**args)
+    capture = OutputCapture(
+        host_name, cmd,
+        max_lines=config.ssh_output_lines,
+        spill_dir=config.ssh_output_dir)
 
-    fin, fout, ferr = client.exec_command(cmd)
-    stdout = fout.read().decode()
-    stderr = ferr.read().decode()
+    try:
+        client.connect(**args)
 
-    client.close()
+        fin, fout, ferr = client.exec_command(cmd)
+        fout.channel.shutdown_write()
+        rc = _drain_channel(fout.channel, capture, timeout=command_timeout)
+    finally:
+        capture.close()
+        _ssh_close(client, args)
 
-    logging.debug({
-        'ssh': args, 'cmd': cmd,
-        'stdout': stdout, 'stderr': stderr})
+    _record_command(cmd, rc, capture.stderr)
+    logging.getLogger('amaltheia').debug(
+        '[{}] ssh: {} (returncode {}, {} lines stdout, {} lines stderr)'
+        .format(host_name, cmd, rc,
+                capture.total['stdout'], capture.total['stderr']))
 
-    return stdout, stderr
+    return capture.stdout, capture.stderr
 
 
 def ssh_try_connect(host_name, host_args, timeout=5):
     """Tries to connect with ssh on @host_name with @host_args. Return False if
     connection fails or times out, True otherwise"""
+    import paramiko
 
-    client, args = _ssh_client(host_name, host_args, timeout=timeout)
+    client = None
     try:
+        client, args = _ssh_client(host_name, host_args, timeout=timeout)
         client.connect(**args)
 
         return True
@@ -198,6 +522,15 @@ def ssh_try_connect(host_name, host_args, timeout=5):
             paramiko.SSHException,
             paramiko.AuthenticationException):
         return False
+    finally:
+        if client is not None:
+            _ssh_close(client, args)
+
+
+def host_file(directory, host, suffix='log'):
+    """Returns path of per-host file for @host in @directory"""
+    return os.path.join(directory, '{}.{}'.format(
+        re.sub(r'[^\w.-]', '_', str(host)), suffix))
 
 
 def str_or_dict(entry):
@@ -226,6 +559,7 @@ def str_or_dict(entry):
 def bold(string):
     """Make bold string"""
     if config.color:
+        from colorama import Style
         return Style.BRIGHT + string + Style.NORMAL
 
     return string
@@ -234,12 +568,34 @@ def bold(string):
 def colored(string, color):
     """Add color to string"""
     color = str(color).upper()
-    if config.color and hasattr(Fore, color):
-        return getattr(Fore, color) + string + Fore.RESET
+    if config.color and color != 'NONE':
+        from colorama import Fore
+        if hasattr(Fore, color):
+            return getattr(Fore, color) + string + Fore.RESET
 
     return string
 
 
+@lru_cache(maxsize=1)
+def _jinja_env():
+    from jinja2 import BaseLoader, DebugUndefined
+    from jinja2.nativetypes import NativeEnvironment
+    return NativeEnvironment(loader=BaseLoader, undefined=DebugUndefined)
+
+
+@lru_cache(maxsize=1024)
+def _jinja_template(source):
+    """Compiled templates are kept for the lifetime of the process, most
+    jobs render the same few templates for every host"""
+    return _jinja_env().from_string(source)
+
+
+def jinja_variables(template):
+    """Returns set of the names of variables used in string @template"""
+    from jinja2 import meta
+    return meta.find_undeclared_variables(_jinja_env().parse(str(template)))
+
+
 def jinja(template, _env=None, **data):
     """Recursively renders a python dict, list or str, evaluating strings
     along the way"""
@@ -247,9 +603,11 @@ def jinja(template, _env=None, **data):
     kwargs.update(data)
 
     if _env is None:
-        _env = NativeEnvironment(loader=BaseLoader, undefined=DebugUndefined)
+        t = _jinja_template(str(template))
+    else:
+        t = _env.from_string(str(template))
 
-    return _env.from_string(str(template)).render(**kwargs, json=json)
+    return t.render(**kwargs, json=json)
 
 
 def GET(url):
@@ -288,38 +646,88 @@ def override(dictionary, key, value):
     assert d == {'a': 1, 'c': {'d': 10}}
     ```
     """
+    import jsonpath_ng
     dictionary = jsonpath_ng.parse(key).update(dictionary, value)
 
 
+def _thruk_headers(thruk_username, thruk_password):
+    return {
+        'Authorization': 'Basic {}'.format(
+            b64encode('{}:{}'.format(
+                thruk_username, thruk_password).encode()).decode())
+    }
+
+
 def thruk_get_host(thruk_url, thruk_username, thruk_password, address):
     """Get Nagios hostname from Thruk API using address. Raise exception
     on error"""
     r = HTTP({
-        'url': '{}/hosts?address={}'.format(thruk_url, address),
-        'headers': {
-            'Authentication': 'Basic {}'.format(
-                b64encode('{}:{}'.format(
-                    thruk_username, thruk_password).encode()).decode())
-        },
+        'url': '{}/hosts?address={}'.format(
+            thruk_url, urllib.parse.quote(address)),
+        'headers': _thruk_headers(thruk_username, thruk_password),
         'method': 'GET',
     })
 
-    return json.dumps(r.read())['name']
+    result = json.loads(r.read().decode())
+    if isinstance(result, list):
+        result = result[0]
 
+    return result['name']
 
-def thruk_set_notifications(thruk_url, thruk_username, thruk_password, name,
-                            enable):
-    """Set notifications on or off for Nagios host. Raise exception on error.
-    Returns True/False"""
+
+def thruk_get_hosts(thruk_url, thruk_username, thruk_password):
+    """Get all Nagios hosts from Thruk API with a single request. Returns
+    dictionary of address -> Nagios hostname (host names are also mapped to
+    themselves). Raise exception on error"""
     r = HTTP({
-        'url': '{}/hosts/{}/{}_notifications'.format(
-            thruk_url, name, 'enable' if enable else 'disable'),
-        'headers': {
-            'Authentication': 'Basic {}'.format(
-                b64encode('{}:{}'.format(
-                    thruk_username, thruk_password).encode()).decode())
-        },
-        'method': 'POST',
+        'url': '{}/hosts?columns=name,address'.format(thruk_url),
+        'headers': _thruk_headers(thruk_username, thruk_password),
+        'method': 'GET',
     })
 
-    return r
+    result = {}
+    for host in json.loads(r.read().decode()):
+        result[host['name']] = host['name']
+        if host.get('address'):
+            result.setdefault(host['address'], host['name'])
+
+    return result
+
+
+def thruk_set_notifications_bulk(thruk_url, thruk_username, thruk_password,
+                                 names, enable):
+    """Set notifications on or off for multiple Nagios hosts. Requests are
+    sent over a single keep-alive connection, which is only opened again
+    after a failure. Failed requests are logged. Returns dictionary of
+    name -> True/False"""
+    url = urllib.parse.urlsplit(thruk_url)
+    if url.scheme == 'https':
+        conn = http.client.HTTPSConnection(url.netloc, timeout=60)
+    else:
+        conn = http.client.HTTPConnection(url.netloc, timeout=60)
+
+    headers = _thruk_headers(thruk_username, thruk_password)
+    result = {}
+    try:
+        for name in names:
+            try:
+                conn.request('POST', '{}/hosts/{}/{}_notifications'.format(
+                    url.path.rstrip('/'), urllib.parse.quote(name),
+                    'enable' if enable else 'disable'), headers=headers)
+                r = conn.getresponse()
+                r.read()
+                if r.status >= 400:
+                    raise ValueError('HTTP {} {}'.format(r.status, r.reason))
+
+                result[name] = True
+            except (OSError, ValueError, http.client.HTTPException):
+                logging.getLogger('amaltheia').exception(
+                    '[{}] Thruk request failed'.format(name))
+                result[name] = False
+
+                # the next request opens a new connection
+                conn.close()
+    finally:
+        conn.close()
+
+    return result